@@ -0,0 +1,232 @@
+import argparse
+import asyncio
+import json
+import pathlib
+import random
+import struct
+import subprocess
+import sys
+import time
+
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+SERVERS = {'tree': 'tree.py', 'gofer': 'gofer.py'}
+# Bodies start with the time they were put, for put to reserve latency
+stamp = struct.Struct('<d')
+
+
+class Results:
+    def __init__(self) -> None:
+        # Seconds, by what was measured
+        self.latencies = {'put': [], 'reserve': [], 'delete': [], 'end-to-end': []}
+
+    def add(self, name: str, seconds: float) -> None:
+        self.latencies[name].append(seconds)
+
+
+def percentile(values: list, q: float) -> float:
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def summary(values: list, duration: float) -> dict:
+    values = sorted(values)
+    if not values:
+        return {'count': 0}
+    return {
+        'count': len(values),
+        'per_second': len(values) / duration,
+        'p50_ms': percentile(values, 0.5) * 1000,
+        'p99_ms': percentile(values, 0.99) * 1000,
+        'p999_ms': percentile(values, 0.999) * 1000,
+        'max_ms': values[-1] * 1000,
+    }
+
+
+def parse_priorities(text: str) -> tuple[list, list]:
+    # `0:3,1024:1` is priority 0 three times as often as 1024
+    priorities, weights = [], []
+    for part in text.split(','):
+        priority, _, weight = part.partition(':')
+        priorities.append(int(priority))
+        weights.append(int(weight or 1))
+    return priorities, weights
+
+
+async def read_reply(reader: asyncio.StreamReader) -> tuple[bytes, bytes | None]:
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError('server closed the connection')
+    if line.startswith(b'RESERVED '):
+        size = int(line.split()[2])
+        body = await reader.readexactly(size + 2)
+        return line, body[:-2]
+    return line, None
+
+
+async def producer(args: argparse.Namespace, results: Results, tubes: list, stop: float) -> None:
+    reader, writer = await asyncio.open_connection(args.host, args.port)
+    priorities, weights = parse_priorities(args.priorities)
+    padding = b'x' * max(args.body_size - stamp.size, 0)
+    using = None
+    while time.perf_counter() < stop:
+        tube = random.choice(tubes)
+        batch = []
+        if tube != using:
+            batch.append(b'use %s\r\n' % tube)
+        chosen = random.choices(priorities, weights, k=args.pipeline)
+        sent = time.perf_counter()
+        for priority in chosen:
+            body = stamp.pack(sent) + padding
+            batch.append(b'put %d 0 60 %d\r\n%s\r\n' % (priority, len(body), body))
+        writer.write(b''.join(batch))
+        if tube != using:
+            await read_reply(reader)
+            using = tube
+        for _ in chosen:
+            line, _ = await read_reply(reader)
+            if not line.startswith(b'INSERTED'):
+                raise RuntimeError(line)
+            results.add('put', time.perf_counter() - sent)
+    writer.close()
+
+
+async def consumer(args: argparse.Namespace, results: Results, tubes: list, stop: float) -> None:
+    reader, writer = await asyncio.open_connection(args.host, args.port)
+    writer.write(b''.join(b'watch %s\r\n' % tube for tube in tubes))
+    for _ in tubes:
+        await read_reply(reader)
+    delete = b''
+    while time.perf_counter() < stop:
+        sent = time.perf_counter()
+        # The delete of the previous job goes out with the next reserve
+        writer.write(delete + b'reserve-with-timeout 1\r\n')
+        if delete:
+            await read_reply(reader)
+            results.add('delete', time.perf_counter() - sent)
+        line, body = await read_reply(reader)
+        now = time.perf_counter()
+        delete = b''
+        if body is None:
+            continue
+        results.add('reserve', now - sent)
+        if len(body) >= stamp.size:
+            results.add('end-to-end', now - stamp.unpack_from(body)[0])
+        delete = b'delete %s\r\n' % line.split()[1]
+    if delete:
+        writer.write(delete)
+        await read_reply(reader)
+    writer.close()
+
+
+async def run(args: argparse.Namespace) -> dict:
+    results = Results()
+    tubes = [b'bench-%d' % i for i in range(args.tubes)]
+    started = time.perf_counter()
+    stop = started + args.duration
+    tasks = [producer(args, results, tubes, stop) for _ in range(args.producers)]
+    tasks += [consumer(args, results, tubes, stop) for _ in range(args.consumers)]
+    await asyncio.gather(*tasks)
+    duration = time.perf_counter() - started
+    return {name: summary(values, duration) for name, values in results.latencies.items()}
+
+
+def wait_for_port(host: str, port: int) -> None:
+    import socket
+
+    for _ in range(100):
+        try:
+            socket.create_connection((host, port)).close()
+            return
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+    raise ConnectionRefusedError(port)
+
+
+def git_commit() -> str | None:
+    try:
+        output = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.stdout.decode().strip()
+
+
+def benchmark(args: argparse.Namespace) -> dict:
+    server = None
+    if args.server != 'none':
+        cmd = [sys.executable, SERVERS[args.server], *args.server_args]
+        if args.server == 'tree':
+            cmd += ['--port', str(args.port)]
+        server = subprocess.Popen(cmd, cwd=ROOT, stdout=subprocess.DEVNULL)
+    try:
+        wait_for_port(args.host, args.port)
+        results = asyncio.run(run(args))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    config = {
+        name: value for name, value in vars(args).items()
+        if name not in ('output', 'compare')
+    }
+    return {'commit': git_commit(), 'config': config, 'results': results}
+
+
+def print_results(report: dict) -> None:
+    for name, result in report['results'].items():
+        if not result['count']:
+            print(f'{name:>11}: no samples')
+            continue
+        print(
+            f'{name:>11}: {result["per_second"]:>10,.0f}/s  p50 {result["p50_ms"]:8.3f} ms  '
+            f'p99 {result["p99_ms"]:8.3f} ms  p99.9 {result["p999_ms"]:8.3f} ms',
+        )
+
+
+def compare(old_path: str, new_path: str) -> None:
+    old = json.loads(pathlib.Path(old_path).read_text())
+    new = json.loads(pathlib.Path(new_path).read_text())
+    print(f'{old["commit"] or old_path} -> {new["commit"] or new_path}')
+    for name, before in old['results'].items():
+        after = new['results'].get(name, {'count': 0})
+        if not before['count'] or not after['count']:
+            continue
+        parts = []
+        for key in ('per_second', 'p50_ms', 'p99_ms', 'p999_ms'):
+            change = (after[key] - before[key]) / before[key] * 100 if before[key] else 0
+            parts.append(f'{key} {change:+6.1f}%')
+        print(f'{name:>11}: ' + '  '.join(parts))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Throughput and latency under load')
+    parser.add_argument('--server', choices=[*SERVERS, 'none'], default='tree',
+                        help="server to start, or 'none' to use one already running")
+    parser.add_argument('--server-args', nargs=argparse.REMAINDER, default=[],
+                        help='passed on to the server, must come last')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=10_000)
+    parser.add_argument('--producers', type=int, default=4)
+    parser.add_argument('--consumers', type=int, default=4)
+    parser.add_argument('--pipeline', type=int, default=1, help='puts sent before reading replies')
+    parser.add_argument('--body-size', type=int, default=100)
+    parser.add_argument('--tubes', type=int, default=1)
+    parser.add_argument('--priorities', default='1024', help='priority:weight,...')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--output', help='save the results as JSON')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='compare two saved results and exit')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    report = benchmark(args)
+    print_results(report)
+    if args.output:
+        pathlib.Path(args.output).write_text(json.dumps(report, indent=2) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+import argparse
+import os
+import pathlib
+import resource
+import subprocess
+import sys
+
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+
+def max_rss() -> int:
+    # Peak resident set size in bytes, ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def measure(count: int, body_size: int, tube_count: int) -> None:
+    # Runs in its own process so the peak RSS is this run's alone
+    import protocol
+
+    names = [b'tube-%d' % i for i in range(tube_count)]
+    before = max_rss()
+    for i in range(count):
+        # A new body object per job, as the parser makes them
+        body = os.urandom(body_size) if body_size else b''
+        protocol.add_job(names[i % tube_count], protocol.Job(body, i % 1024, 60))
+    used = max_rss() - before
+    print(
+        f'{count:>12,} jobs  {body_size:>5} byte bodies  '
+        f'{used / 2 ** 20:>9,.1f} MiB  {used / count:>7.1f} bytes/job',
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Memory used per ready job')
+    parser.add_argument('--jobs', type=int, nargs='+', default=[1_000_000, 10_000_000])
+    parser.add_argument('--body-size', type=int, default=0)
+    parser.add_argument('--tubes', type=int, default=1)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        measure(args.jobs[0], args.body_size, args.tubes)
+        return
+    for count in args.jobs:
+        cmd = [
+            sys.executable, __file__, '--child', '--jobs', str(count),
+            '--body-size', str(args.body_size), '--tubes', str(args.tubes),
+        ]
+        subprocess.run(cmd, check=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,263 @@
+import argparse
+import json
+import math
+import pathlib
+import random
+import sys
+import time
+
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+import protocol
+from timers import Timers
+
+
+# Operations timed at each size, as many as this or the size if smaller
+SAMPLES = 1000
+TUBE = b'micro'
+
+
+def reset() -> None:
+    protocol.tubes.clear()
+    protocol.jobs.clear()
+    protocol.count_job = 0
+    protocol.timers = Timers()
+    protocol.stats = protocol.Stats()
+
+
+def new_client() -> protocol.Client:
+    # No connection, replies just pile up in outgoing
+    return protocol.Client(None, None)
+
+
+def fill_jobs(count: int, tube_count: int) -> None:
+    for i in range(count):
+        protocol.add_job(b'%s-%d' % (TUBE, i % tube_count), protocol.Job(b'', i % 1024, 60))
+
+
+def fill_clients(count: int) -> list:
+    clients = []
+    for _ in range(count):
+        client = new_client()
+        client.watching.append(TUBE)
+        protocol.ensure_tube_has_client(TUBE, client)
+        clients.append(client)
+    return clients
+
+
+def timed(run, samples: int) -> float:
+    # Nanoseconds per call
+    started = time.perf_counter_ns()
+    run()
+    return (time.perf_counter_ns() - started) / samples
+
+
+def bench_add_job(size: int, args: argparse.Namespace) -> float:
+    fill_jobs(size, args.tubes)
+    samples = min(SAMPLES, size)
+    jobs = [protocol.Job(b'', i % 1024, 60) for i in range(samples)]
+
+    def run() -> None:
+        for job in jobs:
+            protocol.add_job(b'%s-0' % TUBE, job)
+    return timed(run, samples)
+
+
+def bench_get_job_by_id(size: int, args: argparse.Namespace) -> float:
+    fill_jobs(size, args.tubes)
+    samples = min(SAMPLES, size)
+    ids = random.sample(range(1, size + 1), samples)
+
+    def run() -> None:
+        for job_id in ids:
+            protocol.get_job_by_id(job_id)
+    return timed(run, samples)
+
+
+def bench_delete_job(size: int, args: argparse.Namespace) -> float:
+    fill_jobs(size, args.tubes)
+    samples = min(SAMPLES, size)
+    jobs = [protocol.jobs[job_id] for job_id in random.sample(range(1, size + 1), samples)]
+
+    def run() -> None:
+        for job in jobs:
+            protocol.delete_job(job)
+    return timed(run, samples)
+
+
+def bench_get_job_with_client(size: int, args: argparse.Namespace) -> float:
+    # One tube holding every job, handed to waiting reservers
+    fill_jobs(size, 1)
+    tube = protocol.tubes[b'%s-0' % TUBE]
+    samples = min(SAMPLES, size)
+    clients = []
+    for _ in range(samples):
+        client = new_client()
+        client.watching.append(tube.name)
+        protocol.ensure_tube_has_client(tube.name, client)
+        protocol.wait_for_job(client)
+        clients.append(client)
+
+    def run() -> None:
+        for _ in range(samples):
+            protocol.get_job_with_client(tube)
+    return timed(run, samples)
+
+
+def bench_ensure_tube_has_client(size: int, args: argparse.Namespace) -> float:
+    fill_clients(size)
+    samples = min(SAMPLES, size)
+    clients = [new_client() for _ in range(samples)]
+
+    def run() -> None:
+        for client in clients:
+            protocol.ensure_tube_has_client(TUBE, client)
+    return timed(run, samples)
+
+
+def bench_add_job_watched(size: int, args: argparse.Namespace) -> float:
+    # Each job put is the new most urgent one of a tube size clients watch
+    fill_clients(size)
+    samples = SAMPLES
+    jobs = [protocol.Job(b'', samples - i, 60) for i in range(samples)]
+
+    def run() -> None:
+        for job in jobs:
+            protocol.add_job(TUBE, job)
+    return timed(run, samples)
+
+
+def bench_drop_connection(size: int, args: argparse.Namespace) -> float:
+    clients = fill_clients(size)
+    samples = min(SAMPLES, size)
+    dropped = random.sample(clients, samples)
+
+    def run() -> None:
+        for client in dropped:
+            protocol.drop_connection(client)
+    return timed(run, samples)
+
+
+def bench_reserve_ready_job(size: int, args: argparse.Namespace) -> float:
+    # One client watching size tubes, the jobs spread over them
+    client = new_client()
+    for i in range(size):
+        name = b'%s-%d' % (TUBE, i)
+        client.watching.append(name)
+        protocol.ensure_tube_has_client(name, client)
+    fill_jobs(SAMPLES, size)
+    samples = SAMPLES
+
+    def run() -> None:
+        for _ in range(samples):
+            protocol.reserve_ready_job(client)
+    return timed(run, samples)
+
+
+def bench_kick_jobs(size: int, args: argparse.Namespace) -> float:
+    # One tube of delayed jobs, kicked one at a time
+    for i in range(size):
+        protocol.add_job(TUBE, protocol.Job(b'', i % 1024, 60), 3600 + i % 1000)
+    tube = protocol.tubes[TUBE]
+    samples = min(SAMPLES, size)
+
+    def run() -> None:
+        for _ in range(samples):
+            protocol.kick_jobs(tube, 1)
+    return timed(run, samples)
+
+
+def bench_touch_job(size: int, args: argparse.Namespace) -> float:
+    # Delayed jobs fill the timer heap, reserved ones are touched
+    for i in range(size):
+        protocol.add_job(TUBE, protocol.Job(b'', 0, 60), 3600 + i % 1000)
+    samples = min(SAMPLES, size)
+    client = new_client()
+    client.watching.append(b'%s-0' % TUBE)
+    protocol.ensure_tube_has_client(b'%s-0' % TUBE, client)
+    fill_jobs(samples, 1)
+    held = [protocol.reserve_ready_job(client) for _ in range(samples)]
+
+    def run() -> None:
+        for job in held:
+            protocol.touch_job(job)
+    return timed(run, samples)
+
+
+JOB_BENCHMARKS = {
+    'add_job': bench_add_job,
+    'get_job_by_id': bench_get_job_by_id,
+    'delete_job': bench_delete_job,
+    'get_job_with_client': bench_get_job_with_client,
+    'kick_jobs': bench_kick_jobs,
+    'touch_job': bench_touch_job,
+}
+CLIENT_BENCHMARKS = {
+    'ensure_tube_has_client': bench_ensure_tube_has_client,
+    'add_job_watched': bench_add_job_watched,
+    'drop_connection': bench_drop_connection,
+}
+TUBE_BENCHMARKS = {
+    'reserve_ready_job': bench_reserve_ready_job,
+}
+
+
+def exponent(curve: list) -> float | None:
+    # Slope on a log-log scale between the ends of the curve, about 0
+    # for O(1), 1 for O(n)
+    (n1, t1), (n2, t2) = curve[0], curve[-1]
+    if n1 == n2 or t1 <= 0 or t2 <= 0:
+        return None
+    return math.log(t2 / t1) / math.log(n2 / n1)
+
+
+def run_curve(name: str, benchmark, sizes: list, args: argparse.Namespace) -> list:
+    curve = []
+    for size in sizes:
+        reset()
+        ns = benchmark(size, args)
+        curve.append((size, ns))
+        print(f'{name:>24} {size:>12,} {ns:>12,.0f} ns/op', flush=True)
+    return curve
+
+
+def powers(low: int, high: int) -> list:
+    return [10 ** e for e in range(low, high + 1)]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Cost of protocol.py operations by size')
+    parser.add_argument('--max-jobs', type=int, default=6, help='largest job count, as a power of 10 (up to 7)')
+    parser.add_argument('--max-clients', type=int, default=5, help='largest client count, as a power of 10')
+    parser.add_argument('--max-watched', type=int, default=4, help='most tubes watched, as a power of 10')
+    parser.add_argument('--tubes', type=int, default=10, help='tubes the jobs are spread over')
+    parser.add_argument(
+        '--only', nargs='+', choices=[*JOB_BENCHMARKS, *CLIENT_BENCHMARKS, *TUBE_BENCHMARKS],
+    )
+    parser.add_argument('--output', help='save the curves as JSON')
+    args = parser.parse_args()
+
+    curves = {}
+    benchmarks = [
+        *((name, bench, powers(3, args.max_jobs)) for name, bench in JOB_BENCHMARKS.items()),
+        *((name, bench, powers(1, args.max_clients)) for name, bench in CLIENT_BENCHMARKS.items()),
+        *((name, bench, powers(0, args.max_watched)) for name, bench in TUBE_BENCHMARKS.items()),
+    ]
+    for name, benchmark, sizes in benchmarks:
+        if args.only and name not in args.only:
+            continue
+        curves[name] = run_curve(name, benchmark, sizes, args)
+
+    print()
+    for name, curve in curves.items():
+        slope = exponent(curve)
+        growth = 'n/a' if slope is None else f'~n^{slope:.2f}'
+        print(f'{name:>24} {growth}')
+    if args.output:
+        report = {name: [{'size': n, 'ns_per_op': ns} for n, ns in curve] for name, curve in curves.items()}
+        pathlib.Path(args.output).write_text(json.dumps(report, indent=2) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,349 @@
+import itertools
+import os
+import struct
+import time
+import zlib
+
+import protocol
+
+
+# Record types
+PUT = 1
+DELETE = 2
+RELEASE = 3
+# Last job id handed out, heads every snapshot
+LAST_ID = 4
+BURY = 5
+KICK = 6
+
+# Every record is <payload size> <crc32 of payload> <payload>, the payload
+# starts with the record type and the job id
+frame = struct.Struct('<II')
+put_record = struct.Struct('<BQIIdHI')
+delete_record = struct.Struct('<BQ')
+release_record = struct.Struct('<BQId')
+bury_record = struct.Struct('<BQI')
+
+# A new segment is started once the current one reaches this size
+SEGMENT_SIZE = 10 * 2 ** 20
+
+
+def encode(payload: bytes, body: bytes = b'') -> list:
+    crc = zlib.crc32(body, zlib.crc32(payload))
+    header = frame.pack(len(payload) + len(body), crc)
+    if body:
+        return [header, payload, body]
+    return [header, payload]
+
+
+def encode_put(job_id: int, priority: int, ttr: int, ready: float, tube: bytes, body: bytes) -> list:
+    payload = put_record.pack(PUT, job_id, priority, ttr, ready, len(tube), len(body))
+    return encode(payload + tube, body)
+
+
+def ready_at(delay: int) -> float:
+    # Wall clock, so a delay survives a restart
+    if delay:
+        return time.time() + delay
+    return 0.0
+
+
+def segment_path(directory: str, number: int) -> str:
+    return os.path.join(directory, 'binlog.%06d' % number)
+
+
+def snapshot_path(directory: str, number: int) -> str:
+    return os.path.join(directory, 'snapshot.%06d' % number)
+
+
+def numbered(directory: str, prefix: str) -> list:
+    # Numbers of the files named prefix.NNNNNN, in order
+    numbers = []
+    for name in os.listdir(directory):
+        if name.startswith(prefix) and name[len(prefix):].isdigit():
+            numbers.append(int(name[len(prefix):]))
+    return sorted(numbers)
+
+
+def write_all(fd: int, buffers: list) -> None:
+    while buffers:
+        written = os.writev(fd, buffers[:protocol.IOV_MAX])
+        protocol.drop_sent(buffers, written)
+
+
+class Snapshot:
+    # Every live job, as the arguments of encode_put(), and the (id,
+    # priority) of buried jobs in burial order. It replaces the segments
+    # before `segment`, which the writer sets when it reaches this
+    # snapshot in the queue and starts that segment.
+    def __init__(self, last_id: int, jobs: list, buried: list) -> None:
+        self.buried = buried
+        self.jobs = jobs
+        self.last_id = last_id
+        self.segment = None
+        # Bytes written, known once it is
+        self.size = 0
+
+
+class Binlog:
+    # Append-only log of job events, split in numbered segments. Appending
+    # only queues the encoded record, the server writes and fsyncs queued
+    # records off the event loop with write(), as one group commit per
+    # round. Once enough has been logged a snapshot of the live jobs is
+    # taken and the segments it covers are deleted, so recovery reads
+    # about as much as there are live jobs.
+    def __init__(self, directory: str, fsync: bool, segment: int, segment_size: int = SEGMENT_SIZE) -> None:
+        self.directory = directory
+        self.fsync = fsync
+        self.segment = segment
+        self.segment_size = segment_size
+        # First segment still kept, the one the last snapshot precedes
+        self.oldest = segment
+        self.fd = os.open(segment_path(directory, segment), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.segment_written = 0
+        self.pending = []
+        # Records appended, and records written (and fsynced if enabled)
+        self.appended = 0
+        self.synced = 0
+        # Bytes logged since the last snapshot, and the size of that snapshot
+        self.logged = 0
+        self.snapshot_size = 0
+        self.snapshotting = False
+        # Set by the server, called when there is something to write
+        self.wakeup = None
+
+    def append(self, buffers: list) -> None:
+        self.pending.extend(buffers)
+        self.appended += 1
+        self.logged += sum(map(len, buffers))
+        if len(self.pending) == len(buffers) and self.wakeup is not None:
+            self.wakeup()
+
+    def put(self, job: protocol.Job, delay: int) -> None:
+        self.append(encode_put(job.id, job.priority, job.ttr, ready_at(delay), job.tube.name, job.body))
+
+    def delete(self, job: protocol.Job) -> None:
+        self.append(encode(delete_record.pack(DELETE, job.id)))
+
+    def release(self, job: protocol.Job, delay: int) -> None:
+        self.append(encode(release_record.pack(RELEASE, job.id, job.priority, ready_at(delay))))
+
+    def bury(self, job: protocol.Job) -> None:
+        self.append(encode(bury_record.pack(BURY, job.id, job.priority)))
+
+    def kick(self, job: protocol.Job) -> None:
+        self.append(encode(delete_record.pack(KICK, job.id)))
+
+    def take(self) -> tuple[list, int]:
+        buffers = self.pending
+        self.pending = []
+        return buffers, self.appended
+
+    def write(self, buffers: list) -> None:
+        # Runs in a worker thread, the only place segments change
+        start = 0
+        for i, buffer in enumerate(buffers):
+            if isinstance(buffer, Snapshot):
+                self.write_segment(buffers[start:i])
+                self.next_segment()
+                buffer.segment = self.segment
+                start = i + 1
+        self.write_segment(buffers[start:])
+        if self.segment_written >= self.segment_size:
+            self.next_segment()
+        if self.fsync:
+            os.fsync(self.fd)
+
+    def write_segment(self, buffers: list) -> None:
+        self.segment_written += sum(map(len, buffers))
+        write_all(self.fd, buffers)
+
+    def next_segment(self) -> None:
+        if self.fsync:
+            os.fsync(self.fd)
+        os.close(self.fd)
+        self.segment += 1
+        path = segment_path(self.directory, self.segment)
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.segment_written = 0
+
+    def wants_snapshot(self) -> bool:
+        # Snapshots cost about as much as the live jobs, so take one when
+        # the log since the last one is well past that
+        if self.snapshotting:
+            return False
+        return self.logged >= 2 * max(self.segment_size, self.snapshot_size)
+
+    def snapshot(self) -> Snapshot:
+        # Runs on the event loop so it sees a consistent state. Only the
+        # fields are gathered here, bodies shared rather than copied, and
+        # write_snapshot() encodes them.
+        now = time.time()
+        monotonic = time.monotonic()
+        jobs = []
+        for job in protocol.jobs.values():
+            if job.state == protocol.State.DELAYED:
+                ready = now + job.timer.deadline - monotonic
+            else:
+                # Reserved jobs come back ready after a restart anyway
+                ready = 0.0
+            jobs.append((job.id, job.priority, job.ttr, ready, job.tube.name, job.body))
+        buried = [
+            (job.id, job.priority)
+            for tube in protocol.tubes.values()
+            for job in tube.buried.values()
+        ]
+        snapshot = Snapshot(protocol.count_job, jobs, buried)
+        self.snapshotting = True
+        self.logged = 0
+        # Records appended from now on go to the segments after it
+        self.pending.append(snapshot)
+        self.appended += 1
+        if len(self.pending) == 1 and self.wakeup is not None:
+            self.wakeup()
+        return snapshot
+
+    def write_snapshot(self, snapshot: Snapshot) -> None:
+        # Runs in a worker thread, along with the CRCs and packing
+        buffers = encode(delete_record.pack(LAST_ID, snapshot.last_id))
+        for fields in snapshot.jobs:
+            buffers += encode_put(*fields)
+        # Buried jobs again, in the order they were buried
+        for job_id, priority in snapshot.buried:
+            buffers += encode(bury_record.pack(BURY, job_id, priority))
+        snapshot.size = sum(map(len, buffers))
+        path = os.path.join(self.directory, 'snapshot.tmp')
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            write_all(fd, buffers)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def commit_snapshot(self, snapshot: Snapshot) -> None:
+        # Runs in a worker thread once the writer has reached the snapshot
+        directory = self.directory
+        os.rename(os.path.join(directory, 'snapshot.tmp'), snapshot_path(directory, snapshot.segment))
+        fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        remove_before(directory, snapshot.segment)
+        self.oldest = snapshot.segment
+        self.snapshot_size = snapshot.size
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+def remove_before(directory: str, segment: int) -> None:
+    # Segments and snapshots made obsolete by the snapshot of `segment`
+    for number in numbered(directory, 'binlog.'):
+        if number < segment:
+            os.unlink(segment_path(directory, number))
+    for number in numbered(directory, 'snapshot.'):
+        if number < segment:
+            os.unlink(snapshot_path(directory, number))
+
+
+def read_records(path: str):
+    # Yields (type, job id, fields), stops at a torn or corrupt tail and
+    # truncates the file there so new records follow the last good one
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return
+    view = memoryview(data)
+    offset = 0
+    while offset + frame.size <= len(data):
+        size, crc = frame.unpack_from(data, offset)
+        start = offset + frame.size
+        payload = view[start:start + size]
+        if len(payload) < size or zlib.crc32(payload) != crc:
+            break
+        kind, job_id = delete_record.unpack_from(payload)
+        if kind == PUT:
+            (_, _, priority, ttr, ready, tube_size, body_size) = put_record.unpack_from(payload)
+            tube_start = put_record.size
+            tube = bytes(payload[tube_start:tube_start + tube_size])
+            body = bytes(payload[tube_start + tube_size:])
+            yield kind, job_id, (tube, priority, ttr, ready, body)
+        elif kind == RELEASE:
+            (_, _, priority, ready) = release_record.unpack_from(payload)
+            yield kind, job_id, (priority, ready)
+        elif kind == BURY:
+            (_, _, priority) = bury_record.unpack_from(payload)
+            yield kind, job_id, (priority,)
+        else:
+            yield kind, job_id, ()
+        offset = start + size
+    if offset < len(data):
+        os.truncate(path, offset)
+
+
+def replay(records) -> tuple[dict, int]:
+    # Live jobs by id as [tube, priority, ttr, ready_at, body, buried],
+    # buried counting up in burial order or 0, and the last id handed
+    # out so deleted ids aren't reused
+    live = {}
+    last_id = 0
+    burials = itertools.count(1)
+    for kind, job_id, fields in records:
+        if kind == PUT:
+            live[job_id] = [*fields, 0]
+            last_id = max(last_id, job_id)
+        elif kind == LAST_ID:
+            last_id = max(last_id, job_id)
+        elif kind == DELETE:
+            live.pop(job_id, None)
+        elif job_id not in live:
+            continue
+        elif kind == RELEASE:
+            live[job_id][1], live[job_id][3] = fields
+        elif kind == BURY:
+            live[job_id][1], live[job_id][5] = fields[0], next(burials)
+        elif kind == KICK:
+            live[job_id][3], live[job_id][5] = 0.0, 0
+    return live, last_id
+
+
+def restore(live: dict, last_id: int) -> None:
+    # Jobs reserved when the server stopped come back ready
+    now = time.time()
+    for job_id in sorted(live, key=lambda job_id: (live[job_id][5], job_id)):
+        tube, priority, ttr, ready, body, buried = live[job_id]
+        job = protocol.Job(body, priority, ttr)
+        job.id = job_id
+        protocol.insert_job(tube, job, max(ready - now, 0), bool(buried))
+    protocol.count_job = max(protocol.count_job, last_id)
+
+
+def recover(directory: str) -> int:
+    # Loads the latest snapshot and replays the segments after it,
+    # returns the number of the segment to log to next
+    snapshots = numbered(directory, 'snapshot.')
+    first = snapshots[-1] if snapshots else 0
+    paths = []
+    if snapshots:
+        paths.append(snapshot_path(directory, first))
+    segments = [number for number in numbered(directory, 'binlog.') if number >= first]
+    paths += [segment_path(directory, number) for number in segments]
+    restore(*replay(itertools.chain.from_iterable(map(read_records, paths))))
+
+    # Left over by a crash while snapshotting
+    remove_before(directory, first)
+    try:
+        os.unlink(os.path.join(directory, 'snapshot.tmp'))
+    except FileNotFoundError:
+        pass
+    return max(segments + [first]) + 1
+
+
+def open_binlog(directory: str, fsync: bool, segment_size: int = SEGMENT_SIZE) -> Binlog:
+    os.makedirs(directory, exist_ok=True)
+    segment = recover(directory)
+    binlog = Binlog(directory, fsync, segment, segment_size)
+    binlog.oldest = min(numbered(directory, 'binlog.'))
+    return binlog
@@ -0,0 +1,460 @@
+import bisect
+from collections import deque
+import math
+import os
+import socket
+import zlib
+
+import trio
+
+from commands import COMMANDS, handle_message, yaml_list
+from parser import Command, MAX_BATCH_SIZE
+import protocol
+from protocol import Client, QuitMessage
+
+
+# Points per worker on the hash ring, evens out the share of tubes
+VIRTUAL_NODES = 64
+# Tube owners remembered by the ring, forgotten all at once past this
+MAX_CACHED_OWNERS = 10_000
+# How long to wait for a worker that is still starting
+CONNECT_TIMEOUT = 5
+
+
+def socket_path(run_dir: str, worker: int) -> str:
+    return os.path.join(run_dir, 'worker.%d.sock' % worker)
+
+
+def command_data(command: Command) -> bytes:
+    # The command as the client sent it, to forward to another worker
+    data = [command.line, b'\r\n']
+    if isinstance(command.body, list):
+        # put-batch
+        for header, body in command.body:
+            data += [header, b'\r\n', body, b'\r\n']
+    elif command.body is not None:
+        data += [command.body, b'\r\n']
+    return b''.join(data)
+
+
+async def wait_or_hang_up(sock, event: trio.Event) -> bool:
+    # Wait for event, False if the client hangs up first. Whatever it
+    # sends meanwhile stays in the socket, past that a hang-up isn't told.
+    hung_up = False
+
+    async def watch_hang_up(cancel_scope: trio.CancelScope) -> None:
+        nonlocal hung_up
+        await trio.lowlevel.wait_readable(sock)
+        if not await sock.recv(1, socket.MSG_PEEK):
+            hung_up = True
+            cancel_scope.cancel()
+
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(watch_hang_up, nursery.cancel_scope)
+        await event.wait()
+        nursery.cancel_scope.cancel()
+    return not hung_up
+
+
+class Ring:
+    # Consistent hashing of tube names to workers. crc32 rather than
+    # hash() so every worker process agrees.
+    def __init__(self, workers: int) -> None:
+        points = sorted(
+            (zlib.crc32(b'%d-%d' % (worker, i)), worker)
+            for worker in range(workers)
+            for i in range(VIRTUAL_NODES)
+        )
+        self.hashes = [point for point, _ in points]
+        self.workers = [worker for _, worker in points]
+        self.owners = {}
+
+    def owner(self, tube: bytes) -> int:
+        owner = self.owners.get(tube)
+        if owner is None:
+            if len(self.owners) >= MAX_CACHED_OWNERS:
+                # Tubes come and go, don't keep every name ever seen
+                self.owners.clear()
+            i = bisect.bisect(self.hashes, zlib.crc32(tube)) % len(self.hashes)
+            owner = self.owners[tube] = self.workers[i]
+        return owner
+
+
+def message_size(buffer: bytearray, start: int = 0) -> int | None:
+    # Size of the reply at start if it is all in buffer, else None
+    end = buffer.find(b'\r\n', start)
+    if end == -1:
+        return None
+    size = end + 2 - start
+    if buffer.startswith((b'RESERVED ', b'FOUND ', b'OK '), start):
+        size += int(buffer[start:end].rsplit(b' ', 1)[1]) + 2
+    elif buffer.startswith(b'RESERVED-BATCH ', start):
+        # Followed by that many RESERVED frames
+        for _ in range(int(buffer[start:end].rsplit(b' ', 1)[1])):
+            frame = message_size(buffer, start + size)
+            if frame is None:
+                return None
+            size += frame
+    if len(buffer) < start + size:
+        return None
+    return size
+
+
+class Request:
+    def __init__(self, reserve: bool) -> None:
+        self.done = trio.Event()
+        self.reply = None
+        # TIMED_OUT is the reply to a reserve, otherwise it is a TTR notice
+        self.reserve = reserve
+
+
+class Session:
+    # A client's connection to a worker owning some of its tubes. The
+    # owner sees an ordinary client, so it keeps the use, watch list and
+    # reservations on the client's behalf.
+    def __init__(self, client: Client, stream: trio.SocketStream) -> None:
+        self.buffer = bytearray()
+        self.client = client
+        # Set by `JOB_READY` after a `wait-ready`, see Router.reserve()
+        self.ready = None
+        self.requests = deque()
+        self.stream = stream
+        self.using = None
+        self.watching = []
+
+    async def read_message(self) -> bytes | None:
+        buffer = self.buffer
+        while True:
+            size = message_size(buffer)
+            if size is not None:
+                message = bytes(buffer[:size])
+                del buffer[:size]
+                return message
+            data = await self.stream.receive_some()
+            if not data:
+                return None
+            buffer += data
+
+    async def run(self) -> None:
+        while True:
+            message = await self.read_message()
+            if message is None:
+                return
+            if message == b'JOB_READY\r\n':
+                # Late ones, after the reserve that asked, are dropped
+                if self.ready is not None:
+                    self.ready.set()
+                continue
+            request = self.requests[0] if self.requests else None
+            if message == b'DEADLINE_SOON\r\n' or request is None or (
+                message == b'TIMED_OUT\r\n' and not request.reserve
+            ):
+                # Sent by the owner on its own, pass it on
+                self.client.write(message)
+                continue
+            self.requests.popleft()
+            request.reply = message
+            request.done.set()
+
+    async def send(self, data: bytes, reserve: bool = False) -> Request:
+        # The request's reply is ready once request.done is set
+        request = Request(reserve)
+        self.requests.append(request)
+        await self.stream.send_all(data)
+        return request
+
+    async def request(self, data: bytes, reserve: bool = False) -> bytes:
+        request = await self.send(data, reserve)
+        await request.done.wait()
+        return request.reply
+
+    async def use(self, tube: bytes) -> None:
+        if self.using != tube:
+            await self.request(b'use %s\r\n' % tube)
+            self.using = tube
+
+    async def watch(self, tubes: list) -> None:
+        # Mirror the part of the client's watch list this owner holds
+        for tube in tubes:
+            if tube not in self.watching:
+                await self.request(b'watch %s\r\n' % tube)
+        for tube in self.watching:
+            if tube not in tubes:
+                await self.request(b'ignore %s\r\n' % tube)
+        self.watching = list(tubes)
+
+
+class Worker:
+    # One of the processes started by --workers. Each tube belongs to one
+    # worker. Commands on another worker's tubes or jobs are forwarded to
+    # it, so clients see a single server whichever worker they reach.
+    def __init__(self, index: int, workers: int, run_dir: str) -> None:
+        self.index = index
+        self.ring = Ring(workers)
+        self.run_dir = run_dir
+        self.workers = workers
+        protocol.id_step = workers
+        protocol.count_job = index + 1 - workers
+
+    def id_owner(self, job_id: int) -> int:
+        return (job_id - 1) % self.workers
+
+
+class Router:
+    # Routes one connection's commands, handles local ones as usual
+    def __init__(self, worker: Worker, client: Client, nursery: trio.Nursery) -> None:
+        self.client = client
+        self.nursery = nursery
+        self.sessions = {}
+        # The client's tube in use and watch list, across all workers.
+        # client.using and client.watching only hold this worker's tubes.
+        self.using = None
+        self.watching = []
+        self.worker = worker
+
+    async def session(self, owner: int) -> Session:
+        session = self.sessions.get(owner)
+        if session is None:
+            path = socket_path(self.worker.run_dir, owner)
+            with trio.move_on_after(CONNECT_TIMEOUT):
+                while not os.path.exists(path):
+                    await trio.sleep(0.05)
+            stream = await trio.open_unix_socket(path)
+            session = self.sessions[owner] = Session(self.client, stream)
+            self.nursery.start_soon(session.run)
+        return session
+
+    def owned(self, owner: int) -> list:
+        # The part of the watch list owner holds
+        return [tube for tube in self.watching if self.worker.ring.owner(tube) == owner]
+
+    async def handle(self, command: Command) -> None:
+        # Arguments are checked as commands.COMMANDS does. Anything
+        # malformed, and commands with no route, are handled here.
+        route = None
+        if not command.error:
+            name, _, args = command.line.partition(b' ')
+            if name in ROUTES:
+                args = COMMANDS[name][1](args)
+                if args is not None:
+                    route = ROUTES[name]
+        if route is not None:
+            await route(self, command, *args)
+        else:
+            await self.forward(self.worker.index, command)
+
+    async def forward(self, owner: int, command: Command) -> None:
+        # Run command on owner, which may be this worker
+        client = self.client
+        if owner != self.worker.index:
+            session = await self.session(owner)
+            client.write(await session.request(command_data(command)))
+            return
+        reply = handle_message(client, command)
+        if reply:
+            client.write(reply)
+
+    async def job_command(self, command: Command, job_id: int, *args: int) -> None:
+        # Job ids are handed out in turn by the workers, see Worker
+        await self.forward(self.worker.id_owner(job_id), command)
+
+    async def named_tube_command(self, command: Command, tube: bytes, *args: int) -> None:
+        # stats-tube and pause-tube
+        await self.forward(self.worker.ring.owner(tube), command)
+
+    async def used_tube_command(self, command: Command, *args: int) -> None:
+        # put, put-batch, kick and peek-ready, -delayed and -buried
+        owner = self.worker.index
+        if self.using is not None:
+            owner = self.worker.ring.owner(self.using)
+            if owner != self.worker.index:
+                session = await self.session(owner)
+                await session.use(self.using)
+        await self.forward(owner, command)
+
+    async def tube_command(self, command: Command, tube: bytes) -> None:
+        # use, watch and ignore. Another worker's tube is only kept by its
+        # owner, which is told right away so its stats count this client.
+        client = self.client
+        name = command.line.partition(b' ')[0]
+        owner = self.worker.ring.owner(tube)
+        if name == b'use':
+            if owner == self.worker.index:
+                handle_message(client, command)
+            else:
+                protocol.use_tube(client, None)
+                session = await self.session(owner)
+                await session.use(tube)
+            self.using = tube
+            client.write(b'USING %s\r\n' % tube)
+            return
+
+        watching = self.watching
+        changed = tube not in watching if name == b'watch' else tube in watching
+        if changed:
+            if name == b'watch':
+                watching.append(tube)
+            else:
+                watching.remove(tube)
+            if owner == self.worker.index:
+                handle_message(client, command)
+            else:
+                session = await self.session(owner)
+                await session.watch(self.owned(owner))
+        client.write(b'WATCHING %d\r\n' % len(watching))
+
+    async def list_tube_used(self, command: Command) -> None:
+        if self.using is None:
+            await self.forward(self.worker.index, command)
+            return
+        self.client.write(b'USING %s\r\n' % self.using)
+
+    async def list_tubes_watched(self, command: Command) -> None:
+        self.client.write(yaml_list(self.watching))
+
+    async def list_tubes(self, command: Command) -> None:
+        # Every worker has tubes of its own
+        names = set(protocol.tubes)
+        for owner in range(self.worker.workers):
+            if owner == self.worker.index:
+                continue
+            session = await self.session(owner)
+            reply = await session.request(b'list-tubes\r\n')
+            # `OK <bytes>\r\n---\n- <tube>\n...\r\n`
+            body = reply.split(b'\r\n', 1)[1][:-2]
+            names.update(line[2:] for line in body.splitlines()[1:])
+        self.client.write(yaml_list(sorted(names)))
+
+    async def reserve(self, command: Command, *args: int) -> None:
+        # reserve, reserve-with-timeout and reserve-batch
+        client = self.client
+        owners = sorted({self.worker.ring.owner(tube) for tube in self.watching})
+        if not owners or owners == [self.worker.index]:
+            await self.forward(self.worker.index, command)
+            return
+        sock = client.connection.socket
+        if len(owners) == 1:
+            # All on one other worker, it can block there
+            session = await self.session(owners[0])
+            await session.watch(self.watching)
+            request = await session.send(command_data(command), reserve=True)
+            if not await wait_or_hang_up(sock, request.done):
+                # Gone, stop reading as after quit
+                raise QuitMessage
+            client.write(request.reply)
+            return
+
+        # Spread over several workers. Each owner tells which job it would
+        # hand out and the most urgent one is reserved from its owner. With
+        # none ready, every owner is asked to tell once one is.
+        count = None
+        timeout = args[-1] if args else None
+        if command.line.startswith(b'reserve-batch '):
+            count = args[0]
+            if not 0 < count <= MAX_BATCH_SIZE:
+                client.write(b'BAD_FORMAT\r\n')
+                return
+        deadline = math.inf if timeout is None else trio.current_time() + timeout
+        while True:
+            best = None
+            for owner in owners:
+                top = await self.peek_watched(owner)
+                if top is not None and (best is None or top < best[0]):
+                    best = (top, owner)
+            if best is not None:
+                if await self.reserve_ready(best[1], count):
+                    return
+                # Taken meanwhile, look again
+                continue
+            if trio.current_time() >= deadline:
+                client.write(b'TIMED_OUT\r\n')
+                return
+            if not await self.wait_ready(owners, deadline):
+                raise QuitMessage
+
+    async def peek_watched(self, owner: int) -> tuple | None:
+        # (priority, id) of the job owner would hand out now
+        if owner == self.worker.index:
+            job = protocol.peek_watched(self.client)
+            return None if job is None else (job.priority, job.id)
+        session = await self.session(owner)
+        await session.watch(self.owned(owner))
+        reply = await session.request(b'peek-watched\r\n')
+        if reply == b'NOT_FOUND\r\n':
+            return None
+        _, job_id, priority = reply.split()
+        return (int(priority), int(job_id))
+
+    async def reserve_ready(self, owner: int, count: int | None) -> bool:
+        # Reserve from owner without waiting, False if nothing is ready
+        client = self.client
+        if owner == self.worker.index:
+            if count is None:
+                return protocol.reserve_ready_job(client) is not None
+            return protocol.reserve_batch(client, count) > 0
+        session = await self.session(owner)
+        if count is None:
+            data = b'reserve-with-timeout 0\r\n'
+        else:
+            data = b'reserve-batch %d 0\r\n' % count
+        reply = await session.request(data, reserve=True)
+        if reply == b'TIMED_OUT\r\n':
+            return False
+        client.write(reply)
+        return True
+
+    async def wait_ready(self, owners: list, deadline: float) -> bool:
+        # Until any owner has a ready job or the deadline passes, False if
+        # the client hangs up first. A `JOB_READY` still on its way from
+        # an earlier wait only makes the next reserve look again.
+        client = self.client
+        ready = trio.Event()
+        for owner in owners:
+            if owner == self.worker.index:
+                protocol.wait_ready(client, ready.set)
+            else:
+                session = self.sessions[owner]
+                session.ready = ready
+                await session.stream.send_all(b'wait-ready\r\n')
+        alive = True
+        with trio.move_on_at(deadline):
+            alive = await wait_or_hang_up(client.connection.socket, ready)
+        protocol.stop_waiting_ready(client)
+        for owner in owners:
+            if owner != self.worker.index:
+                self.sessions[owner].ready = None
+        return alive
+
+    async def close(self) -> None:
+        for session in self.sessions.values():
+            await session.stream.aclose()
+
+
+# Commands that may run on another worker, by how it is found from
+# their arguments as parsed by commands.COMMANDS
+ROUTES = {
+    b'bury': Router.job_command,
+    b'delete': Router.job_command,
+    b'ignore': Router.tube_command,
+    b'kick': Router.used_tube_command,
+    b'kick-job': Router.job_command,
+    b'list-tube-used': Router.list_tube_used,
+    b'list-tubes': Router.list_tubes,
+    b'list-tubes-watched': Router.list_tubes_watched,
+    b'pause-tube': Router.named_tube_command,
+    b'peek': Router.job_command,
+    b'peek-buried': Router.used_tube_command,
+    b'peek-delayed': Router.used_tube_command,
+    b'peek-ready': Router.used_tube_command,
+    b'put': Router.used_tube_command,
+    b'put-batch': Router.used_tube_command,
+    b'release': Router.job_command,
+    b'reserve': Router.reserve,
+    b'reserve-batch': Router.reserve,
+    b'reserve-with-timeout': Router.reserve,
+    b'stats-job': Router.job_command,
+    b'stats-tube': Router.named_tube_command,
+    b'touch': Router.job_command,
+    b'use': Router.tube_command,
+    b'watch': Router.tube_command,
+}
@@ -0,0 +1,451 @@
+import os
+import resource
+import socket
+import time
+
+from parser import Command, MAX_BATCH_SIZE
+import protocol
+from protocol import (
+    add_job,
+    add_jobs,
+    bury_job,
+    Client,
+    delete_job,
+    ensure_tube_has_client,
+    ensure_tube_without_client,
+    get_job_by_id,
+    Job,
+    kick_job,
+    kick_jobs,
+    MAX_JOB_SIZE,
+    pause_tube,
+    peek_buried,
+    peek_delayed,
+    peek_ready,
+    peek_watched,
+    QuitMessage,
+    requeue_job,
+    State,
+    stats,
+    touch_job,
+    try_to_issue_job_to_client,
+    try_to_reserve_batch,
+    tubes,
+    use_tube,
+    wait_ready,
+)
+
+
+MAX_TUBE_NAME_SIZE = 200
+# Priorities, delays and TTRs are 32-bit, as in beanstalkd and the binlog
+MAX_UINT32 = 2 ** 32 - 1
+VERSION = b'0.1.0'
+
+# Commands counted in `stats`, including those this server doesn't have
+STATS_COMMANDS = (
+    b'put', b'put-batch', b'peek', b'peek-ready', b'peek-delayed', b'peek-buried', b'reserve',
+    b'reserve-with-timeout', b'reserve-batch', b'delete', b'release', b'use', b'watch', b'ignore', b'bury',
+    b'kick', b'touch', b'stats', b'stats-job', b'stats-tube', b'list-tubes',
+    b'list-tube-used', b'list-tubes-watched', b'pause-tube',
+)
+# Fixed for the life of the server
+SERVER_ID = os.urandom(8).hex().encode()
+HOSTNAME = socket.gethostname().encode()
+UNAME = os.uname()
+
+
+# Argument parsers, each returns the arguments to pass to the handler
+# or None if they are malformed
+def no_args(args: bytes) -> tuple | None:
+    if args:
+        return None
+    return ()
+
+
+def tube_arg(args: bytes) -> tuple | None:
+    if not args or len(args) > MAX_TUBE_NAME_SIZE or b' ' in args:
+        return None
+    return (args,)
+
+
+def tube_int_args(args: bytes) -> tuple | None:
+    tube, _, number = args.rpartition(b' ')
+    if tube_arg(tube) is None or not number.isdigit() or int(number) > MAX_UINT32:
+        return None
+    return (tube, int(number))
+
+
+def int_args(count: int, uint32: tuple = ()):
+    # uint32 are the positions of the arguments that must fit in 32 bits,
+    # priorities and every time in seconds
+    def parse(args: bytes) -> tuple | None:
+        parts = args.split(b' ')
+        if len(parts) != count:
+            return None
+        for part in parts:
+            # Rejects signs, spaces and underscores that int() would accept
+            if not part.isdigit():
+                return None
+        values = tuple(map(int, parts))
+        for i in uint32:
+            if values[i] > MAX_UINT32:
+                return None
+        return values
+    return parse
+
+
+# `<pri> <delay> <ttr> <bytes>` of put and of each job of a put-batch
+put_args = int_args(4, uint32=(0, 1, 2))
+
+
+def quit_(client: Client, command: Command) -> None:
+    raise QuitMessage
+
+
+def use(client: Client, command: Command, tube: bytes) -> bytes:
+    use_tube(client, tube)
+    return b'USING %s\r\n' % tube
+
+
+def watch(client: Client, command: Command, tube: bytes) -> bytes:
+    if tube not in client.watching:
+        client.watching.append(tube)
+        ensure_tube_has_client(tube, client)
+    return b'WATCHING %d\r\n' % len(client.watching)
+
+
+def ignore(client: Client, command: Command, tube: bytes) -> bytes:
+    if tube in client.watching:
+        client.watching.remove(tube)
+        ensure_tube_without_client(tube, client)
+    return b'WATCHING %d\r\n' % len(client.watching)
+
+
+def set_worker(client: Client) -> None:
+    if not client.worker:
+        client.worker = True
+        stats.workers += 1
+
+
+def reserve(client: Client, command: Command) -> bytes | None:
+    if not client.watching:
+        return b'Error: `reserve` without watching a tube.'
+    set_worker(client)
+    try_to_issue_job_to_client(client)
+    return None
+
+
+def reserve_with_timeout(client: Client, command: Command, time_s: int) -> bytes | None:
+    if not client.watching:
+        return b'Error: `reserve` without watching a tube.'
+    set_worker(client)
+    try_to_issue_job_to_client(client, time_s)
+    return None
+
+
+def set_producer(client: Client) -> None:
+    if not client.producer:
+        client.producer = True
+        stats.producers += 1
+
+
+def put(client: Client, command: Command, priority: int, delay: int, ttr: int, _num_bytes: int) -> bytes:
+    tube = client.using
+    if tube is None:
+        return b'Error: `put` without using a tube.'
+    if command.body is None:
+        return b'BAD_FORMAT\r\n'
+    set_producer(client)
+    job = Job(command.body, priority, ttr)
+    job_id = add_job(tube, job, delay)
+    return b'INSERTED %d\r\n' % job_id
+
+
+def put_batch(client: Client, command: Command, count: int) -> bytes:
+    # `put-batch <n>` then n times `<pri> <delay> <ttr> <bytes>` and a body,
+    # inserted all or nothing with one reply listing the ids
+    tube = client.using
+    if tube is None:
+        return b'Error: `put` without using a tube.'
+    if command.body is None:
+        return b'BAD_FORMAT\r\n'
+    batch = []
+    for line, body in command.body:
+        args = put_args(line)
+        if args is None:
+            return b'BAD_FORMAT\r\n'
+        priority, delay, ttr, _num_bytes = args
+        batch.append((Job(body, priority, ttr), delay))
+    set_producer(client)
+    ids = add_jobs(tube, batch)
+    return b'INSERTED-BATCH %s\r\n' % b' '.join(b'%d' % job_id for job_id in ids)
+
+
+def reserve_batch_(client: Client, command: Command, count: int, time_s: int) -> bytes | None:
+    # Up to count jobs as `RESERVED-BATCH <k>` followed by k RESERVED
+    # frames, waiting up to time_s seconds for the first one
+    if not client.watching:
+        return b'Error: `reserve` without watching a tube.'
+    if not 0 < count <= MAX_BATCH_SIZE:
+        return b'BAD_FORMAT\r\n'
+    set_worker(client)
+    try_to_reserve_batch(client, count, time_s)
+    return None
+
+
+def peek_watched_(client: Client, command: Command) -> bytes:
+    # `TOP <id> <pri>` of the job a reserve would take now, for workers
+    # choosing between their owners, see cluster.Router.reserve()
+    job = peek_watched(client)
+    if job is None:
+        return b'NOT_FOUND\r\n'
+    return b'TOP %d %d\r\n' % (job.id, job.priority)
+
+
+def wait_ready_(client: Client, command: Command) -> None:
+    # No reply, `JOB_READY` is sent once a job is ready on a watched tube.
+    # The connection is still read meanwhile, unlike with a reserve.
+    wait_ready(client, lambda: client.write(b'JOB_READY\r\n'))
+
+
+def delete(client: Client, command: Command, job_id: int) -> bytes:
+    job = get_job_by_id(job_id)
+    if not job:
+        return b'NOT_FOUND\r\n'
+
+    if not job.client or client == job.client:
+        delete_job(job)
+        return b'DELETED\r\n'
+    return b'NOT_FOUND\r\n'
+
+
+def release(client: Client, command: Command, job_id: int, priority: int, delay: int) -> bytes:
+    job = get_job_by_id(job_id)
+    if not job or job.client is not client:
+        return b'NOT_FOUND\r\n'
+    requeue_job(job, priority, delay)
+    return b'RELEASED\r\n'
+
+
+def touch(client: Client, command: Command, job_id: int) -> bytes:
+    job = get_job_by_id(job_id)
+    if not job or job.client is not client:
+        return b'NOT_FOUND\r\n'
+    touch_job(job)
+    return b'TOUCHED\r\n'
+
+
+def pause_tube_(client: Client, command: Command, name: bytes, delay: int) -> bytes:
+    tube = tubes.get(name)
+    if tube is None:
+        return b'NOT_FOUND\r\n'
+    pause_tube(tube, delay)
+    return b'PAUSED\r\n'
+
+
+def bury(client: Client, command: Command, job_id: int, priority: int) -> bytes:
+    job = get_job_by_id(job_id)
+    if not job or job.client is not client:
+        return b'NOT_FOUND\r\n'
+    bury_job(job, priority)
+    return b'BURIED\r\n'
+
+
+def kick(client: Client, command: Command, bound: int) -> bytes:
+    tube = tubes.get(client.using)
+    kicked = 0 if tube is None else kick_jobs(tube, bound)
+    return b'KICKED %d\r\n' % kicked
+
+
+def kick_job_(client: Client, command: Command, job_id: int) -> bytes:
+    job = get_job_by_id(job_id)
+    if not job or job.state not in (State.BURIED, State.DELAYED):
+        return b'NOT_FOUND\r\n'
+    kick_job(job)
+    return b'KICKED\r\n'
+
+
+def found(client: Client, job: Job | None) -> bytes | None:
+    if job is None:
+        return b'NOT_FOUND\r\n'
+    # Sent from the stored body, like RESERVED
+    client.write(b'FOUND %d %d\r\n' % (job.id, len(job.body)), job.body, b'\r\n')
+    return None
+
+
+def peek(client: Client, command: Command, job_id: int) -> bytes | None:
+    return found(client, get_job_by_id(job_id))
+
+
+def peek_in_used_tube(peek_tube):
+    # `peek-ready`, `peek-delayed` and `peek-buried`
+    def handler(client: Client, command: Command) -> bytes | None:
+        tube = tubes.get(client.using)
+        return found(client, None if tube is None else peek_tube(tube))
+    return handler
+
+
+def yaml(fields: list) -> bytes:
+    # `OK <bytes>` and a YAML dictionary, values are already formatted
+    body = b'---\n' + b''.join(b'%s: %s\n' % field for field in fields)
+    return b'OK %d\r\n%s\r\n' % (len(body), body)
+
+
+def yaml_list(items) -> bytes:
+    body = b'---\n' + b''.join(b'- %s\n' % item for item in items)
+    return b'OK %d\r\n%s\r\n' % (len(body), body)
+
+
+def list_tubes(client: Client, command: Command) -> bytes:
+    return yaml_list(tubes)
+
+
+def list_tube_used(client: Client, command: Command) -> bytes:
+    if client.using is None:
+        # Connections start without a tube here, unlike beanstalkd
+        return b'NOT_FOUND\r\n'
+    return b'USING %s\r\n' % client.using
+
+
+def list_tubes_watched(client: Client, command: Command) -> bytes:
+    return yaml_list(client.watching)
+
+
+def job_counts(counts: protocol.Counts) -> list:
+    jobs = counts.jobs
+    return [
+        (b'current-jobs-urgent', b'%d' % counts.urgent),
+        (b'current-jobs-ready', b'%d' % jobs[State.READY]),
+        (b'current-jobs-reserved', b'%d' % jobs[State.RESERVED]),
+        (b'current-jobs-delayed', b'%d' % jobs[State.DELAYED]),
+        (b'current-jobs-buried', b'%d' % jobs[State.BURIED]),
+    ]
+
+
+def stats_(client: Client, command: Command) -> bytes:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    binlog = protocol.binlog
+    fields = job_counts(stats.counts)
+    fields += [(b'cmd-' + name, b'%d' % stats.commands.get(name, 0)) for name in STATS_COMMANDS]
+    fields += [
+        (b'job-timeouts', b'%d' % stats.job_timeouts),
+        (b'total-jobs', b'%d' % stats.total_jobs),
+        (b'max-job-size', b'%d' % MAX_JOB_SIZE),
+        (b'current-tubes', b'%d' % len(tubes)),
+        (b'current-connections', b'%d' % stats.connections),
+        (b'current-producers', b'%d' % stats.producers),
+        (b'current-workers', b'%d' % stats.workers),
+        (b'current-waiting', b'%d' % stats.waiting),
+        (b'total-connections', b'%d' % stats.total_connections),
+        (b'pid', b'%d' % os.getpid()),
+        (b'version', b'"%s"' % VERSION),
+        (b'rusage-utime', b'%.6f' % usage.ru_utime),
+        (b'rusage-stime', b'%.6f' % usage.ru_stime),
+        (b'uptime', b'%d' % (time.monotonic() - stats.started)),
+        (b'binlog-oldest-index', b'%d' % (binlog.oldest if binlog else 0)),
+        (b'binlog-current-index', b'%d' % (binlog.segment if binlog else 0)),
+        (b'binlog-records-migrated', b'0'),
+        (b'binlog-records-written', b'%d' % (binlog.synced if binlog else 0)),
+        (b'binlog-max-size', b'%d' % (binlog.segment_size if binlog else 0)),
+        (b'draining', b'false'),
+        (b'id', SERVER_ID),
+        (b'hostname', b'"%s"' % HOSTNAME),
+        (b'os', b'"%s"' % UNAME.version.encode()),
+        (b'platform', b'"%s"' % UNAME.machine.encode()),
+    ]
+    return yaml(fields)
+
+
+def stats_tube(client: Client, command: Command, name: bytes) -> bytes:
+    tube = tubes.get(name)
+    if tube is None:
+        return b'NOT_FOUND\r\n'
+    fields = [(b'name', b'"%s"' % name), *job_counts(tube.counts)]
+    pause_time_left = 0
+    if tube.pause_timer is not None:
+        pause_time_left = max(tube.pause_timer.deadline - time.monotonic(), 0)
+    fields += [
+        (b'total-jobs', b'%d' % tube.total_jobs),
+        (b'current-using', b'%d' % tube.using),
+        (b'current-waiting', b'%d' % len(tube.waiting)),
+        (b'current-watching', b'%d' % len(tube.clients)),
+        (b'pause', b'%d' % tube.pause),
+        (b'cmd-delete', b'%d' % tube.deletes),
+        (b'cmd-pause-tube', b'%d' % tube.pauses),
+        (b'pause-time-left', b'%d' % pause_time_left),
+    ]
+    return yaml(fields)
+
+
+def stats_job(client: Client, command: Command, job_id: int) -> bytes:
+    job = get_job_by_id(job_id)
+    if job is None:
+        return b'NOT_FOUND\r\n'
+    now = time.monotonic()
+    time_left = 0
+    if job.timer is not None:
+        time_left = max(job.timer.deadline - now, 0)
+    fields = [
+        (b'id', b'%d' % job.id),
+        (b'tube', b'"%s"' % job.tube.name),
+        (b'state', job.state.name.lower().encode()),
+        (b'pri', b'%d' % job.priority),
+        (b'age', b'%d' % (now - job.created)),
+        (b'delay', b'%d' % job.delay),
+        (b'ttr', b'%d' % job.ttr),
+        (b'time-left', b'%d' % time_left),
+        (b'file', b'0'),
+        (b'reserves', b'%d' % job.reserves),
+        (b'timeouts', b'%d' % job.timeouts),
+        (b'releases', b'%d' % job.releases),
+        (b'buries', b'%d' % job.buries),
+        (b'kicks', b'%d' % job.kicks),
+    ]
+    return yaml(fields)
+
+
+COMMANDS = {
+    b'bury': (bury, int_args(2, uint32=(1,))),
+    b'delete': (delete, int_args(1)),
+    b'ignore': (ignore, tube_arg),
+    b'kick': (kick, int_args(1)),
+    b'kick-job': (kick_job_, int_args(1)),
+    b'list-tube-used': (list_tube_used, no_args),
+    b'list-tubes': (list_tubes, no_args),
+    b'list-tubes-watched': (list_tubes_watched, no_args),
+    b'peek': (peek, int_args(1)),
+    b'peek-buried': (peek_in_used_tube(peek_buried), no_args),
+    b'peek-delayed': (peek_in_used_tube(peek_delayed), no_args),
+    b'peek-ready': (peek_in_used_tube(peek_ready), no_args),
+    b'peek-watched': (peek_watched_, no_args),
+    b'pause-tube': (pause_tube_, tube_int_args),
+    b'put': (put, put_args),
+    b'put-batch': (put_batch, int_args(1)),
+    b'quit': (quit_, no_args),
+    b'release': (release, int_args(3, uint32=(1, 2))),
+    b'reserve': (reserve, no_args),
+    b'reserve-batch': (reserve_batch_, int_args(2, uint32=(1,))),
+    b'reserve-with-timeout': (reserve_with_timeout, int_args(1, uint32=(0,))),
+    b'stats': (stats_, no_args),
+    b'stats-job': (stats_job, int_args(1)),
+    b'stats-tube': (stats_tube, tube_arg),
+    b'touch': (touch, int_args(1)),
+    b'use': (use, tube_arg),
+    b'wait-ready': (wait_ready_, no_args),
+    b'watch': (watch, tube_arg),
+}
+
+
+def handle_message(client: Client, command: Command) -> bytes | None:
+    if command.error:
+        return command.error
+    name, _, args = command.line.partition(b' ')
+    try:
+        handler, parse_args = COMMANDS[name]
+    except KeyError:
+        return b'UNKNOWN_COMMAND\r\n'
+    stats.commands[name] = stats.commands.get(name, 0) + 1
+    args = parse_args(args)
+    if args is None:
+        return b'BAD_FORMAT\r\n'
+    return handler(client, command, *args)
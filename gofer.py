@@ -1,21 +1,20 @@
 import asyncio
 import logging
-import re
 import socket
 import sys
+import time
 
+from commands import handle_message
+from parser import Parser
 from protocol import (
-    add_job,
     Client,
     drop_connection,
-    ensure_tube_has_client,
-    ensure_tube_without_client,
-    ignore_message,
-    Job,
+    drop_sent,
+    IOV_MAX,
     MAX_JOB_SIZE,
+    MAX_UNSENT,
     QuitMessage,
-    try_to_issue_job,
-    try_to_issue_job_to_client,
+    timers,
 )
 
 
@@ -24,125 +23,134 @@ logger.setLevel(logging.DEBUG)
 handler = logging.StreamHandler(sys.stdout)
 logger.addHandler(handler)
 
-put_head_re = re.compile('put ([0-9]+) ([0-9]+) ([0-9]+) ([0-9]+)')
-
 count_job = 0
 in_event_loop = set()
 
 
-async def issue_job(job: Job) -> None:
+async def wait_writable(sock: socket.socket) -> None:
     loop = asyncio.get_event_loop()
-    job_size = len(job.body)
-    message = f'RESERVED {job.id} {job_size}\r\n'
-    to_send = message.encode('utf-8') + job.body + b'\r\n'
-    await loop.sock_sendall(job.client.connection, to_send)
-
-
-def handle_message(client: Client, message: bytes) -> str | None:
-    if message == b'quit':
-        raise QuitMessage
-    if message.startswith(b'use '):
-        tube = message.replace(b'use ', b'').decode('utf-8')
-        client.using = tube
-        return f'USING {tube}\r\n'
-    if message.startswith(b'watch '):
-        tube = message.replace(b'watch ', b'').decode('utf-8')
-        client.watching.append(tube)
-        ensure_tube_has_client(tube, client)
-        count = len(client.watching)
-        return f'WATCHING {count}\r\n'
-    if message.startswith(b'ignore '):
-        tube = message.replace(b'ignore ', b'').decode('utf-8')
-        client.watching.remove(tube)
-        ensure_tube_without_client(tube, client)
-        count = len(client.watching)
-        return f'WATCHING {count}\r\n'
-    if message.startswith(b'reserve'):
-        if not client.watching:
-            msg = 'Error: `reserve` without watching a tube.'
-            return msg
-        task = asyncio.create_task(try_to_issue_job_to_client(client, issue_job))
-        in_event_loop.add(task)
-        task.add_done_callback(lambda _: in_event_loop.discard(task))
-        return
-    if message.startswith(b'put '):
-        head, body = message.split(b'\r\n')
-        (pri, delay, ttr, num_bytes) = put_head_re.match(head.decode('utf-8')).groups()
-        tube = client.using
-        if tube is None:
-            msg = 'Error: `put` without using a tube.'
-            return msg
-        job = Job(body)
-        logger.debug('Job created.')
-
-        job_id = add_job(tube, job)
-        task = asyncio.create_task(try_to_issue_job(tube, issue_job))
-        in_event_loop.add(task)
-        task.add_done_callback(lambda _: in_event_loop.discard(task))
-        return f'INSERTED {job_id}\r\n'
+    writable = loop.create_future()
+    loop.add_writer(sock, writable.set_result, None)
+    try:
+        await writable
+    finally:
+        loop.remove_writer(sock)
+
+
+async def wait_readable(sock: socket.socket) -> None:
+    loop = asyncio.get_event_loop()
+    readable = loop.create_future()
+    loop.add_reader(sock, readable.set_result, None)
+    try:
+        await readable
+    finally:
+        loop.remove_reader(sock)
+
+
+async def wait_for_reserve(client: Client) -> bool:
+    # Like beanstalkd, nothing sent after a reserve that waits is read
+    # until it is answered, it stays in the parser and the socket. A
+    # client hanging up meanwhile is still noticed, False then.
+    resumed = asyncio.Event()
+    client.resume = resumed.set
+    waiter = asyncio.ensure_future(resumed.wait())
+    readable = asyncio.ensure_future(wait_readable(client.connection))
+    try:
+        await asyncio.wait((waiter, readable), return_when=asyncio.FIRST_COMPLETED)
+        if readable.done() and not client.connection.recv(1, socket.MSG_PEEK):
+            return False
+        await waiter
+    finally:
+        waiter.cancel()
+        readable.cancel()
+        client.resume = None
+    return True
 
 
-async def on_connection(client: Client) -> None:
-    message = b''
+async def send_buffers(sock: socket.socket, buffers: list) -> None:
+    while buffers:
+        try:
+            sent = sock.sendmsg(buffers[:IOV_MAX])
+        except BlockingIOError:
+            await wait_writable(sock)
+            continue
+        drop_sent(buffers, sent)
+
+
+async def send_replies(client: Client) -> None:
+    wakeup = asyncio.Event()
+    client.wakeup = wakeup.set
+    while True:
+        if not client.outgoing:
+            wakeup.clear()
+            await wakeup.wait()
+        # Everything written while this task wasn't running, usually the
+        # replies to a whole read batch, goes out in one sendmsg
+        buffers = client.outgoing
+        client.outgoing = []
+        size = sum(map(len, buffers))
+        await send_buffers(client.connection, buffers)
+        client.unsent -= size
+        if client.sent is not None:
+            client.sent()
+
+
+async def wait_sent(client: Client, writer: asyncio.Task, limit: int) -> None:
+    # Until no more than limit bytes of replies wait to be sent, or the
+    # writer is gone
+    while client.unsent > limit and not writer.done():
+        sent = asyncio.Event()
+        client.sent = sent.set
+        waiter = asyncio.ensure_future(sent.wait())
+        await asyncio.wait((writer, waiter), return_when=asyncio.FIRST_COMPLETED)
+        waiter.cancel()
+
+
+async def run_timers() -> None:
+    wakeup = asyncio.Event()
+    timers.wakeup = wakeup.set
+    while True:
+        timers.expire()
+        wakeup.clear()
+        deadline = timers.next_deadline()
+        if deadline is None:
+            timeout = None
+        else:
+            timeout = max(deadline - time.monotonic(), 0)
+        try:
+            await asyncio.wait_for(wakeup.wait(), timeout)
+        except TimeoutError:
+            pass
+
+
+async def on_connection(client: Client, writer: asyncio.Task) -> None:
+    parser = Parser(MAX_JOB_SIZE)
     try:
         loop = asyncio.get_event_loop()
-        while True:
-            # TODO: why 100?
-            data = await loop.sock_recv(client.connection, 100)
-            if data == b'':
-                message = b''
-                drop_connection(client)
-                return
-
-            message += data
-            if ignore_message(message):
-                message = b''
-                continue
-            if message.startswith(b'put') and b'\r\n' in message:
-                try:
-                    (pri, delay, ttr, num_bytes) = put_head_re.match(message.decode('utf-8')).groups()
-                except AttributeError:
-                    continue
-                num_bytes_int = int(num_bytes)
-                if num_bytes_int > MAX_JOB_SIZE:
-                    # clear message before yielding to event loop
-                    message = b''
-                    data = await loop.sock_sendall(client.connection, b'JOB_TOO_BIG\r\n')
-                    continue
-                body = message.split(b'\r\n')[-1]
-                if body and len(body) > num_bytes_int:
-                    # clear message before yielding to event loop
-                    message = b''
-                    data = await loop.sock_sendall(client.connection, b'EXPECTED_CRLF\r\n')
-                    continue
-                if message.count(b'\r\n') == 1:
-                    continue
-            elif b'\r\n' not in message:
-                continue
-    
-            # message will contain at least one message
-            messages = message.split(b'\r\n')
-            # Combine put which has two \r\n
-            complete_messages = []
-            found_put = False
-            for idx, message in enumerate(messages):
-                if found_put:
-                    complete_messages[-1] += b'\r\n' + message
-                    found_put = False
-                if b'put' in message:
-                    found_put = True
-                complete_messages.append(message)
-
-            for message in complete_messages:
-                try:
-                    reply = handle_message(client, message)
-                except QuitMessage:
-                    drop_connection(client)
-                    return
-                if reply:
-                    await loop.sock_sendall(client.connection, reply.encode('utf-8'))
+        try:
+            while True:
+                await wait_sent(client, writer, MAX_UNSENT)
+                # Put bodies are received straight into the buffer they are kept in
+                nbytes = await loop.sock_recv_into(client.connection, parser.get_buffer())
+                if nbytes == 0:
+                    break
+
+                parser.buffer_updated(nbytes)
+                for command in parser:
+                    reply = handle_message(client, command)
+                    if reply:
+                        client.write(reply)
+                    if client.waiting and not await wait_for_reserve(client):
+                        return
+        except QuitMessage:
+            pass
+        # Replies to the commands before EOF or quit still go out
+        await wait_sent(client, writer, 0)
     finally:
         logger.debug('Connection closed')
+        # Whatever ended it, so jobs it held are handed out again
+        drop_connection(client)
+        writer.cancel()
         client.connection.close()
 
 
@@ -157,11 +165,19 @@ def on_done_connection_data(task: asyncio.Task) -> None:
 
 async def on_new_connection(sock: socket.socket) -> None:
     loop = asyncio.get_event_loop()
+    timer_task = asyncio.create_task(run_timers())
+    in_event_loop.add(timer_task)
+    timer_task.add_done_callback(on_done_connection_data)
     while True:
         connection, address = await loop.sock_accept(sock)
+        # Every reply to this client, including jobs handed over by other
+        # connections, goes through one writer so they never interleave
         new_client = Client(connection, address)
         logger.debug('New Client created.')
-        task = asyncio.create_task(on_connection(new_client))
+        writer = asyncio.create_task(send_replies(new_client))
+        in_event_loop.add(writer)
+        writer.add_done_callback(in_event_loop.discard)
+        task = asyncio.create_task(on_connection(new_client, writer))
         # Add reference to task so it isn't garbage collected
         in_event_loop.add(task)
         task.add_done_callback(on_done_connection_data)
@@ -0,0 +1,100 @@
+import bisect
+
+import protocol
+from protocol import State
+
+
+# Seconds, for command service times
+SERVICE_BUCKETS = (
+    0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1,
+)
+# Seconds, for time spent queued or held by a consumer
+WAIT_BUCKETS = (0.001, 0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600, 4 * 3600, 24 * 3600)
+
+
+class Histogram:
+    # Fixed buckets, observe() is a bisect and two additions
+    def __init__(self, buckets: tuple) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def render(self, name: str, labels: str = '') -> list:
+        lines = []
+        total = 0
+        separator = ',' if labels else ''
+        for bound, count in zip((*self.buckets, '+Inf'), self.counts):
+            total += count
+            lines.append(f'{name}_bucket{{{labels}{separator}le="{bound}"}} {total}')
+        braces = f'{{{labels}}}' if labels else ''
+        lines.append(f'{name}_sum{braces} {self.sum}')
+        lines.append(f'{name}_count{braces} {total}')
+        return lines
+
+
+def label(value: bytes) -> str:
+    text = value.decode('utf-8', 'replace')
+    return text.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metrics:
+    def __init__(self) -> None:
+        # put to first reserve, and reserve to delete
+        self.queue_wait = Histogram(WAIT_BUCKETS)
+        self.processing = Histogram(WAIT_BUCKETS)
+        # Time to handle a command, by command name
+        self.commands = {}
+
+    def command(self, name: bytes, seconds: float) -> None:
+        histogram = self.commands.get(name)
+        if histogram is None:
+            histogram = self.commands[name] = Histogram(SERVICE_BUCKETS)
+        histogram.observe(seconds)
+
+    def render(self) -> bytes:
+        # Prometheus text exposition format
+        stats = protocol.stats
+        lines = [
+            '# HELP tree_queue_wait_seconds Time from put to first reserve.',
+            '# TYPE tree_queue_wait_seconds histogram',
+            *self.queue_wait.render('tree_queue_wait_seconds'),
+            '# HELP tree_processing_seconds Time from reserve to delete.',
+            '# TYPE tree_processing_seconds histogram',
+            *self.processing.render('tree_processing_seconds'),
+            '# HELP tree_command_seconds Time to handle a command.',
+            '# TYPE tree_command_seconds histogram',
+        ]
+        for name, histogram in sorted(self.commands.items()):
+            lines += histogram.render('tree_command_seconds', f'command="{label(name)}"')
+
+        lines += [
+            '# HELP tree_jobs Jobs by tube and state.',
+            '# TYPE tree_jobs gauge',
+        ]
+        for name, tube in sorted(protocol.tubes.items()):
+            for state in (State.READY, State.RESERVED, State.DELAYED, State.BURIED):
+                count = tube.counts.jobs[state]
+                lines.append(f'tree_jobs{{tube="{label(name)}",state="{state.name.lower()}"}} {count}')
+        lines += [
+            '# HELP tree_waiting_clients Clients blocked in reserve by tube.',
+            '# TYPE tree_waiting_clients gauge',
+        ]
+        for name, tube in sorted(protocol.tubes.items()):
+            lines.append(f'tree_waiting_clients{{tube="{label(name)}"}} {len(tube.waiting)}')
+
+        lines += [
+            '# HELP tree_jobs_total Jobs put.',
+            '# TYPE tree_jobs_total counter',
+            f'tree_jobs_total {stats.total_jobs}',
+            '# HELP tree_job_timeouts_total Reservations that ran out of TTR.',
+            '# TYPE tree_job_timeouts_total counter',
+            f'tree_job_timeouts_total {stats.job_timeouts}',
+            '# HELP tree_connections Open connections.',
+            '# TYPE tree_connections gauge',
+            f'tree_connections {stats.connections}',
+        ]
+        return ('\n'.join(lines) + '\n').encode()
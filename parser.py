@@ -0,0 +1,243 @@
+# Longest command line accepted, same as beanstalkd
+MAX_LINE_SIZE = 224
+# Size of the scratch buffer commands are received into
+RECEIVE_SIZE = 2 ** 14
+# Most jobs in one put-batch
+MAX_BATCH_SIZE = 1000
+
+# Returned by next_command() for a job of a batch that isn't complete yet
+BATCHED = object()
+
+
+class Command:
+    def __init__(self, line: bytes, body: bytes | None = None, error: bytes | None = None) -> None:
+        # Reply to send instead of handling the command when framing failed
+        self.error = error
+        self.body = body
+        self.line = line
+
+
+class Parser:
+    # Incremental framing of the beanstalkd protocol, without I/O.
+    # Bytes go in with feed(), or are received into get_buffer() and
+    # announced with buffer_updated(). Complete commands come out by
+    # iterating.
+    def __init__(self, max_job_size: int) -> None:
+        # Body of the current put, allocated at its final size once the
+        # header is parsed so the rest is received straight into it
+        self.body = None
+        self.body_filled = 0
+        self.buffer = bytearray()
+        self.chunk = memoryview(bytearray(RECEIVE_SIZE))
+        self.max_job_size = max_job_size
+        # Start of the bytes not consumed yet
+        self.offset = 0
+        # No CRLF before this position, so a partial line isn't rescanned
+        self.scanned = 0
+        # Header of a put whose body hasn't fully arrived
+        self.put_line = None
+        self.body_size = 0
+        self.receiving_body = False
+        # Bytes of a rejected body still to be discarded
+        self.skip = 0
+        # Rest of a line too long to be a command, discarded up to its CRLF
+        self.skip_line = False
+        # put-batch being received: its line, how many jobs it announced
+        # and how many were read, the (header, body) of the good ones and
+        # the first error
+        self.batch_line = None
+        self.batch_size = 0
+        self.batch_read = 0
+        self.batch = []
+        self.batch_error = None
+
+    def feed(self, data: bytes) -> None:
+        if self.body is not None:
+            data = memoryview(data)
+            size = min(len(data), len(self.body) - self.body_filled)
+            self.body[self.body_filled:self.body_filled + size] = data[:size]
+            self.body_filled += size
+            data = data[size:]
+        buffer = self.buffer
+        if self.offset:
+            # Drop consumed bytes, cheap for bytearray
+            del buffer[:self.offset]
+            self.scanned -= self.offset
+            self.offset = 0
+        buffer += data
+
+    def get_buffer(self) -> memoryview:
+        # Where the next recv_into() should write
+        if self.body is not None and self.body_filled < len(self.body):
+            self.receiving_body = True
+            return memoryview(self.body)[self.body_filled:]
+        self.receiving_body = False
+        return self.chunk
+
+    def buffer_updated(self, nbytes: int) -> None:
+        if self.receiving_body:
+            self.body_filled += nbytes
+        else:
+            self.feed(self.chunk[:nbytes])
+
+    def __iter__(self):
+        while True:
+            command = self.next_command()
+            if command is None:
+                return
+            if command is not BATCHED:
+                yield command
+
+    def next_command(self) -> Command | None:
+        buffer = self.buffer
+        if self.skip:
+            skipped = min(self.skip, len(buffer) - self.offset)
+            self.offset += skipped
+            self.skip -= skipped
+            if self.skip:
+                return None
+            self.scanned = self.offset
+
+        if self.skip_line:
+            end = buffer.find(b'\r\n', max(self.offset, self.scanned))
+            if end == -1:
+                # The last byte may be the \r of a CRLF
+                self.offset = self.scanned = max(len(buffer) - 1, self.offset)
+                return None
+            self.offset = self.scanned = end + 2
+            self.skip_line = False
+
+        if self.put_line is not None:
+            return self.next_body()
+
+        start = max(self.offset, self.scanned)
+        end = buffer.find(b'\r\n', start)
+        if end == -1:
+            if len(buffer) - self.offset > MAX_LINE_SIZE:
+                # Whatever follows up to the CRLF is part of it, not a command
+                self.offset = self.scanned = len(buffer) - 1
+                self.skip_line = True
+                if self.batch_line is not None:
+                    return self.batch_failed(b'BAD_FORMAT\r\n')
+                return Command(b'', error=b'BAD_FORMAT\r\n')
+            # The last byte may be the \r of a CRLF
+            self.scanned = max(len(buffer) - 1, self.offset)
+            return None
+
+        line = bytes(buffer[self.offset:end])
+        self.offset = self.scanned = end + 2
+        if self.batch_line is None:
+            if line.startswith(b'put-batch '):
+                return self.start_batch(line)
+            if not line.startswith(b'put '):
+                return Command(line)
+
+        try:
+            body_size = int(line.rsplit(b' ', 1)[1])
+        except (IndexError, ValueError):
+            body_size = -1
+        if self.batch_line is not None and (body_size < 0 or line.count(b' ') != 3):
+            # Not `<pri> <delay> <ttr> <bytes>`, skip the body it announces
+            # if it can be told, so the frames after it are framed right
+            if body_size >= 0:
+                self.skip = body_size + 2
+            return self.batch_failed(b'BAD_FORMAT\r\n')
+        if body_size < 0:
+            # Let the command handler reject it
+            return Command(line)
+        if body_size > self.max_job_size:
+            self.skip = body_size + 2
+            if self.batch_line is not None:
+                return self.batch_failed(b'JOB_TOO_BIG\r\n')
+            return Command(line, error=b'JOB_TOO_BIG\r\n')
+        self.put_line = line
+        self.body_size = body_size
+        return self.next_body()
+
+    def next_body(self) -> Command | None:
+        size = self.body_size
+        body = self.body
+        if body is None:
+            buffer = self.buffer
+            start = self.offset
+            available = len(buffer) - start
+            if available > size and buffer[start + size] != ord('\r'):
+                return self.reject_body()
+            if available >= size + 2:
+                if buffer[start + size + 1] != ord('\n'):
+                    return self.reject_body()
+                # Small bodies arrive with their header, copy them out once
+                with memoryview(buffer) as view:
+                    body = bytes(view[start:start + size])
+                self.offset = self.scanned = start + size + 2
+                return self.finish_body(body)
+
+            # Receive the rest of the body straight into its own buffer
+            body = self.body = bytearray(size + 2)
+            with memoryview(buffer) as view:
+                body[:available] = view[start:]
+            self.body_filled = available
+            self.offset = self.scanned = len(buffer)
+            return None
+
+        filled = self.body_filled
+        if filled > size and body[size] != ord('\r'):
+            return self.reject_body()
+        if filled < size + 2:
+            return None
+        if body[size + 1] != ord('\n'):
+            return self.reject_body()
+        self.body = None
+        return self.finish_body(memoryview(body)[:size])
+
+    def finish_body(self, body: bytes | memoryview) -> Command:
+        line = self.put_line
+        self.put_line = None
+        if self.batch_line is not None:
+            self.batch.append((line, body))
+            self.batch_read += 1
+            return self.next_in_batch()
+        return Command(line, body)
+
+    def start_batch(self, line: bytes) -> Command:
+        count = line[len(b'put-batch '):]
+        if not count.isdigit() or not 0 < int(count) <= MAX_BATCH_SIZE:
+            # Let the command handler reject it
+            return Command(line)
+        self.batch_line = line
+        self.batch_size = int(count)
+        self.batch_read = 0
+        return BATCHED
+
+    def next_in_batch(self) -> Command:
+        if self.batch_read < self.batch_size:
+            return BATCHED
+        return self.finish_batch(self.batch_error)
+
+    def batch_failed(self, error: bytes) -> Command:
+        # Keep reading the batch so what follows it is framed right, but
+        # reply with the first error instead of inserting any of it
+        if self.batch_error is None:
+            self.batch_error = error
+        self.batch_read += 1
+        return self.next_in_batch()
+
+    def finish_batch(self, error: bytes | None) -> Command:
+        command = Command(self.batch_line, self.batch, error)
+        self.batch_line = None
+        self.batch = []
+        self.batch_error = None
+        return command
+
+    def reject_body(self) -> Command:
+        # Body isn't followed by CRLF, discard it with the two bytes after
+        line = self.put_line
+        self.put_line = None
+        self.skip = self.body_size + 2
+        if self.body is not None:
+            # Part of it is already out of the line buffer
+            self.skip -= self.body_filled
+            self.body = None
+        if self.batch_line is not None:
+            return self.batch_failed(b'EXPECTED_CRLF\r\n')
+        return Command(line, error=b'EXPECTED_CRLF\r\n')
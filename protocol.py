@@ -1,107 +1,528 @@
+from collections import OrderedDict
+import enum
 import heapq
+import time
 
-import trio
+from timers import Timers
 
 
+# Live tubes by name. A tube is dropped as soon as no client uses or
+# watches it and it holds no jobs, see release_tube().
 tubes = {}
+# Index of every live job by id so id-addressed commands don't walk the tubes
+jobs = {}
+# Last id handed out. Ids go up by id_step, so with several workers each
+# hands out its own ids and an id tells which worker holds the job.
 count_job = 0
+id_step = 1
+# TTRs, delays and reserve timeouts, driven by the server
+timers = Timers()
+# Set by the server when jobs are persisted, see binlog.py
+binlog = None
+# Set by the server when bodies past a memory budget are spilled, see store.py
+store = None
+# Set by the server when it serves metrics, see metrics.py
+metrics = None
 
 MAX_JOB_SIZE = 2 ** 16
+# Most buffers a single sendmsg() or writev() accepts on Linux
+IOV_MAX = 1024
+# A connection isn't read from while more than this many bytes of
+# replies to it wait to be sent, so a client that doesn't read can't
+# make them pile up
+MAX_UNSENT = 2 ** 20
+# A client's ready heap is rebuilt once it holds this many more entries
+# than it watches tubes, see push_ready()
+MAX_STALE_READY = 64
+# Ready jobs more urgent than this count as urgent in stats
+URGENT_PRIORITY = 1024
 
 
 class Client:
     def __init__(self, connection, address) -> None:
         self.address = address
+        # Put by reserve-batch while it waits, how many jobs it takes
+        self.batch = 0
         self.connection = connection
-        self.job = None
+        # Has sent a put, has sent a reserve, for stats
+        self.producer = False
+        # Set by wait_ready(), called once a job is ready on a watched tube
+        self.on_ready = None
+        # Jobs reserved by this client, by id
+        self.reserved = {}
+        # Set by the server's reader while a reserve waits, wakes it once
+        # the reserve is answered. Like beanstalkd, nothing sent after the
+        # reserve is read until then, so replies keep the order of the
+        # commands.
+        self.resume = None
+        # Set by the server's reader, called by its writer after a send
+        self.sent = None
+        # Bytes written and not sent yet, outgoing and the write in progress
+        self.unsent = 0
+        self.worker = False
+        # Replies not sent yet, in order. The server's writer sends them
+        # all at once, so replies to a pipelined batch share one write.
+        self.outgoing = []
+        # Heap of (priority, id, job) holding at least the most urgent
+        # ready job of each watched tube, so reserve takes the most urgent
+        # job across them all without looking at every tube. Entries go
+        # stale as those jobs are taken and are checked when popped. Only
+        # kept while watching several tubes, a single one is peeked.
+        self.ready = []
+        # Pending reserve-with-timeout
+        self.timer = None
         self.using = None
+        # True while blocked in `reserve` and queued on every watched tube
+        self.waiting = False
+        # Set by the server's writer, wakes it when there is output
+        self.wakeup = None
         self.watching = []
+        stats.connections += 1
+        stats.total_connections += 1
+
+    def write(self, *data: bytes) -> None:
+        # Buffers are kept as they are and sent with scatter/gather I/O
+        self.outgoing.extend(data)
+        self.unsent += sum(map(len, data))
+        if len(self.outgoing) == len(data) and self.wakeup is not None:
+            self.wakeup()
+
+
+class State(enum.IntEnum):
+    READY = 0
+    RESERVED = 1
+    DELAYED = 2
+    BURIED = 3
+    DELETED = 4
 
 
 class Job:
-    def __init__(self, body: str, priority: int, ttr: int) -> None:
+    # There can be tens of millions of jobs, keep them small
+    __slots__ = (
+        'body', 'buries', 'client', 'created', 'delay', 'id', 'kicks', 'priority', 'releases',
+        'reserved_at', 'reserves', 'state', 'timeouts', 'timer', 'tube', 'ttr',
+    )
+
+    def __init__(self, body: bytes, priority: int, ttr: int) -> None:
         self.client = None
         self.body = body
+        self.buries = 0
+        self.created = time.monotonic()
+        self.delay = 0
         self.id = None
+        self.kicks = 0
         self.priority = priority
-        self.state = 'ready'
+        self.releases = 0
+        # Only kept for metrics
+        self.reserved_at = None
+        self.reserves = 0
+        self.timeouts = 0
+        # None until the job is in a tube
+        self.state = None
+        # TTR while reserved, end of the delay while delayed
+        self.timer = None
+        # The Tube itself, not its name
+        self.tube = None
         self.ttr = ttr
 
     def __lt__(self, other):
-        return self.priority < other.priority
+        # Most urgent first, oldest first among equal priorities
+        if self.priority != other.priority:
+            return self.priority < other.priority
+        return self.id < other.id
+
+
+class Tube:
+    __slots__ = (
+        'buried', 'clients', 'counts', 'deletes', 'delayed', 'name', 'notify', 'pause', 'pause_timer',
+        'pauses', 'ready', 'ready_waiting', 'total_jobs', 'using', 'waiting',
+    )
+
+    def __init__(self, name: bytes) -> None:
+        # Buried jobs by id, oldest burial first
+        self.buried = OrderedDict()
+        # Clients watching it, as keys so one leaves in O(1)
+        self.clients = {}
+        # Jobs by state, see set_state()
+        self.counts = Counts()
+        self.deletes = 0
+        # Heap of (delay timer, job), soonest ready first. An entry is
+        # stale once the job's timer is another one, skipped lazily.
+        self.delayed = []
+        self.name = name
+        # Those clients that watch other tubes too, told of each new most
+        # urgent job through their ready heap. A put costs nothing per
+        # client watching just this tube.
+        self.notify = {}
+        # Seconds of the pause in progress, and the timer ending it. No
+        # jobs are handed out while paused.
+        self.pause = 0
+        self.pause_timer = None
+        self.pauses = 0
+        # Heap of ready jobs. Jobs leave it by being popped when reserved,
+        # anything else (delete) leaves a stale entry that is skipped lazily.
+        self.ready = []
+        # Clients to tell once a job is ready here, see wait_ready()
+        self.ready_waiting = {}
+        self.total_jobs = 0
+        # Clients using it
+        self.using = 0
+        # Clients blocked in `reserve`, longest waiting first
+        self.waiting = OrderedDict()
+
+
+class Counts:
+    # Jobs in each state, by State, and ready urgent jobs
+    __slots__ = ('jobs', 'urgent')
+
+    def __init__(self) -> None:
+        self.jobs = [0] * len(State)
+        self.urgent = 0
+
+
+class Stats:
+    # Server wide counters behind `stats`, all kept up to date as things
+    # happen so reading them costs the same whatever the load
+    def __init__(self) -> None:
+        self.commands = {}
+        self.connections = 0
+        self.counts = Counts()
+        self.job_timeouts = 0
+        self.producers = 0
+        self.started = time.monotonic()
+        self.total_connections = 0
+        self.total_jobs = 0
+        self.waiting = 0
+        self.workers = 0
+
+
+stats = Stats()
+
+
+def drop_sent(buffers: list, sent: int) -> None:
+    # After a scatter/gather write of buffers[:IOV_MAX], drop what was
+    # sent, keeping the unsent tail of a partial buffer
+    done = 0
+    for buffer in buffers:
+        size = len(buffer)
+        if sent < size:
+            break
+        sent -= size
+        done += 1
+    del buffers[:done]
+    if sent:
+        buffers[0] = memoryview(buffers[0])[sent:]
+
+
+def get_tube(name: bytes) -> Tube:
+    tube = tubes.get(name)
+    if tube is None:
+        tube = tubes[name] = Tube(name)
+    return tube
+
+
+def release_tube(tube: Tube) -> None:
+    # Called when a client stops using or watching the tube, or one of
+    # its jobs is deleted. Those are what keep it alive, counted by
+    # using, clients and counts, and while paused its timer.
+    if tube.using or tube.clients or tube.pause_timer is not None:
+        return
+    counts = tube.counts.jobs
+    if sum(counts) != counts[State.DELETED]:
+        return
+    if tubes.get(tube.name) is tube:
+        del tubes[tube.name]
+
+
+def set_state(job: Job, state: State) -> None:
+    # Every state change goes through here so the stats stay exact
+    urgent = job.priority < URGENT_PRIORITY
+    for counts in (job.tube.counts, stats.counts):
+        if job.state is not None:
+            counts.jobs[job.state] -= 1
+            if job.state == State.READY and urgent:
+                counts.urgent -= 1
+        counts.jobs[state] += 1
+        if state == State.READY and urgent:
+            counts.urgent += 1
+    job.state = state
+
+
+def make_ready(job: Job) -> None:
+    tube = job.tube
+    was_delayed = job.state == State.DELAYED
+    set_state(job, State.READY)
+    job.timer = None
+    if was_delayed:
+        trim_delayed(tube)
+    heapq.heappush(tube.ready, job)
+    if tube.waiting and tube.pause_timer is None:
+        get_job_with_client(tube)
+    # Only a new most urgent job of the tube is news to its watchers
+    if job.state == State.READY and peek_ready(tube) is job:
+        for client in tube.notify:
+            push_ready(client, job)
+    if job.state == State.READY and tube.ready_waiting and tube.pause_timer is None:
+        tell_ready(tube)
+
+
+def delay_job(job: Job, delay: float) -> None:
+    set_state(job, State.DELAYED)
+    job.delay = delay
+    job.timer = timers.schedule(delay, make_ready, job)
+    heapq.heappush(job.tube.delayed, (job.timer, job))
+
+
+def peek_delayed(tube: Tube) -> Job | None:
+    delayed = tube.delayed
+    while delayed and delayed[0][1].timer is not delayed[0][0]:
+        heapq.heappop(delayed)
+    if delayed:
+        return delayed[0][1]
+    return None
+
+
+def trim_delayed(tube: Tube) -> None:
+    # Called as a delayed job leaves the state. They mostly leave in
+    # order, from the top, otherwise rebuild once stale entries pile up.
+    peek_delayed(tube)
+    if len(tube.delayed) > 2 * tube.counts.jobs[State.DELAYED] + 64:
+        tube.delayed = [entry for entry in tube.delayed if entry[1].timer is entry[0]]
+        heapq.heapify(tube.delayed)
+
+
+def peek_buried(tube: Tube) -> Job | None:
+    return next(iter(tube.buried.values()), None)
+
+
+def peek_ready(tube: Tube) -> Job | None:
+    ready = tube.ready
+    while ready and ready[0].state != State.READY:
+        heapq.heappop(ready)
+    if ready:
+        return ready[0]
+    return None
+
+
+def pop_ready(tube: Tube) -> Job | None:
+    job = peek_ready(tube)
+    if job is not None:
+        heapq.heappop(tube.ready)
+    return job
+
+
+def push_ready(client: Client, job: Job) -> None:
+    ready = client.ready
+    heapq.heappush(ready, (job.priority, job.id, job))
+    if len(ready) > len(client.watching) + MAX_STALE_READY:
+        rebuild_ready(client)
+
+
+def rebuild_ready(client: Client) -> None:
+    # Just the most urgent ready job of each watched tube
+    ready = []
+    for name in client.watching:
+        job = peek_ready(tubes[name])
+        if job is not None:
+            ready.append((job.priority, job.id, job))
+    heapq.heapify(ready)
+    client.ready = ready
 
 
 def delete_job(job: Job) -> None:
-    job_id = job.id
-    print('job_id', job_id)
-    for tube in tubes:
-        for idx, (_, j) in enumerate(tubes[tube]['jobs']):
-            if j.id == job_id:
-                try:
-                    j.client.job = None
-                except AttributeError:
-                    # tubes[tube]['jobs'][job_id].client is None
-                    pass
-                j.client = None
-                del tubes[tube]['jobs'][idx]
-                return
+    if job.client is not None:
+        del job.client.reserved[job.id]
+        job.client = None
+    timers.cancel(job.timer)
+    job.timer = None
+    tube = job.tube
+    if metrics is not None and job.state == State.RESERVED:
+        metrics.processing.observe(time.monotonic() - job.reserved_at)
+    was = job.state
+    set_state(job, State.DELETED)
+    tube.deletes += 1
+    if was == State.READY and len(tube.ready) > 2 * tube.counts.jobs[State.READY] + 64:
+        # Too many stale entries, rebuild without them
+        tube.ready = [j for j in tube.ready if j.state == State.READY]
+        heapq.heapify(tube.ready)
+    elif was == State.DELAYED:
+        trim_delayed(tube)
+    elif was == State.BURIED:
+        del tube.buried[job.id]
+    del jobs[job.id]
+    if store is not None:
+        store.forget(job.body)
+    if binlog is not None:
+        binlog.delete(job)
+    release_tube(tube)
 
 
 def get_job_by_id(job_id: int) -> Job | None:
-    for tube in tubes:
-        for _, job in tubes[tube]['jobs']:
-            if job.id == job_id:
-                return job
+    return jobs.get(job_id)
 
 
-def get_job_with_client(tube: str) -> Job | None:
-    job = None
-    for _, j in tubes[tube]['jobs']:
-        if j.state == 'ready':
-            job = j
+def issue_job(job: Job) -> None:
+    # The body is sent from the stored buffer, never copied into a frame.
+    # The header is built here rather than kept on every job.
+    job.client.write(b'RESERVED %d %d\r\n' % (job.id, len(job.body)), job.body, b'\r\n')
 
-    if job is None:
-        return None
 
-    client = None
-    for c in tubes[tube]['clients']:
-        if c.job is None:
-            client = c
+def reserve_job(job: Job, client: Client) -> None:
+    set_state(job, State.RESERVED)
+    if metrics is not None:
+        job.reserved_at = time.monotonic()
+        if not job.reserves:
+            metrics.queue_wait.observe(job.reserved_at - job.created)
+    job.client = client
+    job.reserves += 1
+    job.timer = timers.schedule(job.ttr, deadline_soon, job)
+    client.reserved[job.id] = job
+    issue_job(job)
 
-    if client is None:
-        return None
 
-    try:
-        job.client = client
-        client.job = job
-    except Exception:
-        job.client = None
-        client.job = None
-        return None
+def touch_job(job: Job) -> None:
+    # `touch`, the TTR of a reserved job starts over
+    if job.timer.callback is deadline_soon:
+        job.timer = timers.postpone(job.timer, job.ttr)
     else:
-        return job
+        # DEADLINE_SOON was sent, the next notice is one again
+        timers.cancel(job.timer)
+        job.timer = timers.schedule(job.ttr, deadline_soon, job)
 
 
-def ensure_tube_has_client(tube: str, client: Client) -> None:
-    if tube not in tubes:
-        tubes[tube] = {'clients': [client], 'jobs': []}
-    else:
-        current_clients = tubes[tube]['clients']
-        clients_without_new_address = [
-            c for c in current_clients if c.address != client.address
-        ]
-        tubes[tube]['clients'] = [*clients_without_new_address, client]
+def deadline_soon(job: Job) -> None:
+    job.client.write(b'DEADLINE_SOON\r\n')
+    job.timer = timers.schedule(1, job_timed_out, job)
+
+
+def job_timed_out(job: Job) -> None:
+    job.client.write(b'TIMED_OUT\r\n')
+    job.timeouts += 1
+    stats.job_timeouts += 1
+    release_job(job)
+    make_ready(job)
+
+
+def wait_for_job(client: Client, timeout: int | None = None) -> None:
+    if not client.waiting:
+        stats.waiting += 1
+    client.waiting = True
+    for tube in client.watching:
+        tubes[tube].waiting[client] = None
+    if timeout is not None:
+        timers.cancel(client.timer)
+        client.timer = timers.schedule(timeout, reserve_timed_out, client)
+
+
+def stop_waiting(client: Client) -> None:
+    if not client.waiting:
+        return
+    client.waiting = False
+    client.batch = 0
+    stats.waiting -= 1
+    timers.cancel(client.timer)
+    client.timer = None
+    for tube in client.watching:
+        tubes[tube].waiting.pop(client, None)
+    if client.resume is not None:
+        client.resume()
+
+
+def wait_ready(client: Client, callback) -> None:
+    # Call callback once a job is ready on a watched tube, right away if
+    # one already is. Nothing is reserved, see cluster.Router.reserve().
+    if peek_watched(client) is not None:
+        callback()
+        return
+    client.on_ready = callback
+    for tube in client.watching:
+        tubes[tube].ready_waiting[client] = None
+
+
+def stop_waiting_ready(client: Client) -> None:
+    if client.on_ready is None:
+        return
+    client.on_ready = None
+    for tube in client.watching:
+        tubes[tube].ready_waiting.pop(client, None)
+
+
+def tell_ready(tube: Tube) -> None:
+    for client in list(tube.ready_waiting):
+        callback = client.on_ready
+        stop_waiting_ready(client)
+        callback()
+
 
+def reserve_timed_out(client: Client) -> None:
+    stop_waiting(client)
+    client.write(b'TIMED_OUT\r\n')
+
+
+def get_job_with_client(tube: Tube) -> Job | None:
+    # Hand the next ready job to the longest waiting reserver
+    if not tube.waiting:
+        return None
+    job = pop_ready(tube)
+    if job is None:
+        return None
 
-def ensure_tube_without_client(tube: str, client: Client) -> None:
+    client = next(iter(tube.waiting))
+    if client.batch:
+        reserve_batch(client, client.batch, job)
+    else:
+        stop_waiting(client)
+        reserve_job(job, client)
+    return job
+
+
+def use_tube(client: Client, tube: bytes | None) -> None:
+    # None when the tube is another worker's, see cluster.Router
+    if tube is not None:
+        get_tube(tube).using += 1
+    if client.using is not None:
+        used = tubes[client.using]
+        used.using -= 1
+        release_tube(used)
+    client.using = tube
+
+
+def ensure_tube_has_client(tube: bytes, client: Client) -> None:
+    tube = get_tube(tube)
+    tube.clients[client] = None
+    if client.waiting:
+        tube.waiting[client] = None
+    if client.on_ready is not None:
+        tube.ready_waiting[client] = None
+    if len(client.watching) == 2:
+        # Watching several tubes from now on, start a ready heap
+        for name in client.watching:
+            tubes[name].notify[client] = None
+        rebuild_ready(client)
+    elif len(client.watching) > 2:
+        tube.notify[client] = None
+        job = peek_ready(tube)
+        if job is not None:
+            push_ready(client, job)
+
+
+def ensure_tube_without_client(tube: bytes, client: Client) -> None:
     if tube not in tubes:
         return
-    
-    current_clients = tubes[tube]['clients']
-    clients_without_new_address = [
-        c for c in current_clients if c.address != client.address
-    ]
-    tubes[tube]['clients'] = clients_without_new_address
+
+    tube = tubes[tube]
+    tube.clients.pop(client, None)
+    tube.notify.pop(client, None)
+    tube.waiting.pop(client, None)
+    tube.ready_waiting.pop(client, None)
+    if len(client.watching) < 2:
+        # Back to peeking the one tube left, if any
+        for name in client.watching:
+            tubes[name].notify.pop(client, None)
+        client.ready = []
+    else:
+        rebuild_ready(client)
+    release_tube(tube)
 
 
 class QuitMessage(Exception):
@@ -109,123 +530,242 @@ class QuitMessage(Exception):
 
 
 def drop_connection(client: Client) -> None:
+    stats.connections -= 1
+    if client.producer:
+        stats.producers -= 1
+    if client.worker:
+        stats.workers -= 1
+    if client.using is not None:
+        tubes[client.using].using -= 1
     # Remove client from tubes
+    stop_waiting(client)
+    stop_waiting_ready(client)
     for tube in client.watching:
-        tubes[tube]['clients'] = [
-            c for c in tubes[tube]['clients']
-            if c.address != client.address
-        ]
-    if client.job:
-        client.job.client = None
-        client.job = None
+        tubes[tube].clients.pop(client, None)
+        tubes[tube].notify.pop(client, None)
+    # Jobs it held go back to ready now, straight to any waiting reserver,
+    # rather than waiting out their TTR. The client no longer waits, so
+    # none of them comes back to it.
+    held = list(client.reserved.values())
+    client.reserved.clear()
+    for job in held:
+        timers.cancel(job.timer)
+        job.timer = None
+        job.client = None
+        make_ready(job)
+    # Then tubes only it kept alive go
+    for name in (client.using, *client.watching):
+        tube = tubes.get(name)
+        if tube is not None:
+            release_tube(tube)
+
 
+def add_job(tube: bytes, job: Job, delay: int = 0) -> int:
+    return add_jobs(tube, [(job, delay)])[0]
 
-def add_job(tube: str, job: Job) -> int:
+
+def add_jobs(tube: bytes, batch: list) -> list:
+    # Insert (job, delay) pairs, returns their ids
     global count_job
-    count_job += 1
-    job.id = count_job
-    if tube not in tubes:
-        tubes[tube] = {'clients': [], 'jobs': []}
-    heapq.heappush(tubes[tube]['jobs'], (job.priority, job))
-    return job.id
-
-
-def ignore_message(message):
-    if len(message) < 3:
-        return False
-    # Get the message until the first space
-    # If valid message_start will be the command or the first part of a command
-    message_start = message.strip()[:message.find(b' ')]
-
-    # Ensure that the message starts with one of the commands
-    commands = (
-        b'bury',
-        b'delete',
-        b'ignore',
-        b'kick',
-        b'kick-job',
-        b'list-tubes',
-        b'list-tubes-used',
-        b'list-tubes-watched',
-        b'pause-tube',
-        b'peek',
-        b'peek-buried',
-        b'peek-delayed',
-        b'peek-ready',
-        b'put',
-        b'quit',
-        b'release',
-        b'reserve',
-        b'reserve-job',
-        b'reserve-with-timeout',
-        b'stats-job',
-        b'stats-tube',
-        b'stats',
-        b'touch',
-        b'use',
-        b'watch',
-    )
-    for command in commands:
-        if command.startswith(message_start):
-            return False
+    first = count_job + id_step
+    count_job += id_step * len(batch)
+    ids = range(first, count_job + 1, id_step)
+    for job_id, (job, delay) in zip(ids, batch):
+        job.id = job_id
+        insert_job(tube, job, delay)
+        if binlog is not None:
+            binlog.put(job, delay)
+    job.tube.total_jobs += len(batch)
+    stats.total_jobs += len(batch)
+    return ids
+
+
+def insert_job(tube: bytes, job: Job, delay: float = 0, buried: bool = False) -> None:
+    if store is not None:
+        job.body = store.keep(job.body)
+    job.tube = get_tube(tube)
+    jobs[job.id] = job
+    if buried:
+        add_buried(job)
+    elif delay:
+        delay_job(job, delay)
     else:
-        return True
+        make_ready(job)
 
 
-async def try_to_issue_job(tube: str, issue_job) -> Client | None:
-    job = get_job_with_client(tube)
-    if not job:
+def next_ready_job(client: Client) -> Job | None:
+    # Take the most urgent ready job on the watched tubes off its heap
+    if len(client.watching) < 2:
+        # No heap for a single tube, its top is the job
+        for name in client.watching:
+            tube = tubes[name]
+            if tube.pause_timer is None:
+                return pop_ready(tube)
         return None
+    ready = client.ready
+    while ready:
+        priority, _, job = heapq.heappop(ready)
+        tube = job.tube
+        if tube.pause_timer is not None:
+            # Dropped, unpause_tube() gives watchers the tube's top again
+            continue
+        top = peek_ready(tube)
+        if top is job and job.priority == priority:
+            heapq.heappop(tube.ready)
+            top = peek_ready(tube)
+            if top is not None:
+                heapq.heappush(ready, (top.priority, top.id, top))
+            return job
+        # Stale, the tube's most urgent job now stands in for it
+        if top is not None:
+            heapq.heappush(ready, (top.priority, top.id, top))
+    return None
+
+
+def peek_watched(client: Client) -> Job | None:
+    # The job next_ready_job() would take, left where it is
+    best = None
+    for name in client.watching:
+        tube = tubes[name]
+        if tube.pause_timer is None:
+            job = peek_ready(tube)
+            if job is not None and (best is None or job < best):
+                best = job
+    return best
+
+
+def reserve_ready_job(client: Client) -> Job | None:
+    # Reserve the first ready job on the watched tubes, without waiting
+    job = next_ready_job(client)
+    if job is not None:
+        stop_waiting(client)
+        reserve_job(job, client)
+    return job
+
+
+def reserve_batch(client: Client, count: int, first: Job | None = None) -> int:
+    # Reserve up to count ready jobs in one reply, returns how many
+    batch = [] if first is None else [first]
+    while len(batch) < count:
+        job = next_ready_job(client)
+        if job is None:
+            break
+        batch.append(job)
+    if batch:
+        stop_waiting(client)
+        client.write(b'RESERVED-BATCH %d\r\n' % len(batch))
+        for job in batch:
+            reserve_job(job, client)
+    return len(batch)
+
 
-    client = job.client
-    success = await issue_job(job)
-    if success:
-        job.state = 'reserved'
-        return client
+def try_to_reserve_batch(client: Client, count: int, timeout: int) -> None:
+    if reserve_batch(client, count):
+        return
+    if timeout == 0:
+        client.write(b'TIMED_OUT\r\n')
+        return
+    wait_for_job(client, timeout)
+    client.batch = count
+
+
+def try_to_issue_job_to_client(client: Client, timeout: int | None = None) -> Job | None:
+    job = reserve_ready_job(client)
+    if job is not None:
+        return job
+    if timeout == 0:
+        stop_waiting(client)
+        client.write(b'TIMED_OUT\r\n')
     else:
-        try:
-            job.client.job = None
-        except AttributeError:
-            pass
-        job.client = None
-        job.state = 'ready'
-        return None
+        wait_for_job(client, timeout)
+    return None
 
 
-async def check_job_ttr(job: Job) -> None:
-    await trio.sleep(job.ttr)
-    if job.client:
-        # job is current reserved by client
-        try:
-            await job.client.connection.send_all(b'DEADLINE_SOON\r\n')
-            await trio.sleep(1)
-            await job.client.connection.send_all(b'TIMED_OUT\r\n')
-        except (AttributeError, trio.ClosedResourceError):
-            # job.client.connection is None
-            pass
-        else:
-            release_job(job)
-            job.state = 'ready'
+def release_job(job: Job) -> None:
+    timers.cancel(job.timer)
+    job.timer = None
+    if job.client is not None:
+        del job.client.reserved[job.id]
+    job.client = None
 
 
-async def try_to_issue_job_to_client(client: Client, issue_job, nursery, job_given: trio.Event = None) -> None:
-    for tube in client.watching:
-        job_client = await try_to_issue_job(tube, issue_job)
-        if isinstance(job_client, Client) and job_client == client:
-            if job_given:
-                # Used by reserve_with_timeout
-                job_given.set()
+def requeue_job(job: Job, priority: int, delay: int) -> None:
+    # `release` of a reserved job
+    job.priority = priority
+    job.releases += 1
+    release_job(job)
+    if delay:
+        delay_job(job, delay)
+    else:
+        make_ready(job)
+    if binlog is not None:
+        binlog.release(job, delay)
+
+
+def add_buried(job: Job) -> None:
+    set_state(job, State.BURIED)
+    job.tube.buried[job.id] = job
+
+
+def bury_job(job: Job, priority: int) -> None:
+    # `bury` of a reserved job, it stays until kicked or deleted
+    job.priority = priority
+    job.buries += 1
+    release_job(job)
+    add_buried(job)
+    if binlog is not None:
+        binlog.bury(job)
+
+
+def kick_job(job: Job) -> None:
+    # A buried or delayed job made ready
+    if job.state == State.BURIED:
+        del job.tube.buried[job.id]
+    else:
+        timers.cancel(job.timer)
+    job.kicks += 1
+    make_ready(job)
+    if binlog is not None:
+        binlog.kick(job)
+
+
+def kick_jobs(tube: Tube, bound: int) -> int:
+    # Up to bound buried jobs, oldest burial first, or if there are none
+    # delayed jobs, soonest ready first. Returns how many were kicked.
+    kicked = 0
+    peek = peek_buried if tube.buried else peek_delayed
+    while kicked < bound:
+        job = peek(tube)
+        if job is None:
             break
-    try:
-        nursery.start_soon(check_job_ttr, job_client.job)
-    except AttributeError:
-        # job_client.job is None
-        pass
+        kick_job(job)
+        kicked += 1
+    return kicked
+
+
+def pause_tube(tube: Tube, delay: int) -> None:
+    # `pause-tube`, a later one replaces the pause in progress
+    tube.pause = delay
+    tube.pauses += 1
+    timers.cancel(tube.pause_timer)
+    tube.pause_timer = None
+    if delay:
+        tube.pause_timer = timers.schedule(delay, unpause_tube, tube)
+    else:
+        unpause_tube(tube)
 
 
-def release_job(job: Job):
-    try:
-        job.client.job = None
-    except AttributeError:
+def unpause_tube(tube: Tube) -> None:
+    # Whoever waited out the pause is served in one go, longest waiting
+    # first, then watchers see the tube's most urgent job again
+    tube.pause = 0
+    tube.pause_timer = None
+    while tube.waiting and get_job_with_client(tube) is not None:
         pass
-    job.client = None
+    job = peek_ready(tube)
+    if job is not None:
+        for client in tube.notify:
+            push_ready(client, job)
+        if tube.ready_waiting:
+            tell_ready(tube)
+    release_tube(tube)
@@ -0,0 +1,72 @@
+import ctypes
+import mmap
+import os
+import tempfile
+import weakref
+
+
+# The arena grows by this much at a time, each slab holds chunks of one size
+SLAB_SIZE = 2 ** 22
+# Smallest chunk, bodies are rounded up to a power of two at least this big
+MIN_CHUNK_SIZE = 64
+
+
+def chunk_size(size: int) -> int:
+    return 1 << max(size - 1, MIN_CHUNK_SIZE - 1).bit_length()
+
+
+class BodyStore:
+    # Keeps job bodies in memory up to a budget and spills the rest into
+    # an mmap-backed arena file, so resident memory is bounded by the
+    # budget rather than by the backlog. A spilled body is a ctypes array
+    # over its chunk: it is sent and logged like any other buffer, zero
+    # copy, and its chunk is reused only once nothing refers to it, not
+    # even a reply or binlog record that hasn't been written yet.
+    def __init__(self, directory: str, budget: int) -> None:
+        self.budget = budget
+        # Unlinked right away, bodies are only kept across restarts by the binlog
+        self.file = tempfile.TemporaryFile(dir=directory)
+        self.size = 0
+        # Free chunks as (slab, offset) by chunk size
+        self.free = {}
+        # Bytes of bodies kept in memory, and of chunks in use
+        self.resident = 0
+        self.spilled = 0
+
+    def keep(self, body: bytes) -> bytes:
+        # Returns what the job should hold as its body
+        size = len(body)
+        if not size or self.resident + size <= self.budget:
+            self.resident += size
+            return body
+        return self.spill(body)
+
+    def forget(self, body: bytes) -> None:
+        # The job holding this body is gone
+        if not isinstance(body, ctypes.Array):
+            self.resident -= len(body)
+
+    def spill(self, body: bytes) -> ctypes.Array:
+        size = len(body)
+        chunk = chunk_size(size)
+        free = self.free.get(chunk)
+        if not free:
+            free = self.free[chunk] = self.grow(chunk)
+        slab, offset = free.pop()
+        slab[offset:offset + size] = body
+        spilled = (ctypes.c_char * size).from_buffer(slab, offset)
+        weakref.finalize(spilled, self.reclaim, chunk, slab, offset).atexit = False
+        self.spilled += chunk
+        return spilled
+
+    def reclaim(self, chunk: int, slab: mmap.mmap, offset: int) -> None:
+        self.free[chunk].append((slab, offset))
+        self.spilled -= chunk
+
+    def grow(self, chunk: int) -> list:
+        offset = self.size
+        self.size += SLAB_SIZE
+        os.ftruncate(self.file.fileno(), self.size)
+        slab = mmap.mmap(self.file.fileno(), SLAB_SIZE, offset=offset)
+        # Popped from the end, so lower offsets are used first
+        return [(slab, start) for start in range(SLAB_SIZE - chunk, -1, -chunk)]
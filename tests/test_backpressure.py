@@ -0,0 +1,43 @@
+import socket
+import time
+
+from utils import read_yaml, receive_data
+
+
+PEEKS = 300
+
+
+def test_backpressure(server, client2: socket.socket) -> None:
+    # A small receive buffer, so replies back up quickly
+    client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    client.connect(('localhost', 10_000))
+    body = b'x' * 60_000
+    client.sendall(b'use test_backpressure\r\nput 0 0 10 60000\r\n' + body + b'\r\n')
+    data = receive_data(client, len(b'USING test_backpressure\r\nINSERTED X\r\n'))
+    while not data.endswith(b'\r\n'):
+        data += receive_data(client, 1)
+    job_id = data.rsplit(b' ', 1)[1].strip()
+    client2.sendall(b'stats\r\n')
+    before = int(read_yaml(client2)['cmd-peek'])
+
+    # Each in a read of its own, about 18 MB of replies not read
+    for _ in range(PEEKS):
+        client.sendall(b'peek %s\r\n' % job_id)
+        time.sleep(0.002)
+    time.sleep(0.3)
+    client2.sendall(b'stats\r\n')
+    assert int(read_yaml(client2)['cmd-peek']) - before < PEEKS
+
+    # All answered once the client reads
+    reply = b'FOUND %s 60000\r\n%s\r\n' % (job_id, body)
+    client.settimeout(3)
+    replies = bytearray()
+    while len(replies) < len(reply) * PEEKS:
+        data = client.recv(2 ** 20)
+        assert data
+        replies += data
+    assert replies == reply * PEEKS
+    client2.sendall(b'stats\r\n')
+    assert int(read_yaml(client2)['cmd-peek']) - before == PEEKS
+    client.close()
@@ -0,0 +1,164 @@
+import pathlib
+import subprocess
+import time
+
+from utils import connect, receive_data, start_server
+
+
+PORT = 10_001
+
+
+def start_binlog_server(binlog_dir: pathlib.Path, *args: str) -> subprocess.Popen:
+    return start_server(PORT, '--binlog-dir', str(binlog_dir), *args)
+
+
+def snapshot_committed(names: list) -> bool:
+    # The newest file is a snapshot and nothing older than it is left
+    if not names[-1].startswith('snapshot.') or 'snapshot.tmp' in names:
+        return False
+    first = int(names[-1].split('.')[1])
+    return all(int(name.split('.')[1]) >= first for name in names)
+
+
+def test_binlog_restart(tmp_path: pathlib.Path) -> None:
+    server = start_binlog_server(tmp_path)
+    try:
+        client = connect(PORT)
+        client.sendall(b'use test_binlog\r\n')
+        receive_data(client, len(b'USING test_binlog\r\n'))
+        client.sendall(b'put 10 0 10 4\r\nkept\r\nput 5 0 10 7\r\ndeleted\r\n')
+        expected = b'INSERTED 1\r\nINSERTED 2\r\n'
+        assert receive_data(client, len(expected)) == expected
+        client.sendall(b'delete 2\r\n')
+        assert receive_data(client, len(b'DELETED\r\n')) == b'DELETED\r\n'
+        client.close()
+    finally:
+        server.terminate()
+        server.wait()
+
+    server = start_binlog_server(tmp_path)
+    try:
+        client = connect(PORT)
+        client.sendall(b'watch test_binlog\r\nreserve\r\n')
+        expected = b'WATCHING 1\r\nRESERVED 1 4\r\nkept\r\n'
+        assert receive_data(client, len(expected)) == expected
+
+        # Ids keep counting from the restored jobs
+        client.sendall(b'use test_binlog\r\nput 0 0 10 3\r\nnew\r\n')
+        expected = b'USING test_binlog\r\nINSERTED 3\r\n'
+        assert receive_data(client, len(expected)) == expected
+        client.close()
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def test_binlog_snapshot(tmp_path: pathlib.Path) -> None:
+    # Tiny segments so a snapshot is taken after a few puts
+    server = start_binlog_server(tmp_path, '--binlog-size', '256')
+    try:
+        client = connect(PORT)
+        client.sendall(b'use test_binlog\r\n')
+        receive_data(client, len(b'USING test_binlog\r\n'))
+        for job_id in range(1, 51):
+            client.sendall(b'put 0 0 10 3\r\njob\r\n')
+            expected = b'INSERTED %d\r\n' % job_id
+            assert receive_data(client, len(expected)) == expected
+            if job_id != 50:
+                client.sendall(b'delete %d\r\n' % job_id)
+                assert receive_data(client, len(b'DELETED\r\n')) == b'DELETED\r\n'
+        # Snapshots are taken in the background, wait until one is
+        # committed and the segments it covers are gone
+        for _ in range(300):
+            names = sorted(path.name for path in tmp_path.iterdir())
+            if snapshot_committed(names):
+                break
+            time.sleep(0.01)
+        client.close()
+    finally:
+        server.terminate()
+        server.wait()
+    assert snapshot_committed(names)
+
+    server = start_binlog_server(tmp_path)
+    try:
+        client = connect(PORT)
+        client.sendall(b'watch test_binlog\r\nreserve-with-timeout 0\r\n')
+        expected = b'WATCHING 1\r\nRESERVED 50 3\r\njob\r\n'
+        assert receive_data(client, len(expected)) == expected
+        client.sendall(b'reserve-with-timeout 0\r\n')
+        assert receive_data(client, len(b'TIMED_OUT\r\n')) == b'TIMED_OUT\r\n'
+        client.close()
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def test_binlog_buried(tmp_path: pathlib.Path) -> None:
+    server = start_binlog_server(tmp_path)
+    try:
+        client = connect(PORT)
+        client.sendall(b'use test_binlog\r\nwatch test_binlog\r\n')
+        expected = b'USING test_binlog\r\nWATCHING 1\r\n'
+        assert receive_data(client, len(expected)) == expected
+        for job_id in range(1, 4):
+            client.sendall(b'put 0 0 10 3\r\njob\r\nreserve\r\n')
+            expected = b'INSERTED %d\r\nRESERVED %d 3\r\njob\r\n' % (job_id, job_id)
+            assert receive_data(client, len(expected)) == expected
+        # Buried in the order 3, 1, 2 and 2 kicked again
+        for job_id in (3, 1, 2):
+            client.sendall(b'bury %d 7\r\n' % job_id)
+            assert receive_data(client, len(b'BURIED\r\n')) == b'BURIED\r\n'
+        client.sendall(b'kick-job 2\r\n')
+        assert receive_data(client, len(b'KICKED\r\n')) == b'KICKED\r\n'
+        client.close()
+    finally:
+        server.terminate()
+        server.wait()
+
+    server = start_binlog_server(tmp_path)
+    try:
+        client = connect(PORT)
+        client.sendall(b'use test_binlog\r\npeek-buried\r\n')
+        expected = b'USING test_binlog\r\nFOUND 3 3\r\njob\r\n'
+        assert receive_data(client, len(expected)) == expected
+        client.sendall(b'kick 1\r\npeek-buried\r\n')
+        expected = b'KICKED 1\r\nFOUND 1 3\r\njob\r\n'
+        assert receive_data(client, len(expected)) == expected
+        client.sendall(b'peek-ready\r\n')
+        expected = b'FOUND 2 3\r\njob\r\n'
+        assert receive_data(client, len(expected)) == expected
+        client.close()
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def test_binlog_out_of_range(tmp_path: pathlib.Path) -> None:
+    # Values the binlog can't pack are rejected before anything changes
+    server = start_binlog_server(tmp_path)
+    try:
+        client = connect(PORT)
+        client.sendall(b'use test_binlog\r\nwatch test_binlog\r\n')
+        expected = b'USING test_binlog\r\nWATCHING 1\r\n'
+        assert receive_data(client, len(expected)) == expected
+        for args in (b'4294967296 0 10', b'0 4294967296 10', b'0 0 4294967296'):
+            client.sendall(b'put %s 3\r\njob\r\n' % args)
+            assert receive_data(client, len(b'BAD_FORMAT\r\n')) == b'BAD_FORMAT\r\n'
+        client.sendall(b'put-batch 1\r\n4294967296 0 10 3\r\njob\r\n')
+        assert receive_data(client, len(b'BAD_FORMAT\r\n')) == b'BAD_FORMAT\r\n'
+        client.sendall(b'peek-ready\r\n')
+        assert receive_data(client, len(b'NOT_FOUND\r\n')) == b'NOT_FOUND\r\n'
+
+        client.sendall(b'put 4294967295 0 10 3\r\njob\r\nreserve\r\n')
+        expected = b'INSERTED 1\r\nRESERVED 1 3\r\njob\r\n'
+        assert receive_data(client, len(expected)) == expected
+        for command in (b'release 1 4294967296 0', b'release 1 0 4294967296', b'bury 1 4294967296'):
+            client.sendall(command + b'\r\n')
+            assert receive_data(client, len(b'BAD_FORMAT\r\n')) == b'BAD_FORMAT\r\n'
+        client.sendall(b'release 1 4294967295 0\r\n')
+        assert receive_data(client, len(b'RELEASED\r\n')) == b'RELEASED\r\n'
+        client.close()
+    finally:
+        server.terminate()
+        server.wait()
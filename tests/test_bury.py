@@ -0,0 +1,45 @@
+import socket
+
+from utils import read_yaml, receive_data
+
+
+def put_and_reserve(client: socket.socket, tube: bytes, job_body: bytes) -> bytes:
+    client.sendall(b'use %s\r\nwatch %s\r\n' % (tube, tube))
+    expected = b'USING %s\r\nWATCHING 1\r\n' % tube
+    assert receive_data(client, len(expected)) == expected
+    client.sendall(b'put 10 0 10 %d\r\n%s\r\n' % (len(job_body), job_body))
+    data = receive_data(client, len(b'INSERTED X\r\n'))
+    while not data.endswith(b'\r\n'):
+        data += receive_data(client, 1)
+    job_id = data.replace(b'INSERTED ', b'').strip()
+    client.sendall(b'reserve\r\n')
+    expected = b'RESERVED %s %d\r\n%s\r\n' % (job_id, len(job_body), job_body)
+    assert receive_data(client, len(expected)) == expected
+    return job_id
+
+
+def test_bury(client: socket.socket) -> None:
+    job_id = put_and_reserve(client, b'test_bury', b'poison')
+    client.sendall(b'bury ' + job_id + b' 20\r\n')
+    assert receive_data(client, len(b'BURIED\r\n')) == b'BURIED\r\n'
+
+    # Not handed out again until kicked
+    client.sendall(b'reserve-with-timeout 0\r\n')
+    assert receive_data(client, len(b'TIMED_OUT\r\n')) == b'TIMED_OUT\r\n'
+    client.sendall(b'stats-job ' + job_id + b'\r\n')
+    job = read_yaml(client)
+    assert job['state'] == 'buried'
+    assert job['pri'] == '20'
+    assert job['buries'] == '1'
+
+    client.sendall(b'delete ' + job_id + b'\r\n')
+    assert receive_data(client, len(b'DELETED\r\n')) == b'DELETED\r\n'
+
+
+def test_bury_not_reserved(client: socket.socket, client2: socket.socket) -> None:
+    job_id = put_and_reserve(client, b'test_bury_not_reserved', b'mine')
+    client2.sendall(b'bury ' + job_id + b' 0\r\nbury 999999 0\r\n')
+    expected = b'NOT_FOUND\r\nNOT_FOUND\r\n'
+    assert receive_data(client2, len(expected)) == expected
+    client.sendall(b'delete ' + job_id + b'\r\n')
+    assert receive_data(client, len(b'DELETED\r\n')) == b'DELETED\r\n'
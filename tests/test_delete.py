@@ -147,15 +147,16 @@ def test_delete_after_ttr(
 
     time.sleep(ttr)
 
-    message = b'delete <id>\r\n'
-    message = message.replace(b'<id>', job_id)
-    client2.sendall(message)
-
+    # Read it before deleting, so the two replies are not read as one
     expected = b'DEADLINE_SOON\r\n'
     amount_expected = len(expected)
     data = receive_data(client2, amount_expected)
     assert data == expected
 
+    message = b'delete <id>\r\n'
+    message = message.replace(b'<id>', job_id)
+    client2.sendall(message)
+
     expected = b'DELETED\r\n'
     amount_expected = len(expected)
     data = receive_data(client2, amount_expected)
@@ -0,0 +1,53 @@
+import socket
+import time
+
+from utils import read_list, receive_data, wait_for_waiting
+
+
+def test_disconnect_requeues_reserved(
+    client: socket.socket, client2: socket.socket, client3: socket.socket,
+) -> None:
+    client.sendall(b'use test_disconnect\r\n')
+    receive_data(client, len(b'USING test_disconnect\r\n'))
+    ids = []
+    for body in (b'one', b'two'):
+        client.sendall(b'put 0 0 100 3\r\n' + body + b'\r\n')
+        reply = receive_data(client, len(b'INSERTED X\r\n'))
+        ids.append(int(reply.split()[1]))
+
+    client3.sendall(b'watch test_disconnect\r\nreserve\r\nreserve\r\n')
+    expected = b'WATCHING 1\r\nRESERVED %d 3\r\none\r\nRESERVED %d 3\r\ntwo\r\n' % tuple(ids)
+    assert receive_data(client3, len(expected)) == expected
+
+    client2.sendall(b'watch test_disconnect\r\nreserve\r\n')
+    assert receive_data(client2, len(b'WATCHING 1\r\n')) == b'WATCHING 1\r\n'
+    wait_for_waiting(client, b'test_disconnect', 1)
+
+    # Long before their TTR of 100 seconds, the waiting reserver gets the
+    # jobs the closed connection held
+    client3.close()
+    expected = b'RESERVED %d 3\r\none\r\n' % ids[0]
+    assert receive_data(client2, len(expected)) == expected
+    client2.sendall(b'reserve-with-timeout 0\r\n')
+    expected = b'RESERVED %d 3\r\ntwo\r\n' % ids[1]
+    assert receive_data(client2, len(expected)) == expected
+    for job_id in ids:
+        client2.sendall(b'delete %d\r\n' % job_id)
+        assert receive_data(client2, len(b'DELETED\r\n')) == b'DELETED\r\n'
+
+
+def test_disconnect_while_waiting(client: socket.socket, client2: socket.socket) -> None:
+    # Nothing is read from a client blocked in reserve, but its close
+    # is still noticed
+    client2.sendall(b'watch test_disconnect_waiting\r\nreserve\r\n')
+    assert receive_data(client2, len(b'WATCHING 1\r\n')) == b'WATCHING 1\r\n'
+    wait_for_waiting(client, b'test_disconnect_waiting', 1)
+    client2.close()
+    # The tube goes with its last watcher
+    for _ in range(300):
+        client.sendall(b'list-tubes\r\n')
+        if b'test_disconnect_waiting' not in read_list(client):
+            break
+        time.sleep(0.01)
+    else:
+        raise TimeoutError
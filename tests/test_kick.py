@@ -0,0 +1,65 @@
+import socket
+
+from utils import read_yaml, receive_data
+
+
+def put_jobs(client: socket.socket, tube: bytes, jobs: list) -> list:
+    client.sendall(b'use %s\r\nwatch %s\r\n' % (tube, tube))
+    expected = b'USING %s\r\nWATCHING 1\r\n' % tube
+    assert receive_data(client, len(expected)) == expected
+    ids = []
+    for delay, job_body in jobs:
+        client.sendall(b'put 0 %d 10 %d\r\n%s\r\n' % (delay, len(job_body), job_body))
+        data = receive_data(client, len(b'INSERTED X\r\n'))
+        while not data.endswith(b'\r\n'):
+            data += receive_data(client, 1)
+        ids.append(data.replace(b'INSERTED ', b'').strip())
+    return ids
+
+
+def bury_all(client: socket.socket, ids: list) -> None:
+    for job_id in ids:
+        client.sendall(b'reserve\r\n')
+        receive_data(client, len(b'RESERVED %s 3\r\nabc\r\n' % job_id))
+        client.sendall(b'bury ' + job_id + b' 0\r\n')
+        assert receive_data(client, len(b'BURIED\r\n')) == b'BURIED\r\n'
+
+
+def test_kick_buried_first(client: socket.socket) -> None:
+    ids = put_jobs(client, b'test_kick_buried', [(0, b'one'), (0, b'two'), (0, b'thr'), (100, b'del')])
+    bury_all(client, ids[:3])
+
+    # Buried jobs before delayed ones, oldest burial first
+    client.sendall(b'kick 2\r\n')
+    assert receive_data(client, len(b'KICKED 2\r\n')) == b'KICKED 2\r\n'
+    for job_id, job_body in zip(ids, (b'one', b'two')):
+        client.sendall(b'reserve-with-timeout 0\r\n')
+        expected = b'RESERVED %s 3\r\n%s\r\n' % (job_id, job_body)
+        assert receive_data(client, len(expected)) == expected
+    client.sendall(b'kick 5\r\n')
+    assert receive_data(client, len(b'KICKED 1\r\n')) == b'KICKED 1\r\n'
+    client.sendall(b'kick 5\r\n')
+    assert receive_data(client, len(b'KICKED 1\r\n')) == b'KICKED 1\r\n'
+    client.sendall(b'kick 5\r\n')
+    assert receive_data(client, len(b'KICKED 0\r\n')) == b'KICKED 0\r\n'
+
+    for job_id in ids:
+        client.sendall(b'delete ' + job_id + b'\r\n')
+        assert receive_data(client, len(b'DELETED\r\n')) == b'DELETED\r\n'
+
+
+def test_kick_job(client: socket.socket) -> None:
+    ids = put_jobs(client, b'test_kick_job', [(100, b'del'), (0, b'rdy')])
+    client.sendall(b'kick-job ' + ids[1] + b'\r\n')
+    assert receive_data(client, len(b'NOT_FOUND\r\n')) == b'NOT_FOUND\r\n'
+
+    client.sendall(b'kick-job ' + ids[0] + b'\r\n')
+    assert receive_data(client, len(b'KICKED\r\n')) == b'KICKED\r\n'
+    client.sendall(b'stats-job ' + ids[0] + b'\r\n')
+    job = read_yaml(client)
+    assert job['state'] == 'ready'
+    assert job['kicks'] == '1'
+
+    for job_id in ids:
+        client.sendall(b'delete ' + job_id + b'\r\n')
+        assert receive_data(client, len(b'DELETED\r\n')) == b'DELETED\r\n'
@@ -0,0 +1,52 @@
+import re
+import socket
+import time
+
+from utils import read_list, receive_data
+
+
+def test_list_tubes(client: socket.socket, client2: socket.socket) -> None:
+    client.sendall(b'list-tube-used\r\n')
+    assert receive_data(client, len(b'NOT_FOUND\r\n')) == b'NOT_FOUND\r\n'
+    client.sendall(b'use test_list_used\r\nwatch test_list_watched\r\n')
+    expected = b'USING test_list_used\r\nWATCHING 1\r\n'
+    assert receive_data(client, len(expected)) == expected
+    client.sendall(b'list-tube-used\r\n')
+    expected = b'USING test_list_used\r\n'
+    assert receive_data(client, len(expected)) == expected
+    client.sendall(b'list-tubes-watched\r\n')
+    assert read_list(client) == [b'test_list_watched']
+    client2.sendall(b'list-tubes\r\n')
+    tubes = read_list(client2)
+    assert b'test_list_used' in tubes
+    assert b'test_list_watched' in tubes
+
+
+def test_list_tubes_reclaimed(client: socket.socket, client2: socket.socket) -> None:
+    client.sendall(b'use test_list_jobs\r\nput 0 0 10 3\r\nabc\r\nwatch test_list_ignored\r\n')
+    data = receive_data(client, len(b'USING test_list_jobs\r\nINSERTED X\r\nWATCHING 1\r\n'))
+    while not data.endswith(b'WATCHING 1\r\n'):
+        data += receive_data(client, 1)
+    job_id = re.search(b'INSERTED ([0-9]+)', data).group(1)
+    client2.sendall(b'use test_list_closed\r\n')
+    assert receive_data(client2, len(b'USING test_list_closed\r\n')) == b'USING test_list_closed\r\n'
+
+    # Kept by its job after nobody uses it, the others go with their last client
+    client.sendall(b'use test_list_other\r\nignore test_list_ignored\r\n')
+    expected = b'USING test_list_other\r\nWATCHING 0\r\n'
+    assert receive_data(client, len(expected)) == expected
+    client2.close()
+    # The server notices the close in its own time
+    for _ in range(300):
+        client.sendall(b'list-tubes\r\n')
+        tubes = read_list(client)
+        if b'test_list_closed' not in tubes:
+            break
+        time.sleep(0.01)
+    assert b'test_list_jobs' in tubes
+    assert b'test_list_ignored' not in tubes
+    assert b'test_list_closed' not in tubes
+
+    client.sendall(b'delete %s\r\nstats-tube test_list_jobs\r\n' % job_id)
+    expected = b'DELETED\r\nNOT_FOUND\r\n'
+    assert receive_data(client, len(expected)) == expected
@@ -0,0 +1,75 @@
+import socket
+import struct
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+
+from utils import connect, receive_data, start_server
+
+
+PORT = 10_004
+METRICS_PORT = 10_005
+
+
+def scrape(path: str = '/metrics') -> str:
+    url = f'http://localhost:{METRICS_PORT}{path}'
+    with urllib.request.urlopen(url, timeout=3) as response:
+        assert response.headers['Content-Type'].startswith('text/plain')
+        return response.read().decode()
+
+
+def test_metrics() -> None:
+    server = start_server(PORT, '--metrics-port', str(METRICS_PORT))
+    try:
+        client = connect(PORT)
+        client.sendall(b'use test_metrics\r\nwatch test_metrics\r\nput 0 0 10 2\r\nhi\r\n')
+        expected = b'USING test_metrics\r\nWATCHING 1\r\nINSERTED 1\r\n'
+        assert receive_data(client, len(expected)) == expected
+        client.sendall(b'put 0 0 10 2\r\nho\r\n')
+        assert receive_data(client, len(b'INSERTED 2\r\n')) == b'INSERTED 2\r\n'
+
+        text = scrape()
+        assert 'tree_jobs{tube="test_metrics",state="ready"} 2' in text
+        assert 'tree_command_seconds_count{command="put"} 2' in text
+
+        client.sendall(b'reserve\r\n')
+        expected = b'RESERVED 1 2\r\nhi\r\n'
+        assert receive_data(client, len(expected)) == expected
+        client.sendall(b'delete 1\r\n')
+        assert receive_data(client, len(b'DELETED\r\n')) == b'DELETED\r\n'
+
+        text = scrape()
+        assert 'tree_jobs{tube="test_metrics",state="ready"} 1' in text
+        assert 'tree_queue_wait_seconds_count 1' in text
+        assert 'tree_processing_seconds_count 1' in text
+        assert 'tree_queue_wait_seconds_bucket{le="+Inf"} 1' in text
+
+        with pytest.raises(urllib.error.HTTPError):
+            scrape('/other')
+        client.close()
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def test_metrics_reset() -> None:
+    server = start_server(PORT, '--metrics-port', str(METRICS_PORT))
+    try:
+        client = connect(PORT)
+        # Part of a request, then a reset rather than a clean close
+        scraper = connect(METRICS_PORT)
+        scraper.sendall(b'GET /met')
+        time.sleep(0.1)
+        scraper.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        scraper.close()
+        # Seen by the server before it answers a command sent afterwards
+        client.sendall(b'use test_metrics_reset\r\n')
+        expected = b'USING test_metrics_reset\r\n'
+        assert receive_data(client, len(expected)) == expected
+        assert 'tree_queue_wait_seconds' in scrape()
+        client.close()
+    finally:
+        server.terminate()
+        server.wait()
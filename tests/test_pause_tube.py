@@ -0,0 +1,47 @@
+import re
+import socket
+import time
+
+from utils import read_yaml, receive_data
+
+
+def test_pause_tube(client: socket.socket, client2: socket.socket, client3: socket.socket) -> None:
+    client.sendall(b'pause-tube test_pause_tube_missing 1\r\n')
+    assert receive_data(client, len(b'NOT_FOUND\r\n')) == b'NOT_FOUND\r\n'
+
+    client.sendall(b'use test_pause_tube\r\nput 0 0 10 3\r\none\r\npause-tube test_pause_tube 1\r\n')
+    data = receive_data(client, len(b'USING test_pause_tube\r\nINSERTED X\r\nPAUSED\r\n'))
+    while not data.endswith(b'PAUSED\r\n'):
+        data += receive_data(client, 1)
+    ids = re.findall(b'INSERTED ([0-9]+)', data)
+    paused = time.monotonic()
+
+    client2.sendall(b'watch test_pause_tube\r\nreserve-with-timeout 0\r\nreserve\r\n')
+    expected = b'WATCHING 1\r\nTIMED_OUT\r\n'
+    assert receive_data(client2, len(expected)) == expected
+    client3.sendall(b'watch test_pause_tube\r\nreserve\r\n')
+    assert receive_data(client3, len(b'WATCHING 1\r\n')) == b'WATCHING 1\r\n'
+
+    client.sendall(b'put 0 0 10 3\r\ntwo\r\n')
+    data = receive_data(client, len(b'INSERTED X\r\n'))
+    while not data.endswith(b'\r\n'):
+        data += receive_data(client, 1)
+    ids += re.findall(b'INSERTED ([0-9]+)', data)
+    client.sendall(b'stats-tube test_pause_tube\r\n')
+    tube = read_yaml(client)
+    assert tube['pause'] == '1'
+    assert tube['cmd-pause-tube'] == '1'
+    assert tube['current-jobs-ready'] == '2'
+    assert tube['current-waiting'] == '2'
+
+    # Both waiting reservers get a job once the pause is over
+    expected = b'RESERVED %s 3\r\none\r\n' % ids[0]
+    assert receive_data(client2, len(expected)) == expected
+    assert time.monotonic() - paused >= 0.9
+    expected = b'RESERVED %s 3\r\ntwo\r\n' % ids[1]
+    assert receive_data(client3, len(expected)) == expected
+
+    client2.sendall(b'delete ' + ids[0] + b'\r\n')
+    assert receive_data(client2, len(b'DELETED\r\n')) == b'DELETED\r\n'
+    client3.sendall(b'delete ' + ids[1] + b'\r\n')
+    assert receive_data(client3, len(b'DELETED\r\n')) == b'DELETED\r\n'
@@ -0,0 +1,45 @@
+import socket
+
+from utils import receive_data
+
+
+def test_peek(client: socket.socket) -> None:
+    client.sendall(b'use test_peek\r\n')
+    receive_data(client, len(b'USING test_peek\r\n'))
+    for command in (b'peek-ready', b'peek-delayed', b'peek-buried', b'peek 999999'):
+        client.sendall(command + b'\r\n')
+        assert receive_data(client, len(b'NOT_FOUND\r\n')) == b'NOT_FOUND\r\n'
+
+    ids = []
+    for priority, delay, job_body in ((5, 0, b'later'), (1, 0, b'first'), (0, 100, b'sleep'), (0, 50, b'sooon')):
+        client.sendall(b'put %d %d 10 5\r\n%s\r\n' % (priority, delay, job_body))
+        data = receive_data(client, len(b'INSERTED X\r\n'))
+        while not data.endswith(b'\r\n'):
+            data += receive_data(client, 1)
+        ids.append(data.replace(b'INSERTED ', b'').strip())
+
+    client.sendall(b'peek-ready\r\n')
+    expected = b'FOUND %s 5\r\nfirst\r\n' % ids[1]
+    assert receive_data(client, len(expected)) == expected
+    client.sendall(b'peek-delayed\r\n')
+    expected = b'FOUND %s 5\r\nsooon\r\n' % ids[3]
+    assert receive_data(client, len(expected)) == expected
+    client.sendall(b'peek ' + ids[2] + b'\r\n')
+    expected = b'FOUND %s 5\r\nsleep\r\n' % ids[2]
+    assert receive_data(client, len(expected)) == expected
+
+    # Peeking leaves the job where it was
+    client.sendall(b'delete ' + ids[3] + b'\r\npeek-delayed\r\n')
+    expected = b'DELETED\r\nFOUND %s 5\r\nsleep\r\n' % ids[2]
+    assert receive_data(client, len(expected)) == expected
+
+    client.sendall(b'watch test_peek\r\nreserve\r\n')
+    expected = b'WATCHING 1\r\nRESERVED %s 5\r\nfirst\r\n' % ids[1]
+    assert receive_data(client, len(expected)) == expected
+    client.sendall(b'bury ' + ids[1] + b' 0\r\npeek-buried\r\n')
+    expected = b'BURIED\r\nFOUND %s 5\r\nfirst\r\n' % ids[1]
+    assert receive_data(client, len(expected)) == expected
+
+    for job_id in (ids[0], ids[1], ids[2]):
+        client.sendall(b'delete ' + job_id + b'\r\n')
+        assert receive_data(client, len(b'DELETED\r\n')) == b'DELETED\r\n'
@@ -10,7 +10,7 @@ def test_put(client: socket.socket) -> None:
     client.sendall(use_message)
     receive_data(client, len(b'using foo\r\n'))
 
-    message = b'put 500 0 10 53\r\n'
+    message = b'put 500 0 10 20\r\n'
     client.sendall(message)
 
     job_body = b'01234567890123456789\r\n'
@@ -90,3 +90,41 @@ def test_put_with_timeout(client, client2):
     job_id = put_response.replace(b'INSERTED ', b'').strip()
     expected = expected.replace(b'X', job_id)
     assert data == expected
+
+
+def test_put_body_with_crlf(client: socket.socket) -> None:
+    # Body is framed by <bytes>, not by the next CRLF
+    job_body = b'0123\r\n4567\r\n89'
+    message = (
+        b'use test_put_body_with_crlf\r\n'
+        + b'put 500 0 10 ' + str(len(job_body)).encode('utf-8') + b'\r\n' + job_body + b'\r\n'
+        + b'watch test_put_body_with_crlf\r\n'
+        + b'reserve\r\n'
+    )
+    client.sendall(message)
+
+    expected = (
+        b'USING test_put_body_with_crlf\r\n'
+        + b'INSERTED X\r\n'
+        + b'WATCHING 1\r\n'
+        + b'RESERVED X ' + str(len(job_body)).encode('utf-8') + b'\r\n' + job_body + b'\r\n'
+    )
+    data = receive_data(client, len(expected))
+    while not data.endswith(job_body + b'\r\n'):
+        # Job ids may be longer than X
+        data += receive_data(client, 1)
+    assert re.fullmatch(re.escape(expected).replace(b'X', b'[0-9]+'), data)
+
+
+def test_put_bad_format(client: socket.socket) -> None:
+    use_message = b'use foo\r\n'
+    client.sendall(use_message)
+    receive_data(client, len(b'USING foo\r\n'))
+
+    expected = b'BAD_FORMAT\r\n'
+    message = b'put 500 -1 10 5\r\nhello\r\n'
+    client.sendall(message)
+
+    amount_expected = len(expected)
+    data = receive_data(client, amount_expected)
+    assert data == expected
@@ -0,0 +1,67 @@
+import re
+import socket
+
+from utils import receive_data
+
+
+def receive_line(client: socket.socket) -> bytes:
+    data = receive_data(client, 2)
+    while not data.endswith(b'\r\n'):
+        data += receive_data(client, 1)
+    return data
+
+
+def test_put_batch(client: socket.socket, client2: socket.socket) -> None:
+    client.sendall(b'use test_put_batch\r\n')
+    receive_data(client, len(b'USING test_put_batch\r\n'))
+    bodies = [b'first', b'second\r\nline', b'third']
+    message = b'put-batch 3\r\n' + b''.join(
+        b'%d 0 10 %d\r\n%s\r\n' % (priority, len(body), body)
+        for priority, body in enumerate(bodies)
+    )
+    client.sendall(message)
+    ids = re.fullmatch(b'INSERTED-BATCH ([0-9]+) ([0-9]+) ([0-9]+)\r\n', receive_line(client)).groups()
+    assert [int(job_id) for job_id in ids] == list(range(int(ids[0]), int(ids[0]) + 3))
+
+    client2.sendall(b'watch test_put_batch\r\n')
+    receive_data(client2, len(b'WATCHING 1\r\n'))
+    for job_id, body in zip(ids, bodies):
+        client2.sendall(b'reserve\r\n')
+        expected = b'RESERVED %s %d\r\n%s\r\n' % (job_id, len(body), body)
+        assert receive_data(client2, len(expected)) == expected
+        client2.sendall(b'delete %s\r\n' % job_id)
+        assert receive_data(client2, len(b'DELETED\r\n')) == b'DELETED\r\n'
+
+
+def test_put_batch_job_too_big(client: socket.socket) -> None:
+    client.sendall(b'use test_put_batch\r\n')
+    receive_data(client, len(b'USING test_put_batch\r\n'))
+    big = b'x' * (2 ** 16 + 1)
+    client.sendall(b'put-batch 2\r\n0 0 10 1\r\na\r\n0 0 10 %d\r\n%s\r\n' % (len(big), big))
+    assert receive_data(client, len(b'JOB_TOO_BIG\r\n')) == b'JOB_TOO_BIG\r\n'
+    # Nothing was inserted and the connection is still in step
+    client.sendall(b'stats-tube test_put_batch\r\n')
+    data = receive_data(client, 256)
+    assert data.startswith(b'OK ')
+    assert b'current-jobs-ready: 0\n' in data
+
+
+def test_put_batch_bad_format(client: socket.socket) -> None:
+    client.sendall(b'use test_put_batch\r\n')
+    receive_data(client, len(b'USING test_put_batch\r\n'))
+    client.sendall(b'put-batch 0\r\nput-batch 1\r\nnot a job\r\n')
+    expected = b'BAD_FORMAT\r\nBAD_FORMAT\r\n'
+    assert receive_data(client, len(expected)) == expected
+
+
+def test_put_batch_bad_frame(client: socket.socket) -> None:
+    client.sendall(b'use test_put_batch_bad_frame\r\n')
+    receive_data(client, len(b'USING test_put_batch_bad_frame\r\n'))
+    # A header missing its TTR, its body is skipped all the same
+    client.sendall(b'put-batch 3\r\n0 0 10 1\r\na\r\n0 0 1\r\nb\r\n0 0 10 1\r\nc\r\n')
+    assert receive_data(client, len(b'BAD_FORMAT\r\n')) == b'BAD_FORMAT\r\n'
+    # Nothing was inserted and the frames after it weren't taken for commands
+    client.sendall(b'stats-tube test_put_batch_bad_frame\r\n')
+    data = receive_data(client, 256)
+    assert data.startswith(b'OK ')
+    assert b'current-jobs-ready: 0\n' in data
@@ -0,0 +1,84 @@
+import re
+import socket
+import time
+
+from utils import receive_data, wait_for_waiting
+
+
+def test_release(client: socket.socket, client2: socket.socket) -> None:
+    use_message = b'use test_release\r\n'
+    client.sendall(use_message)
+    receive_data(client, len(b'USING test_release\r\n'))
+
+    job_body = b'01234567890123456789'
+    message = b'put 500 0 10 ' + str(len(job_body)).encode('utf-8') + b'\r\n' + job_body + b'\r\n'
+    client.sendall(message)
+    receive_data(client, len(b'INSERTED X\r\n'))
+
+    watch_message = b'watch test_release\r\n'
+    client.sendall(watch_message)
+    receive_data(client, len(b'WATCHING 1\r\n'))
+    client2.sendall(watch_message)
+    receive_data(client2, len(b'WATCHING 1\r\n'))
+
+    client.sendall(b'reserve\r\n')
+    expected = b'RESERVED X ' + str(len(job_body)).encode('utf-8') + b'\r\n' + job_body + b'\r\n'
+    data = receive_data(client, len(expected))
+    job_id = re.match(expected.replace(b'X', b'([0-9]+)'), data).groups()[0]
+
+    client2.sendall(b'reserve\r\n')
+    wait_for_waiting(client, b'test_release', 1)
+
+    message = b'release ' + job_id + b' 500 0\r\n'
+    client.sendall(message)
+    expected = b'RELEASED\r\n'
+    data = receive_data(client, len(expected))
+    assert data == expected
+
+    # The released job goes straight to the waiting reserver
+    expected = b'RESERVED ' + job_id + b' ' + str(len(job_body)).encode('utf-8') + b'\r\n' + job_body + b'\r\n'
+    data = receive_data(client2, len(expected))
+    assert data == expected
+
+
+def test_release_with_delay(client: socket.socket) -> None:
+    use_message = b'use test_release_with_delay\r\n'
+    client.sendall(use_message)
+    receive_data(client, len(b'USING test_release_with_delay\r\n'))
+
+    job_body = b'01234567890123456789'
+    message = b'put 500 0 10 ' + str(len(job_body)).encode('utf-8') + b'\r\n' + job_body + b'\r\n'
+    client.sendall(message)
+    receive_data(client, len(b'INSERTED X\r\n'))
+
+    watch_message = b'watch test_release_with_delay\r\n'
+    client.sendall(watch_message)
+    receive_data(client, len(b'WATCHING 1\r\n'))
+
+    client.sendall(b'reserve\r\n')
+    expected = b'RESERVED X ' + str(len(job_body)).encode('utf-8') + b'\r\n' + job_body + b'\r\n'
+    data = receive_data(client, len(expected))
+    job_id = re.match(expected.replace(b'X', b'([0-9]+)'), data).groups()[0]
+
+    delay = 2
+    message = b'release ' + job_id + b' 500 ' + str(delay).encode('utf-8') + b'\r\n'
+    client.sendall(message)
+    data = receive_data(client, len(b'RELEASED\r\n'))
+    assert data == b'RELEASED\r\n'
+
+    client.sendall(b'reserve\r\n')
+    start_time = time.time()
+    expected = b'RESERVED ' + job_id + b' ' + str(len(job_body)).encode('utf-8') + b'\r\n' + job_body + b'\r\n'
+    data = receive_data(client, len(expected), delay + 1)
+    end_time = time.time()
+    assert data == expected
+    assert (delay - 0.5) < (end_time - start_time) < (delay + 0.5)
+
+
+def test_release_not_reserved(client: socket.socket) -> None:
+    message = b'release 999999 500 0\r\n'
+    client.sendall(message)
+
+    expected = b'NOT_FOUND\r\n'
+    data = receive_data(client, len(expected))
+    assert data == expected
@@ -1,7 +1,7 @@
 import re
 import socket
 
-from utils import receive_data
+from utils import receive_data, wait_for_waiting
 
 
 def test_reserve_after_put(client: socket.socket) -> None:
@@ -54,3 +54,181 @@ def test_reserve_before_put(client: socket.socket, client2: socket.socket) -> No
 
     data = receive_data(client, amount_expected)
     assert re.match(expected.replace(b'X', b'[0-9]+'), data)
+
+
+def test_reserve_longest_waiting_first(
+    client: socket.socket,
+    client2: socket.socket,
+    client3: socket.socket,
+) -> None:
+    watch_message = b'watch test_reserve_longest_waiting_first\r\n'
+    client.sendall(watch_message)
+    receive_data(client, len(b'WATCHING 1\r\n'))
+    client2.sendall(watch_message)
+    receive_data(client2, len(b'WATCHING 1\r\n'))
+
+    client.sendall(b'reserve\r\n')
+    wait_for_waiting(client3, b'test_reserve_longest_waiting_first', 1)
+    client2.sendall(b'reserve\r\n')
+    wait_for_waiting(client3, b'test_reserve_longest_waiting_first', 2)
+
+    use_message = b'use test_reserve_longest_waiting_first\r\n'
+    client3.sendall(use_message)
+    receive_data(client3, len(b'USING test_reserve_longest_waiting_first\r\n'))
+
+    job_body = b'first'
+    message = b'put 500 0 10 ' + str(len(job_body)).encode('utf-8') + b'\r\n' + job_body + b'\r\n'
+    client3.sendall(message)
+    receive_data(client3, len(b'INSERTED X\r\n'))
+
+    expected = b'RESERVED X ' + str(len(job_body)).encode('utf-8') + b'\r\n' + job_body + b'\r\n'
+    data = receive_data(client, len(expected))
+    assert re.match(expected.replace(b'X', b'[0-9]+'), data)
+
+
+def test_reserve_priority_order(client: socket.socket) -> None:
+    use_message = b'use test_reserve_priority_order\r\n'
+    client.sendall(use_message)
+    receive_data(client, len(b'USING test_reserve_priority_order\r\n'))
+
+    for priority, job_body in ((10, b'later'), (1, b'first'), (10, b'last!')):
+        message = f'put {priority} 0 10 {len(job_body)}\r\n'.encode('utf-8') + job_body + b'\r\n'
+        client.sendall(message)
+        receive_data(client, len(b'INSERTED X\r\n'))
+
+    watch_message = b'watch test_reserve_priority_order\r\n'
+    client.sendall(watch_message)
+    receive_data(client, len(b'WATCHING 1\r\n'))
+
+    for job_body in (b'first', b'later', b'last!'):
+        client.sendall(b'reserve\r\n')
+        expected = b'RESERVED X 5\r\n' + job_body + b'\r\n'
+        data = receive_data(client, len(expected))
+        assert re.match(expected.replace(b'X', b'[0-9]+'), data)
+
+
+def test_reserve_priority_across_tubes(client: socket.socket) -> None:
+    # The most urgent job of all the watched tubes, whichever was watched first
+    tubes = (b'test_reserve_across_a', b'test_reserve_across_b', b'test_reserve_across_c')
+    for tube, priority, job_body in (
+        (tubes[0], 10, b'third'), (tubes[1], 5, b'first'), (tubes[2], 5, b'later'),
+        (tubes[0], 1, b'quick'),
+    ):
+        client.sendall(b'use %s\r\n' % tube)
+        receive_data(client, len(b'USING %s\r\n' % tube))
+        client.sendall(b'put %d 0 10 5\r\n%s\r\n' % (priority, job_body))
+        receive_data(client, len(b'INSERTED X\r\n'))
+
+    client.sendall(b''.join(b'watch %s\r\n' % tube for tube in tubes))
+    expected = b'WATCHING 1\r\nWATCHING 2\r\nWATCHING 3\r\n'
+    assert receive_data(client, len(expected)) == expected
+
+    for job_body in (b'quick', b'first', b'later', b'third'):
+        client.sendall(b'reserve\r\n')
+        expected = b'RESERVED X 5\r\n' + job_body + b'\r\n'
+        data = receive_data(client, len(expected))
+        assert re.match(expected.replace(b'X', b'[0-9]+'), data)
+
+
+def test_reserve_large_body(client: socket.socket) -> None:
+    use_message = b'use test_reserve_large_body\r\n'
+    client.sendall(use_message)
+    receive_data(client, len(b'USING test_reserve_large_body\r\n'))
+
+    job_body = bytes(range(256)) * 256
+    message = b'put 500 0 10 ' + str(len(job_body)).encode('utf-8') + b'\r\n' + job_body + b'\r\n'
+    client.sendall(message)
+    data = receive_data(client, len(b'INSERTED X\r\n'))
+    job_id = data.replace(b'INSERTED ', b'').strip()
+
+    watch_message = b'watch test_reserve_large_body\r\n'
+    client.sendall(watch_message)
+    receive_data(client, len(b'WATCHING 1\r\n'))
+
+    client.sendall(b'reserve\r\n')
+    expected = b'RESERVED ' + job_id + b' ' + str(len(job_body)).encode('utf-8') + b'\r\n' + job_body + b'\r\n'
+    data = receive_data(client, len(expected))
+    assert data == expected
+
+
+def test_reserve_pipelined(client: socket.socket, client2: socket.socket) -> None:
+    # Three reserves in one write, the third times out after the others
+    client2.sendall(
+        b'watch test_reserve_pipelined\r\nreserve\r\nreserve\r\nreserve-with-timeout 0\r\n',
+    )
+    receive_data(client2, len(b'WATCHING 1\r\n'))
+    wait_for_waiting(client, b'test_reserve_pipelined', 1)
+
+    use_message = b'use test_reserve_pipelined\r\n'
+    client.sendall(use_message)
+    receive_data(client, len(b'USING test_reserve_pipelined\r\n'))
+    job_ids = []
+    for job_body in (b'one', b'two'):
+        message = f'put 0 0 10 {len(job_body)}\r\n'.encode('utf-8') + job_body + b'\r\n'
+        client.sendall(message)
+        data = receive_data(client, len(b'INSERTED X\r\n'))
+        while not data.endswith(b'\r\n'):
+            data += receive_data(client, 1)
+        job_ids.append(data.replace(b'INSERTED ', b'').strip())
+
+    # Both jobs are held by the one connection at the same time
+    expected = b''.join(
+        b'RESERVED ' + job_id + b' 3\r\n' + job_body + b'\r\n'
+        for job_id, job_body in zip(job_ids, (b'one', b'two'))
+    ) + b'TIMED_OUT\r\n'
+    data = receive_data(client2, len(expected))
+    assert data == expected
+
+    for job_id in reversed(job_ids):
+        client2.sendall(b'delete ' + job_id + b'\r\n')
+        assert receive_data(client2, len(b'DELETED\r\n')) == b'DELETED\r\n'
+
+
+def test_reserve_then_delete(client: socket.socket, client2: socket.socket) -> None:
+    client2.sendall(b'watch test_reserve_then_delete\r\nignore default\r\n')
+    receive_data(client2, len(b'WATCHING 2\r\nWATCHING 1\r\n'))
+    client.sendall(b'use test_reserve_then_delete\r\nput 0 0 10 3\r\nabc\r\n')
+    data = receive_data(client, len(b'USING test_reserve_then_delete\r\nINSERTED X\r\n'))
+    while not data.endswith(b'\r\n'):
+        data += receive_data(client, 1)
+    job_id = data.rsplit(b' ', 1)[1].strip()
+    client2.sendall(b'reserve\r\n')
+    expected = b'RESERVED ' + job_id + b' 3\r\nabc\r\n'
+    assert receive_data(client2, len(expected)) == expected
+
+    # The delete waits for the reserve sent before it to be answered
+    client2.sendall(b'reserve-with-timeout 1\r\ndelete ' + job_id + b'\r\n')
+    expected = b'TIMED_OUT\r\nDELETED\r\n'
+    assert receive_data(client2, len(expected)) == expected
+
+
+def test_reserve_watch_switch(client: socket.socket) -> None:
+    # From several tubes watched down to one and back
+    job_ids = {}
+    for tube, priority, job_body in ((b'a', 5, b'a1'), (b'a', 3, b'a2'), (b'b', 1, b'b1')):
+        client.sendall(b'use test_reserve_switch_%s\r\nput %d 0 10 2\r\n%s\r\n' % (tube, priority, job_body))
+        data = receive_data(client, len(b'USING test_reserve_switch_a\r\nINSERTED X\r\n'))
+        while not data.endswith(b'\r\n'):
+            data += receive_data(client, 1)
+        job_ids[job_body] = re.search(b'INSERTED ([0-9]+)', data).group(1)
+    client.sendall(
+        b'watch test_reserve_switch_a\r\nwatch test_reserve_switch_b\r\nignore test_reserve_switch_b\r\n',
+    )
+    expected = b'WATCHING 1\r\nWATCHING 2\r\nWATCHING 1\r\n'
+    assert receive_data(client, len(expected)) == expected
+
+    for watch, watching, job_body in (
+        (b'', b'', b'a2'),
+        (b'watch test_reserve_switch_b\r\n', b'WATCHING 2\r\n', b'b1'),
+    ):
+        client.sendall(watch + b'reserve-with-timeout 0\r\n')
+        expected = watching + b'RESERVED %s 2\r\n%s\r\n' % (job_ids[job_body], job_body)
+        assert receive_data(client, len(expected)) == expected
+
+    # Left with b, now empty, a1 isn't handed out
+    client.sendall(b'ignore test_reserve_switch_a\r\nreserve-with-timeout 0\r\n')
+    expected = b'WATCHING 1\r\nTIMED_OUT\r\n'
+    assert receive_data(client, len(expected)) == expected
+    for job_id in job_ids.values():
+        client.sendall(b'delete %s\r\n' % job_id)
+        assert receive_data(client, len(b'DELETED\r\n')) == b'DELETED\r\n'
@@ -0,0 +1,46 @@
+import re
+import socket
+
+from utils import receive_data, wait_for_waiting
+
+
+def put(client: socket.socket, body: bytes) -> bytes:
+    client.sendall(b'put 0 0 10 %d\r\n%s\r\n' % (len(body), body))
+    data = receive_data(client, len(b'INSERTED 1\r\n'))
+    while not data.endswith(b'\r\n'):
+        data += receive_data(client, 1)
+    return re.fullmatch(b'INSERTED ([0-9]+)\r\n', data).group(1)
+
+
+def test_reserve_batch(client: socket.socket, client2: socket.socket) -> None:
+    client.sendall(b'use test_reserve_batch\r\n')
+    receive_data(client, len(b'USING test_reserve_batch\r\n'))
+    ids = [put(client, body) for body in (b'one', b'two', b'six')]
+
+    client2.sendall(b'watch test_reserve_batch\r\n')
+    receive_data(client2, len(b'WATCHING 1\r\n'))
+    # Asks for more than there are
+    client2.sendall(b'reserve-batch 5 0\r\n')
+    expected = b'RESERVED-BATCH 3\r\n' + b''.join(
+        b'RESERVED %s 3\r\n%s\r\n' % (job_id, body)
+        for job_id, body in zip(ids, (b'one', b'two', b'six'))
+    )
+    assert receive_data(client2, len(expected)) == expected
+
+    client2.sendall(b'reserve-batch 5 0\r\n')
+    assert receive_data(client2, len(b'TIMED_OUT\r\n')) == b'TIMED_OUT\r\n'
+    for job_id in ids:
+        client2.sendall(b'delete %s\r\n' % job_id)
+        assert receive_data(client2, len(b'DELETED\r\n')) == b'DELETED\r\n'
+
+
+def test_reserve_batch_waits(client: socket.socket, client2: socket.socket) -> None:
+    client2.sendall(b'watch test_reserve_batch_waits\r\nreserve-batch 2 5\r\n')
+    receive_data(client2, len(b'WATCHING 1\r\n'))
+    wait_for_waiting(client, b'test_reserve_batch_waits', 1)
+
+    client.sendall(b'use test_reserve_batch_waits\r\n')
+    receive_data(client, len(b'USING test_reserve_batch_waits\r\n'))
+    job_id = put(client, b'late')
+    expected = b'RESERVED-BATCH 1\r\nRESERVED %s 4\r\nlate\r\n' % job_id
+    assert receive_data(client2, len(expected)) == expected
@@ -67,3 +67,20 @@ def test_reserve_with_timeout_reached(client2: socket.socket) -> None:
     time.sleep(10)
     data = receive_data(client2, len(b'TIMED_OUT\r\n'))
     assert data == b'TIMED_OUT\r\n'
+
+
+def test_reserve_with_timeout_out_of_range(client: socket.socket) -> None:
+    # Times past 32 bits are rejected, however many digits they have
+    client.sendall(b'use test_timeout_range\r\nwatch test_timeout_range\r\n')
+    expected = b'USING test_timeout_range\r\nWATCHING 1\r\n'
+    assert receive_data(client, len(expected)) == expected
+    for command in (
+        b'reserve-with-timeout 4294967296',
+        b'reserve-with-timeout ' + b'9' * 200,
+        b'reserve-batch 1 ' + b'9' * 200,
+        b'pause-tube test_timeout_range ' + b'9' * 180,
+    ):
+        client.sendall(command + b'\r\n')
+        assert receive_data(client, len(b'BAD_FORMAT\r\n')) == b'BAD_FORMAT\r\n'
+    client.sendall(b'reserve-with-timeout 0\r\n')
+    assert receive_data(client, len(b'TIMED_OUT\r\n')) == b'TIMED_OUT\r\n'
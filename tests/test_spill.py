@@ -0,0 +1,33 @@
+import pathlib
+
+from utils import connect, receive_data, start_server
+
+
+PORT = 10_002
+
+
+def test_spilled_bodies(tmp_path: pathlib.Path) -> None:
+    # Only the first body fits the budget, the others are spilled
+    server = start_server(PORT, '--spill-dir', str(tmp_path), '--body-budget', '10')
+    try:
+        client = connect(PORT)
+        bodies = [b'in memory!', b'spilled', b'x' * 50_000]
+        client.sendall(b'use test_spill\r\nwatch test_spill\r\n')
+        expected = b'USING test_spill\r\nWATCHING 1\r\n'
+        assert receive_data(client, len(expected)) == expected
+
+        for round_ in range(2):
+            for body in bodies:
+                client.sendall(b'put 0 0 10 %d\r\n%s\r\n' % (len(body), body))
+                receive_data(client, len(b'INSERTED 1\r\n'))
+            for job_id, body in enumerate(bodies, 1 + round_ * len(bodies)):
+                client.sendall(b'reserve\r\n')
+                expected = b'RESERVED %d %d\r\n%s\r\n' % (job_id, len(body), body)
+                assert receive_data(client, len(expected)) == expected
+                # Chunks freed here are reused in the next round
+                client.sendall(b'delete %d\r\n' % job_id)
+                assert receive_data(client, len(b'DELETED\r\n')) == b'DELETED\r\n'
+        client.close()
+    finally:
+        server.terminate()
+        server.wait()
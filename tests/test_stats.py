@@ -0,0 +1,65 @@
+import re
+import socket
+
+from utils import read_yaml, receive_data
+
+
+def test_stats(client: socket.socket, client2: socket.socket) -> None:
+    client.sendall(b'stats\r\n')
+    before = read_yaml(client)
+
+    client.sendall(b'use test_stats\r\nput 0 0 10 2\r\nhi\r\nput 2000 5 10 2\r\nho\r\n')
+    data = receive_data(client, len(b'USING test_stats\r\nINSERTED 1\r\nINSERTED 1\r\n'))
+    while data.count(b'\r\n') < 3:
+        data += receive_data(client, 1)
+    ready_id, delayed_id = re.findall(b'INSERTED ([0-9]+)', data)
+
+    client.sendall(b'stats\r\n')
+    after = read_yaml(client)
+    assert int(after['cmd-put']) == int(before['cmd-put']) + 2
+    assert int(after['total-jobs']) == int(before['total-jobs']) + 2
+    assert int(after['current-jobs-ready']) == int(before['current-jobs-ready']) + 1
+    assert int(after['current-jobs-urgent']) == int(before['current-jobs-urgent']) + 1
+    assert int(after['current-jobs-delayed']) == int(before['current-jobs-delayed']) + 1
+    assert int(after['current-producers']) >= 1
+
+    client.sendall(b'stats-tube test_stats\r\n')
+    tube = read_yaml(client)
+    assert tube['name'] == '"test_stats"'
+    assert tube['current-jobs-ready'] == '1'
+    assert tube['current-jobs-delayed'] == '1'
+    assert tube['current-using'] == '1'
+    assert tube['total-jobs'] == '2'
+
+    client2.sendall(b'watch test_stats\r\nreserve\r\n')
+    expected = b'WATCHING 1\r\nRESERVED ' + ready_id + b' 2\r\nhi\r\n'
+    assert receive_data(client2, len(expected)) == expected
+    client.sendall(b'stats-job ' + ready_id + b'\r\n')
+    job = read_yaml(client)
+    assert job['id'] == ready_id.decode()
+    assert job['tube'] == '"test_stats"'
+    assert job['state'] == 'reserved'
+    assert job['reserves'] == '1'
+    assert job['ttr'] == '10'
+
+    client.sendall(b'stats-job ' + delayed_id + b'\r\n')
+    job = read_yaml(client)
+    assert job['state'] == 'delayed'
+    assert job['pri'] == '2000'
+    assert 0 < int(job['time-left']) <= 5
+
+    for job_id in (ready_id, delayed_id):
+        client2.sendall(b'delete ' + job_id + b'\r\n')
+        assert receive_data(client2, len(b'DELETED\r\n')) == b'DELETED\r\n'
+    client.sendall(b'stats-tube test_stats\r\n')
+    tube = read_yaml(client)
+    assert tube['current-jobs-ready'] == '0'
+    assert tube['current-jobs-reserved'] == '0'
+    assert tube['current-jobs-delayed'] == '0'
+    assert tube['cmd-delete'] == '2'
+
+
+def test_stats_not_found(client: socket.socket) -> None:
+    client.sendall(b'stats-tube test_stats_missing\r\nstats-job 999999\r\n')
+    expected = b'NOT_FOUND\r\nNOT_FOUND\r\n'
+    assert receive_data(client, len(expected)) == expected
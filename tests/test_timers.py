@@ -0,0 +1,21 @@
+from timers import Timers
+
+
+def test_cancel_while_expiring() -> None:
+    # A callback cancelling enough timers to compact the heap while
+    # expire() is still going through it
+    timers = Timers()
+    fired = []
+    later = [timers.schedule(3600, fired.append, 'later') for _ in range(200)]
+
+    def cancel_later() -> None:
+        fired.append('first')
+        for timer in later:
+            timers.cancel(timer)
+
+    timers.schedule(0, cancel_later)
+    timers.schedule(0, fired.append, 'second')
+    assert timers.expire() == 2
+    assert fired == ['first', 'second']
+    assert len(timers) == 0
+    assert timers.next_deadline() is None
@@ -0,0 +1,37 @@
+import socket
+import time
+
+from utils import read_yaml, receive_data
+
+
+def test_touch(client: socket.socket, client2: socket.socket) -> None:
+    client.sendall(b'use test_touch\r\nwatch test_touch\r\nput 0 0 3 3\r\nabc\r\n')
+    data = receive_data(client, len(b'USING test_touch\r\nWATCHING 1\r\nINSERTED X\r\n'))
+    while not data.endswith(b'\r\n'):
+        data += receive_data(client, 1)
+    job_id = data.rsplit(b' ', 1)[1].strip()
+    client.sendall(b'reserve\r\n')
+    expected = b'RESERVED %s 3\r\nabc\r\n' % job_id
+    assert receive_data(client, len(expected)) == expected
+
+    client2.sendall(b'touch ' + job_id + b'\r\ntouch 999999\r\n')
+    expected = b'NOT_FOUND\r\nNOT_FOUND\r\n'
+    assert receive_data(client2, len(expected)) == expected
+
+    # Touched before the TTR of 3 seconds is up, it starts over
+    time.sleep(2)
+    client.sendall(b'touch ' + job_id + b'\r\n')
+    assert receive_data(client, len(b'TOUCHED\r\n')) == b'TOUCHED\r\n'
+    time.sleep(2)
+    client.sendall(b'stats-job ' + job_id + b'\r\n')
+    job = read_yaml(client)
+    assert job['state'] == 'reserved'
+    assert int(job['time-left']) >= 0
+
+    # And again after DEADLINE_SOON
+    assert receive_data(client, len(b'DEADLINE_SOON\r\n')) == b'DEADLINE_SOON\r\n'
+    client.sendall(b'touch ' + job_id + b'\r\n')
+    assert receive_data(client, len(b'TOUCHED\r\n')) == b'TOUCHED\r\n'
+    time.sleep(2)
+    client.sendall(b'delete ' + job_id + b'\r\n')
+    assert receive_data(client, len(b'DELETED\r\n')) == b'DELETED\r\n'
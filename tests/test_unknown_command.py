@@ -0,0 +1,32 @@
+import socket
+
+from utils import receive_data
+
+
+def test_unknown_command(client: socket.socket) -> None:
+    expected = b'UNKNOWN_COMMAND\r\n'
+    message = b'frobnicate foo\r\n'
+    client.sendall(message)
+
+    amount_expected = len(expected)
+    data = receive_data(client, amount_expected)
+    assert data == expected
+
+
+def test_unknown_command_then_use(client: socket.socket) -> None:
+    expected = b'UNKNOWN_COMMAND\r\nUSING foo\r\n'
+    message = b'usefoo\r\nuse foo\r\n'
+    client.sendall(message)
+
+    amount_expected = len(expected)
+    data = receive_data(client, amount_expected)
+    assert data == expected
+
+
+def test_line_too_long(client: socket.socket) -> None:
+    client.sendall(b'x' * 300)
+    assert receive_data(client, len(b'BAD_FORMAT\r\n')) == b'BAD_FORMAT\r\n'
+
+    # The rest of the line isn't taken for a command
+    client.sendall(b'xxx\r\nuse foo\r\n')
+    assert receive_data(client, len(b'USING foo\r\n')) == b'USING foo\r\n'
@@ -21,3 +21,9 @@ def test_use_use(client: socket.socket) -> None:
     amount_expected = len(expected)
     data = receive_data(client, amount_expected)
     assert data == expected
+
+
+def test_use_then_quit(client: socket.socket) -> None:
+    # Replies to what came before quit are sent before the connection closes
+    client.sendall(b'use test_use_quit\r\nquit\r\n')
+    assert receive_data(client, 100) == b'USING test_use_quit\r\n'
@@ -0,0 +1,136 @@
+import re
+import socket
+import time
+
+from utils import connect, read_list, read_yaml, receive_data, start_server
+
+
+PORT = 10_003
+# Enough tubes that they land on both workers
+TUBES = [b'test_workers_%d' % i for i in range(8)]
+
+
+def test_workers() -> None:
+    server = start_server(PORT, '--workers', '2')
+    try:
+        clients = [connect(PORT) for _ in range(4)]
+        producer, consumer = clients[0], clients[-1]
+        for tube in TUBES:
+            producer.sendall(b'use %s\r\nput 0 0 10 %d\r\n%s\r\n' % (tube, len(tube), tube))
+            data = receive_data(producer, len(b'USING %s\r\nINSERTED 1\r\n' % tube))
+            while not data.endswith(b'\r\n'):
+                data += receive_data(producer, 1)
+            assert re.fullmatch(b'USING %s\r\nINSERTED [0-9]+\r\n' % tube, data)
+
+        # The consumer's watch list spans both workers
+        for i, tube in enumerate(TUBES, 1):
+            consumer.sendall(b'watch %s\r\n' % tube)
+            assert receive_data(consumer, len(b'WATCHING %d\r\n' % i)) == b'WATCHING %d\r\n' % i
+        consumer.sendall(b'list-tubes-watched\r\n')
+        assert read_list(consumer) == TUBES
+        # Counted by each tube's owner, whichever worker the consumer is on
+        for tube in TUBES:
+            consumer.sendall(b'stats-tube %s\r\n' % tube)
+            assert read_yaml(consumer)['current-watching'] == '1'
+        consumer.sendall(b'list-tubes\r\n')
+        assert read_list(consumer) == sorted(TUBES)
+        job_ids = set()
+        bodies = set()
+        for _ in TUBES:
+            consumer.sendall(b'reserve-with-timeout 1\r\n')
+            data = receive_data(consumer, len(b'RESERVED 1 15\r\n'))
+            while data.count(b'\r\n') < 2:
+                data += receive_data(consumer, 1)
+            job_id, size, body = re.fullmatch(b'RESERVED ([0-9]+) ([0-9]+)\r\n(.*)\r\n', data).groups()
+            assert int(size) == len(body)
+            job_ids.add(job_id)
+            bodies.add(body)
+            consumer.sendall(b'delete %s\r\n' % job_id)
+            assert receive_data(consumer, len(b'DELETED\r\n')) == b'DELETED\r\n'
+        assert bodies == set(TUBES)
+        assert len(job_ids) == len(TUBES)
+        consumer.sendall(b'reserve-with-timeout 0\r\n')
+        assert receive_data(consumer, len(b'TIMED_OUT\r\n')) == b'TIMED_OUT\r\n'
+
+        # A blocked reserve on one tube gets a job put through any worker
+        for client in clients[1:-1]:
+            client.sendall(b'use test_workers_0\r\n')
+            receive_data(client, len(b'USING test_workers_0\r\n'))
+        waiter = clients[0]
+        waiter.sendall(b'watch test_workers_0\r\nreserve\r\n')
+        receive_data(waiter, len(b'WATCHING 1\r\n'))
+        clients[1].sendall(b'put 0 0 10 3\r\nhey\r\n')
+        data = receive_data(clients[1], len(b'INSERTED 1\r\n'))
+        while not data.endswith(b'\r\n'):
+            data += receive_data(clients[1], 1)
+        job_id = re.fullmatch(b'INSERTED ([0-9]+)\r\n', data).group(1)
+        expected = b'RESERVED %s 3\r\nhey\r\n' % job_id
+        assert receive_data(waiter, len(expected)) == expected
+        for client in clients:
+            client.close()
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def read_lines(client: socket.socket, count: int) -> bytes:
+    data = receive_data(client, 2)
+    while data.count(b'\r\n') < count or not data.endswith(b'\r\n'):
+        data += receive_data(client, 1)
+    return data
+
+
+def test_workers_reserve_across() -> None:
+    server = start_server(PORT, '--workers', '2')
+    try:
+        producer, consumer, quitter = [connect(PORT) for _ in range(3)]
+        for client in (consumer, quitter):
+            for i, tube in enumerate(TUBES, 1):
+                client.sendall(b'watch %s\r\n' % tube)
+                assert receive_data(client, len(b'WATCHING %d\r\n' % i)) == b'WATCHING %d\r\n' % i
+
+        # The most urgent job first, whichever worker holds it
+        for i, tube in enumerate(TUBES):
+            priority = 100 - 10 * i if i % 2 else 10 * i + 5
+            producer.sendall(b'use %s\r\nput %d 0 10 %d\r\n%s\r\n' % (tube, priority, len(tube), tube))
+            assert re.fullmatch(b'USING %s\r\nINSERTED [0-9]+\r\n' % tube, read_lines(producer, 2))
+        priorities = []
+        for _ in TUBES:
+            consumer.sendall(b'reserve-with-timeout 0\r\n')
+            job_id = read_lines(consumer, 2).split()[1]
+            consumer.sendall(b'stats-job %s\r\n' % job_id)
+            priorities.append(int(read_yaml(consumer)['pri']))
+            consumer.sendall(b'delete %s\r\n' % job_id)
+            assert read_lines(consumer, 1) == b'DELETED\r\n'
+        assert priorities == sorted(priorities)
+
+        # Nothing ready on any worker
+        started = time.monotonic()
+        consumer.sendall(b'reserve-with-timeout 1\r\n')
+        assert read_lines(consumer, 1) == b'TIMED_OUT\r\n'
+        assert 0.9 < time.monotonic() - started < 3
+
+        # One whose client hung up meanwhile doesn't take a job put later
+        quitter.sendall(b'reserve\r\n')
+        time.sleep(0.2)
+        quitter.close()
+        time.sleep(0.2)
+        producer.sendall(b'use %s\r\nput 0 0 10 3\r\nhey\r\n' % TUBES[-1])
+        job_id = read_lines(producer, 2).split()[-1]
+        time.sleep(0.2)
+        producer.sendall(b'stats-job %s\r\n' % job_id)
+        assert read_yaml(producer)['reserves'] == '0'
+        consumer.sendall(b'reserve\r\n')
+        assert read_lines(consumer, 2) == b'RESERVED %s 3\r\nhey\r\n' % job_id
+
+        # A blocked one gets a job put later on any of its tubes
+        consumer.sendall(b'reserve\r\n')
+        time.sleep(0.2)
+        producer.sendall(b'use %s\r\nput 0 0 10 3\r\nhoy\r\n' % TUBES[0])
+        job_id = read_lines(producer, 2).split()[-1]
+        assert read_lines(consumer, 2) == b'RESERVED %s 3\r\nhoy\r\n' % job_id
+        producer.close()
+        consumer.close()
+    finally:
+        server.terminate()
+        server.wait()
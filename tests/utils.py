@@ -1,4 +1,8 @@
+import re
 import socket
+import subprocess
+import sys
+import time
 
 
 def receive_data(socket: socket.socket, length: int, timeout_s: int = 3) -> bytes:
@@ -13,3 +17,53 @@ def receive_data(socket: socket.socket, length: int, timeout_s: int = 3) -> byte
         all_data += data
 
     return all_data
+
+
+def start_server(port: int, *args: str) -> subprocess.Popen:
+    # A server of its own, for tests that need command line options
+    cmd = [sys.executable, 'tree.py', '--port', str(port), *args]
+    return subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
+
+
+def connect(port: int) -> socket.socket:
+    for _ in range(50):
+        try:
+            return socket.create_connection(('localhost', port))
+        except ConnectionRefusedError:
+            time.sleep(0.1)
+    raise ConnectionRefusedError
+
+
+def read_ok(client: socket.socket) -> bytes:
+    # Body of an `OK <bytes>` reply, YAML without its leading ---
+    data = receive_data(client, len(b'OK 1\r\n'))
+    while b'\r\n' not in data:
+        data += receive_data(client, 1)
+    header, _, rest = data.partition(b'\r\n')
+    size = int(re.fullmatch(b'OK ([0-9]+)', header).group(1))
+    rest += receive_data(client, size + 2 - len(rest))
+    assert rest.startswith(b'---\n')
+    assert rest.endswith(b'\r\n')
+    return rest[4:-2]
+
+
+def read_yaml(client: socket.socket) -> dict:
+    lines = read_ok(client).decode().splitlines()
+    return dict(line.split(': ', 1) for line in lines)
+
+
+def read_list(client: socket.socket) -> list:
+    lines = read_ok(client).splitlines()
+    assert all(line.startswith(b'- ') for line in lines)
+    return [line[2:] for line in lines]
+
+
+def wait_for_waiting(client: socket.socket, tube: bytes, count: int) -> None:
+    # Until count clients are blocked in a reserve on the tube. Another
+    # connection's reserve has no reply to wait for.
+    for _ in range(300):
+        client.sendall(b'stats-tube %s\r\n' % tube)
+        if read_yaml(client)['current-waiting'] == str(count):
+            return
+        time.sleep(0.01)
+    raise TimeoutError
@@ -0,0 +1,109 @@
+import heapq
+import itertools
+import time
+
+
+class Timer:
+    __slots__ = ('args', 'at', 'callback', 'cancelled', 'deadline', 'seq')
+
+    def __init__(self, deadline: float, seq: int, callback, args) -> None:
+        self.args = args
+        # Where it sits in the heap. The deadline can be moved later than
+        # that, see Timers.postpone().
+        self.at = deadline
+        self.callback = callback
+        self.cancelled = False
+        self.deadline = deadline
+        self.seq = seq
+
+    def __lt__(self, other):
+        # Earliest first, in scheduling order for equal deadlines
+        if self.at != other.at:
+            return self.at < other.at
+        return self.seq < other.seq
+
+
+# One deadline heap for every TTR, delay and timeout in the server.
+# It does no I/O: the server runs a single task that sleeps until
+# next_deadline() and calls expire().
+class Timers:
+    def __init__(self, resolution: float = 0.01) -> None:
+        self.cancelled = 0
+        self.heap = []
+        # Timers due within this many seconds of each other fire together
+        self.resolution = resolution
+        self.seq = itertools.count()
+        # Set by the server, called when a new timer becomes the earliest
+        self.wakeup = None
+
+    def __len__(self) -> int:
+        return len(self.heap) - self.cancelled
+
+    def schedule(self, delay: float, callback, *args) -> Timer:
+        deadline = time.monotonic() + delay
+        timer = Timer(deadline, next(self.seq), callback, args)
+        heapq.heappush(self.heap, timer)
+        if self.heap[0] is timer and self.wakeup is not None:
+            self.wakeup()
+        return timer
+
+    def cancel(self, timer: Timer | None) -> None:
+        # Cancelled timers stay in the heap until they reach the top
+        if timer is None or timer.cancelled:
+            return
+        timer.cancelled = True
+        self.cancelled += 1
+        if self.cancelled > len(self.heap) // 2 + 64:
+            # In place, expire() may be popping from this list while the
+            # callback it called cancels timers
+            self.heap[:] = [t for t in self.heap if not t.cancelled]
+            heapq.heapify(self.heap)
+            self.cancelled = 0
+
+    def reschedule(self, timer: Timer | None, delay: float) -> Timer:
+        callback, args = timer.callback, timer.args
+        self.cancel(timer)
+        return self.schedule(delay, callback, *args)
+
+    def postpone(self, timer: Timer, delay: float) -> Timer:
+        # Move the deadline to delay from now. Moving it later doesn't
+        # touch the heap, expire() puts the timer back when it gets to
+        # its old place. Returns the timer to keep, a new one if earlier.
+        deadline = time.monotonic() + delay
+        if deadline < timer.at:
+            return self.reschedule(timer, delay)
+        timer.deadline = deadline
+        return timer
+
+    def next_deadline(self) -> float | None:
+        # When expire() has something to fire, in time.monotonic() terms
+        heap = self.heap
+        while heap and heap[0].cancelled:
+            heapq.heappop(heap)
+            self.cancelled -= 1
+        if heap:
+            return heap[0].at - self.resolution
+        return None
+
+    def expire(self, now: float | None = None) -> int:
+        # Fire every timer that is due, return how many fired
+        if now is None:
+            now = time.monotonic()
+        now += self.resolution
+        heap = self.heap
+        fired = 0
+        while heap and heap[0].at <= now:
+            timer = heapq.heappop(heap)
+            if timer.cancelled:
+                self.cancelled -= 1
+                continue
+            if timer.deadline > now:
+                # Postponed since it was scheduled
+                timer.at = timer.deadline
+                heapq.heappush(heap, timer)
+                continue
+            # Mark it so a late cancel() from the callback is a no-op
+            timer.cancelled = True
+            timer.callback(*timer.args)
+            fired += 1
+        return fired
@@ -1,27 +1,33 @@
-import functools
+import argparse
 import logging
-import re
+import math
+import os
+import signal
+import socket
+import subprocess
 import sys
+import tempfile
+import time
 
 import trio
 
+from binlog import Binlog, open_binlog, SEGMENT_SIZE
+from cluster import Router, socket_path, wait_or_hang_up, Worker
+from commands import COMMANDS, handle_message
+from metrics import Metrics
+from parser import Parser
+import protocol
 from protocol import (
-    add_job,
-    check_job_ttr,
     Client,
-    delete_job,
     drop_connection,
-    ensure_tube_has_client,
-    ensure_tube_without_client,
-    get_job_by_id,
-    ignore_message,
-    Job,
+    drop_sent,
+    IOV_MAX,
     MAX_JOB_SIZE,
+    MAX_UNSENT,
     QuitMessage,
-    release_job,
-    try_to_issue_job,
-    try_to_issue_job_to_client,
+    timers,
 )
+from store import BodyStore
 
 
 logger = logging.getLogger(__name__)
@@ -29,206 +35,309 @@ logger.setLevel(logging.DEBUG)
 handler = logging.StreamHandler(sys.stdout)
 logger.addHandler(handler)
 
-put_head_re = re.compile('put ([0-9]+) ([0-9]+) ([0-9]+) ([0-9]+)')
+# With --fsync always a reply is only sent once the records of the
+# commands before it are on disk
+sync_replies = False
+# Set whenever a binlog write finishes
+binlog_written = trio.Event()
+# This process' share of the tubes when started by --workers
+worker = None
 
 
-async def issue_job(job: Job) -> None:
-    job_size = len(job.body)
-    message = f'RESERVED {job.id} {job_size}\r\n'
-    to_send = message.encode('utf-8') + job.body + b'\r\n'
-    try:
-        await job.client.connection.send_all(to_send)
-    except Exception:
-        return False
-    else:
-        return True
+async def run_timers() -> None:
+    while True:
+        timers.expire()
+        wakeup = trio.Event()
+        timers.wakeup = wakeup.set
+        deadline = timers.next_deadline()
+        if deadline is None:
+            timeout = math.inf
+        else:
+            timeout = max(deadline - time.monotonic(), 0)
+        with trio.move_on_after(timeout):
+            await wakeup.wait()
 
 
-async def reserve_with_timeout(client, time_s, parent_nursery):
-    job_given = trio.Event()
+async def run_binlog(binlog: Binlog, interval: float) -> None:
+    global binlog_written
     async with trio.open_nursery() as nursery:
-        nursery.start_soon(
-            try_to_issue_job_to_client,
-            client,
-            issue_job,
-            parent_nursery,
-            job_given,
-        )
-        with trio.move_on_after(time_s):
-            await job_given.wait()
-        nursery.cancel_scope.cancel()
-    if not job_given.is_set():
-        to_send = b'TIMED_OUT\r\n'
-        await client.connection.send_all(to_send)
-
-
-async def try_to_release_job(client, job_id, priority, delay):
-    job = get_job_by_id(job_id)
-    if job and job.client and job.client == client:
-        if delay:
-            job.state = 'delayed'
-        job.priority = priority
-        release_job(job)
-        to_send = b'RELEASED\r\n'
-        await client.connection.send_all(to_send)
-        if delay:
-            await trio.sleep(delay)
-            job.state = 'ready'
-    else:
-        to_send = b'NOT_FOUND\r\n'
-        await client.connection.send_all(to_send)
-
-
-async def try_to_issue_job_after_delay(job: Job, delay, tube, issue_job):
-    await trio.sleep(delay)
-    job.state = 'ready'
-    client = await try_to_issue_job(tube, issue_job)
-    if client:
-        await check_job_ttr(job)
-
-
-def handle_message(nursery, client: Client, message: bytes) -> str | None:
-    logger.debug('handle_message() %s', message)
-    if message == b'quit':
-        raise QuitMessage
-    if message.startswith(b'use '):
-        tube = message.replace(b'use ', b'').decode('utf-8')
-        client.using = tube
-        return f'USING {tube}\r\n'
-    if message.startswith(b'watch '):
-        tube = message.replace(b'watch ', b'').decode('utf-8')
-        client.watching.append(tube)
-        ensure_tube_has_client(tube, client)
-        count = len(client.watching)
-        return f'WATCHING {count}\r\n'
-    if message.startswith(b'ignore '):
-        tube = message.replace(b'ignore ', b'').decode('utf-8')
-        client.watching.remove(tube)
-        ensure_tube_without_client(tube, client)
-        count = len(client.watching)
-        return f'WATCHING {count}\r\n'
-    if message.startswith(b'reserve-with-timeout'):
-        if not client.watching:
-            msg = 'Error: `reserve` without watching a tube.'
-            return msg
-        time_s = int(message.replace(b'reserve-with-timeout ', b'').strip())
-        nursery.start_soon(reserve_with_timeout, client, time_s, nursery)
-        return
-    if message.startswith(b'reserve'):
-        if not client.watching:
-            msg = 'Error: `reserve` without watching a tube.'
-            return msg
-        nursery.start_soon(try_to_issue_job_to_client, client, issue_job, nursery)
-        return
-    if message.startswith(b'put '):
-        head, body = message.split(b'\r\n')
-        tube = client.using
-        if tube is None:
-            msg = 'Error: `put` without using a tube.'
-            return msg
-        (priority, delay, ttr, _num_bytes) = put_head_re.match(head.decode('utf-8')).groups()
-        job = Job(body, int(priority), int(ttr))
-        delay = int(delay)
-        if delay:
-            job.state = 'delayed'
-        job_id = add_job(tube, job)
-        logger.debug('Job created.')
-        if delay:
-            nursery.start_soon(try_to_issue_job_after_delay, job, delay, tube, issue_job)
-        else:
-            nursery.start_soon(try_to_issue_job, tube, issue_job)
-        return f'INSERTED {job_id}\r\n'
-    if message.startswith(b'delete '):
-        job_id = int(message.replace(b'delete ', b'').strip())
-        job = get_job_by_id(job_id)
-        if not job:
-            return 'NOT_FOUND\r\n'
-
-        if not job.client or (job.client and client == job.client):
-            delete_job(job)
-            return 'DELETED\r\n'
-        return 'NOT_FOUND\r\n'
-    if message.startswith(b'release '):
-        _, job_id, pri, delay = message.split(b' ')
-        job_id = int(job_id)
-        pri = int(pri)
-        delay = int(delay)
-        nursery.start_soon(try_to_release_job, client, job_id, pri, delay)
-        return
-
-
-async def on_connection(connection, nursery) -> None:
-    address = connection.socket.getsockname()
+        while True:
+            if not binlog.pending:
+                wakeup = trio.Event()
+                binlog.wakeup = wakeup.set
+                await wakeup.wait()
+            # Let records pile up between fsyncs
+            await trio.sleep(interval)
+            # Group commit: everything appended since the last round goes out
+            # in one write and one fsync, off the event loop
+            buffers, appended = binlog.take()
+            await trio.to_thread.run_sync(binlog.write, buffers)
+            binlog.synced = appended
+            binlog_written.set()
+            binlog_written = trio.Event()
+            if binlog.wants_snapshot():
+                nursery.start_soon(take_snapshot, binlog)
+
+
+async def wait_for_binlog(binlog: Binlog) -> None:
+    appended = binlog.appended
+    while binlog.synced < appended:
+        await binlog_written.wait()
+
+
+async def take_snapshot(binlog: Binlog) -> None:
+    # Only capturing the jobs happens on the event loop
+    snapshot = binlog.snapshot()
+    await trio.to_thread.run_sync(binlog.write_snapshot, snapshot)
+    # The writer has to start the segment the snapshot precedes first
+    await wait_for_binlog(binlog)
+    await trio.to_thread.run_sync(binlog.commit_snapshot, snapshot)
+    binlog.snapshotting = False
+
+
+async def send_buffers(sock, buffers: list) -> None:
+    while buffers:
+        sent = await sock.sendmsg(buffers[:IOV_MAX])
+        drop_sent(buffers, sent)
+
+
+async def send_replies(connection, client: Client) -> None:
+    sock = connection.socket
+    while True:
+        wakeup = trio.Event()
+        client.wakeup = wakeup.set
+        if not client.outgoing:
+            await wakeup.wait()
+        # Everything written while this task wasn't running, usually the
+        # replies to a whole read batch, goes out in one sendmsg
+        buffers = client.outgoing
+        client.outgoing = []
+        size = sum(map(len, buffers))
+        if sync_replies:
+            await wait_for_binlog(protocol.binlog)
+        await send_buffers(sock, buffers)
+        client.unsent -= size
+        if client.sent is not None:
+            client.sent()
+
+
+async def wait_sent(client: Client, limit: int) -> None:
+    # Until no more than limit bytes of replies wait to be sent
+    while client.unsent > limit:
+        sent = trio.Event()
+        client.sent = sent.set
+        await sent.wait()
+
+
+async def receive_messages(connection, client: Client, router: Router | None) -> None:
+    # Returns on EOF or quit
+    sock = connection.socket
+    parser = Parser(MAX_JOB_SIZE)
+    while True:
+        await wait_sent(client, MAX_UNSENT)
+        # Put bodies are received straight into the buffer they are kept in
+        nbytes = await sock.recv_into(parser.get_buffer())
+        if nbytes == 0:
+            return
+
+        parser.buffer_updated(nbytes)
+        try:
+            for command in parser:
+                # Framing errors are replied to in turn too, by handle_message()
+                metrics = None if command.error else protocol.metrics
+                if metrics is not None:
+                    started = time.perf_counter()
+                if router is not None:
+                    await router.handle(command)
+                else:
+                    reply = handle_message(client, command)
+                    if reply:
+                        client.write(reply)
+                if metrics is not None:
+                    name = command.line.partition(b' ')[0]
+                    if name not in COMMANDS:
+                        name = b'unknown'
+                    metrics.command(name, time.perf_counter() - started)
+                if client.waiting and not await wait_for_reserve(sock, client):
+                    return
+        except QuitMessage:
+            return
+
+
+async def wait_for_reserve(sock, client: Client) -> bool:
+    # Like beanstalkd, nothing sent after a reserve that waits is read
+    # until it is answered, it stays in the parser and the socket. A
+    # client hanging up meanwhile is still noticed, False then.
+    resumed = trio.Event()
+    client.resume = resumed.set
+    alive = await wait_or_hang_up(sock, resumed)
+    client.resume = None
+    return alive
+
+
+async def on_connection(connection) -> None:
+    address = connection.socket.getpeername()
+    # Every reply to this client, including jobs handed over by other
+    # connections, goes through one writer so they never interleave
     client = Client(connection, address)
-    
-    message = b''
+
+    router = None
     try:
-        async for data in connection:
-            if data == b'':
-                message = b''
-                drop_connection(client)
-                return
-
-            message += data
-            if ignore_message(message):
-                message = b''
-                continue
-            if message.startswith(b'put') and b'\r\n' in message:
-                try:
-                    (pri, delay, ttr, num_bytes) = put_head_re.match(message.decode('utf-8')).groups()
-                except AttributeError:
-                    continue
-                num_bytes_int = int(num_bytes)
-                if num_bytes_int > MAX_JOB_SIZE:
-                    # clear message before yielding to event loop
-                    message = b''
-                    await connection.send_all(b'JOB_TOO_BIG\r\n')
-                    continue
-                body = message.split(b'\r\n')[-1]
-                if body and len(body) > num_bytes_int:
-                    # clear message before yielding to event loop
-                    message = b''
-                    await connection.send_all(b'EXPECTED_CRLF\r\n')
-                    continue
-                if message.count(b'\r\n') == 1:
-                    continue
-            elif b'\r\n' not in message:
-                continue
-
-            # message will contain at least one message
-            messages = message.split(b'\r\n')
-            # Combine put which has two \r\n
-            complete_messages = []
-            found_put = False
-            for idx, message in enumerate(messages):
-                if found_put:
-                    complete_messages[-1] += b'\r\n' + message
-                    found_put = False
-                if b'put' in message:
-                    found_put = True
-                complete_messages.append(message)
-
-            for message in complete_messages:
-                try:
-                    reply = handle_message(nursery, client, message)
-                except QuitMessage:
-                    drop_connection(client)
-                    return
-                if reply:
-                    await connection.send_all(reply.encode('utf-8'))
-    except trio.BrokenResourceError:
+        async with trio.open_nursery() as connection_nursery:
+            connection_nursery.start_soon(send_replies, connection, client)
+            # Other workers only send what this one holds, handled here
+            if worker is not None and connection.socket.family != socket.AF_UNIX:
+                router = Router(worker, client, connection_nursery)
+            await receive_messages(connection, client, router)
+            # Replies to the commands before it still go out
+            await wait_sent(client, 0)
+            connection_nursery.cancel_scope.cancel()
+    except (OSError, trio.BrokenResourceError):
+        pass
+    finally:
         drop_connection(client)
-        return
+        if router is not None:
+            with trio.CancelScope(shield=True):
+                await router.close()
+
+
+async def serve_metrics(stream: trio.SocketStream) -> None:
+    # Just enough HTTP for a Prometheus scrape. A scraper that goes away
+    # mid-request only ends its own connection.
+    try:
+        request = b''
+        with trio.move_on_after(10):
+            while b'\r\n\r\n' not in request and len(request) < 8192:
+                data = await stream.receive_some()
+                if not data:
+                    break
+                request += data
+        path = request.split(b' ', 2)[1] if request.count(b' ') >= 2 else b''
+        if path.split(b'?')[0] == b'/metrics':
+            status = b'200 OK'
+            body = protocol.metrics.render()
+        else:
+            status = b'404 Not Found'
+            body = b'Not Found\n'
+        header = (
+            b'HTTP/1.0 %s\r\nContent-Type: text/plain; version=0.0.4\r\n'
+            b'Content-Length: %d\r\nConnection: close\r\n\r\n' % (status, len(body))
+        )
+        await stream.send_all(header + body)
+    except (trio.BrokenResourceError, OSError):
+        pass
+    finally:
+        await stream.aclose()
+
 
+def parse_args(argv: list) -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=10_000)
+    parser.add_argument('--binlog-dir', help='keep jobs across restarts in this directory')
+    parser.add_argument(
+        '--binlog-size', type=int, default=SEGMENT_SIZE,
+        help='start a new binlog segment past this many bytes',
+    )
+    parser.add_argument('--spill-dir', help='spill job bodies past --body-budget to a file here')
+    parser.add_argument(
+        '--body-budget', type=int, default=2 ** 30,
+        help='bytes of job bodies kept in memory with --spill-dir',
+    )
+    parser.add_argument(
+        '--fsync', default='always',
+        help="'always' before replying, 'never', or every this many milliseconds",
+    )
+    parser.add_argument(
+        '--metrics-port', type=int,
+        help='serve Prometheus metrics over HTTP, worker N of --workers uses this port + N',
+    )
+    parser.add_argument('--workers', type=int, default=1, help='processes sharing the port and the tubes')
+    # Set for the processes started by --workers
+    parser.add_argument('--worker', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--run-dir', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.fsync not in ('always', 'never') and not args.fsync.isdigit():
+        parser.error('--fsync must be always, never or a number of milliseconds')
+    return args
 
-async def main() -> None:
+
+def run_workers(args: argparse.Namespace, argv: list) -> None:
+    # Start the workers and wait for them, they share the TCP port with
+    # SO_REUSEPORT and reach each other over Unix sockets in run_dir
+    run_dir = tempfile.mkdtemp(prefix='tree-')
+    workers = [
+        subprocess.Popen([
+            sys.executable, __file__, *argv, '--worker', str(i), '--run-dir', run_dir,
+        ])
+        for i in range(args.workers)
+    ]
+
+    def stop(signum, frame) -> None:
+        for process in workers:
+            process.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for process in workers:
+        process.wait()
+    for i in range(args.workers):
+        try:
+            os.unlink(socket_path(run_dir, i))
+        except FileNotFoundError:
+            pass
+    os.rmdir(run_dir)
+
+
+async def open_listeners(args: argparse.Namespace) -> list:
+    tcp = trio.socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    await tcp.bind(('', args.port))
+    tcp.listen()
+    unix = trio.socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    await unix.bind(socket_path(args.run_dir, args.worker))
+    unix.listen()
+    return [trio.SocketListener(tcp), trio.SocketListener(unix)]
+
+
+async def main(args: argparse.Namespace) -> None:
+    global sync_replies, worker
+    binlog_dir = args.binlog_dir
+    if args.worker is not None:
+        worker = Worker(args.worker, args.workers, args.run_dir)
+        if binlog_dir:
+            binlog_dir = os.path.join(binlog_dir, 'worker.%d' % args.worker)
     async with trio.open_nursery() as nursery:
-        server_task = functools.partial(on_connection, nursery=nursery)
-        # nursery.start_soon(trio.serve_tcp, server_task, 10_000)
-        listener = await nursery.start(trio.serve_tcp, server_task, 10_000)
+        nursery.start_soon(run_timers)
+        if args.spill_dir:
+            # Before the binlog so restored bodies are spilled too
+            protocol.store = BodyStore(args.spill_dir, args.body_budget)
+        if binlog_dir:
+            binlog = open_binlog(binlog_dir, args.fsync != 'never', args.binlog_size)
+            protocol.binlog = binlog
+            if args.fsync == 'always':
+                sync_replies = True
+                interval = 0
+            elif args.fsync == 'never':
+                interval = 0
+            else:
+                interval = int(args.fsync) / 1000
+            nursery.start_soon(run_binlog, binlog, interval)
+        if args.metrics_port is not None:
+            protocol.metrics = Metrics()
+            metrics_port = args.metrics_port + (args.worker or 0)
+            await nursery.start(trio.serve_tcp, serve_metrics, metrics_port)
+        if worker is not None:
+            listeners = await open_listeners(args)
+            listener = await nursery.start(trio.serve_listeners, on_connection, listeners)
+        else:
+            listener = await nursery.start(trio.serve_tcp, on_connection, args.port)
         print(f"Server is running and ready to accept connections on {listener[0].socket.getsockname()}")
 
 
-
 if __name__ == '__main__':
-    trio.run(main)
+    args = parse_args(sys.argv[1:])
+    if args.workers > 1 and args.worker is None:
+        run_workers(args, sys.argv[1:])
+    else:
+        trio.run(main, args)